@@ -0,0 +1,98 @@
+"""
+Excel入出力のベンチマーク。
+
+- 設計書の読み込み: openpyxl / calamine の所要時間と、テキスト化結果が一致するか
+- テンプレートの準備: 毎回load_workbookする場合と、キャッシュから複製する場合の所要時間
+- テスト仕様書の書き込み: 指定件数の行をテンプレートへ書き込み、保存するまでの所要時間
+
+実行方法（プロジェクトルートで実行）:
+    python benchmarks/bench_excel_io.py --rows 20000 --cases 5000
+"""
+import argparse
+import datetime
+import io
+import sys
+import time
+from pathlib import Path
+
+from openpyxl import Workbook, load_workbook
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import function_app  # noqa: E402
+
+
+def build_design_book(rows: int, sheets: int, row_counts: list[int] | None = None) -> bytes:
+    # 項目定義書を模した合成データ（空列・空セル・日付・数値を含む）
+    # row_countsを指定した場合は、シートごとの行数をその値にする
+    wb = Workbook()
+    for sheet_index in range(sheets):
+        ws = wb.active if sheet_index == 0 else wb.create_sheet()
+        ws.title = f"画面定義{sheet_index + 1}"
+        ws.append(["項目名", "型", "桁数", None, "必須", "更新日", "備考"])
+        for i in range(row_counts[sheet_index] if row_counts else rows):
+            ws.append([
+                f"項目{i}", "文字列" if i % 2 else "数値", i % 100, None,
+                "○" if i % 3 else None,
+                datetime.datetime(2024, 1, 1) + datetime.timedelta(days=i % 365),
+                # シートごとに内容を変える（内容が同じシートは構造化結果が再利用されるため）
+                f"入力チェック{(i + sheet_index) % 7}",
+            ])
+    buffer = io.BytesIO()
+    wb.save(buffer)
+    return buffer.getvalue()
+
+
+def build_spec_rows(cases: int) -> list[dict[str, str]]:
+    return [
+        {
+            "No": str(i + 1),
+            "大区分": f"画面{i // 100}",
+            "中区分": f"入力チェック{i // 10}",
+            "テストケース": f"項目{i}に最大桁数+1の値を入力して登録する",
+            "期待結果": "エラーメッセージが表示され、登録されないこと",
+            "トレース元": f"画面定義1 項目{i}",
+        }
+        for i in range(cases)
+    ]
+
+
+def measure(label: str, func):
+    started = time.perf_counter()
+    result = func()
+    print(f"{label:<40} {time.perf_counter() - started:8.2f}s")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=20000, help="設計書1シートあたりの行数")
+    parser.add_argument("--sheets", type=int, default=3, help="設計書のシート数")
+    parser.add_argument("--cases", type=int, default=5000, help="書き込むテストケース数")
+    parser.add_argument("--requests", type=int, default=3, help="テンプレート準備を繰り返す回数")
+    args = parser.parse_args()
+
+    design_bytes = build_design_book(args.rows, args.sheets)
+    print(f"設計書: {args.sheets}シート x {args.rows}行 ({len(design_bytes) / 1024 / 1024:.1f}MB)")
+
+    # --- 設計書の読み込み ---
+    texts = {}
+    for engine in ("openpyxl", "calamine"):
+        function_app.excel_read_engine = engine
+        sheets = measure(f"読み込み ({engine})", lambda: function_app.read_excel_sheets(design_bytes))
+        texts[engine] = {name: function_app.serialize_sheet(df) for name, df in sheets.items()}
+    print(f"テキスト化結果の一致: {texts['openpyxl'] == texts['calamine']}")
+
+    # --- テンプレートの準備 ---
+    measure(f"テンプレート load_workbook x{args.requests}", lambda: [load_workbook(function_app.unit_test_template_path) for _ in range(args.requests)])
+    measure("テンプレート 初回読み込み（キャッシュ作成）", function_app.load_template_workbook)
+    measure(f"テンプレート 複製 x{args.requests}", lambda: [function_app.load_template_workbook() for _ in range(args.requests)])
+
+    # --- テスト仕様書の書き込み ---
+    spec_rows = build_spec_rows(args.cases)
+    wb = function_app.load_template_workbook()
+    measure(f"{args.cases}件の書き込み", lambda: function_app.write_spec_rows(wb.active, spec_rows, start_row=11))
+    measure("保存", lambda: wb.save(io.BytesIO()))
+
+
+if __name__ == "__main__":
+    main()
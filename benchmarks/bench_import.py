@@ -0,0 +1,181 @@
+"""
+ワーカーのコールドスタートの計測（LLMはモックを使用）。
+
+別プロセスで以下を計測して出力する。
+- function_appのimport時間（python -X importtimeの累計時間）と、時間のかかっている依存モジュール
+- import時点で読み込まれている重いライブラリ（pandas、openpyxl、LLMサービスのSDK）
+- import直後に受けた初回リクエスト（単体テスト生成）と、2回目のリクエストの所要時間
+- WARMUP_ENABLED=trueで、ウォームアップの完了後に初回リクエストを受けた場合の所要時間
+
+importの累計時間が--max-import-msを超えた場合、またはimport時点で重いライブラリが読み込まれている場合は
+終了コード1を返す（コールドスタートの劣化の検出に使用する）。
+
+実行方法（プロジェクトルートで実行）:
+    python benchmarks/bench_import.py --repeat 5 --max-import-ms 1000
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+BENCHMARK_DIR = Path(__file__).resolve().parent
+
+# import時に読み込まれてはならないライブラリ（使用する関数の中で読み込む）
+HEAVY_MODULES = ["pandas", "openpyxl", "python_calamine", "openai", "boto3", "botocore", "httpx"]
+
+# importtimeの出力（import time: 自身の時間 | 累計時間 | モジュール名、単位はマイクロ秒）
+IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)$")
+
+
+def child_env(work_dir: str, warmup: bool) -> dict:
+    env = dict(os.environ)
+    env.update(
+        LLM_CACHE_DIR=os.path.join(work_dir, "llm_cache"),
+        RUN_STORE_DIR=os.path.join(work_dir, "runs"),
+        JOB_RESULT_DIR=os.path.join(work_dir, "jobs"),
+        WARMUP_ENABLED="true" if warmup else "false",
+        # ウォームアップでクライアントを生成できるよう、ダミーの接続情報を設定する（LLMは呼び出さない）
+        LLM_SERVICE="AWS",
+        AWS_REGION="ap-northeast-1",
+        AWS_ACCESS_KEY_ID="dummy",
+        AWS_SECRET_ACCESS_KEY="dummy",
+        AWS_BEDROCK_MODEL_ID="dummy",
+    )
+    return env
+
+
+# --- import時間 ---
+def measure_import_time(env: dict) -> tuple[float, list[tuple[str, float]]]:
+    """
+    python -X importtimeでfunction_appをimportし、累計時間（ミリ秒）と直接importしているモジュールの累計時間を返す。
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import function_app"],
+        cwd=PROJECT_ROOT, env=env, capture_output=True, text=True, check=True,
+    )
+    total = None
+    children = []
+    pending = []
+    # importtimeは子モジュールを親より先に（階層ごとに2文字字下げして）出力するため、
+    # function_appの行の直前にある1階層下の行が、function_appから直接importしたモジュール
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        cumulative_ms = int(match.group(2)) / 1000
+        depth = (len(match.group(3)) - 1) // 2
+        name = match.group(4)
+        if depth == 0:
+            if name == "function_app":
+                total, children = cumulative_ms, pending
+            pending = []
+        elif depth == 1:
+            pending.append((name, cumulative_ms))
+    return total, sorted(children, key=lambda item: item[1], reverse=True)
+
+
+def loaded_heavy_modules(env: dict) -> list[str]:
+    code = f"import json, sys, function_app; print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))"
+    result = subprocess.run([sys.executable, "-c", code], cwd=PROJECT_ROOT, env=env, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+# --- 初回リクエスト ---
+def run_child(design_path: str, warmup: bool):
+    # LLMモックはopenai・botocoreを読み込むため、function_appより先に読み込み、計測から除く
+    sys.path[:0] = [str(PROJECT_ROOT), str(BENCHMARK_DIR)]
+    from mock_llm import MockLLMSettings, install_mock_llm
+
+    started = time.perf_counter()
+    import function_app
+    import_seconds = time.perf_counter() - started
+
+    warmup_seconds = None
+    if warmup:
+        # ウォームアップの完了を待ってから初回リクエストを受けた場合を計測する
+        for thread in threading.enumerate():
+            if thread.name == "warmup":
+                thread.join()
+        warmup_seconds = time.perf_counter() - started
+
+    install_mock_llm(function_app, MockLLMSettings(latency=0.0, tokens_per_second=1_000_000))
+    design_bytes = Path(design_path).read_bytes()
+    requests = []
+    for index in range(2):
+        request_started = time.perf_counter()
+        with tempfile.TemporaryFile() as output:
+            function_app.run_unit_test_pipeline(design_bytes, f"設計書{index}.xlsx", output, use_cache=False)
+        requests.append(time.perf_counter() - request_started)
+
+    print(json.dumps({"import": import_seconds, "warmup": warmup_seconds, "first": requests[0], "second": requests[1]}))
+
+
+def measure_first_request(design_path: str, warmup: bool) -> dict:
+    with tempfile.TemporaryDirectory() as work_dir:
+        result = subprocess.run(
+            [sys.executable, __file__, "--child", design_path] + (["--warmup"] if warmup else []),
+            cwd=PROJECT_ROOT, env=child_env(work_dir, warmup), capture_output=True, text=True,
+        )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5, help="import時間の計測回数（中央値を使用）")
+    parser.add_argument("--max-import-ms", type=float, default=0, help="importの累計時間の上限（ミリ秒、0の場合は判定しない）")
+    parser.add_argument("--skip-requests", action="store_true", help="初回リクエストの計測を省略する（テンプレートの解析に数十秒かかる）")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--warmup", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, args.warmup)
+        return
+
+    failed = False
+    with tempfile.TemporaryDirectory() as work_dir:
+        env = child_env(work_dir, warmup=False)
+        measurements = [measure_import_time(env) for _ in range(args.repeat)]
+        import_ms = statistics.median(total for total, _ in measurements)
+        print(f"function_appのimport: {import_ms:.0f}ms（{args.repeat}回の中央値）")
+        for name, cumulative_ms in measurements[-1][1][:8]:
+            print(f"    {name:<32} {cumulative_ms:8.0f}ms")
+        if args.max_import_ms and import_ms > args.max_import_ms:
+            print(f"NG: importの累計時間が上限（{args.max_import_ms:.0f}ms）を超えています。")
+            failed = True
+
+        heavy = loaded_heavy_modules(env)
+        print(f"import時点で読み込まれている重いライブラリ: {', '.join(heavy) if heavy else 'なし'}")
+        if heavy:
+            print("NG: 重いライブラリは使用する関数の中で読み込んでください。")
+            failed = True
+
+    if not args.skip_requests:
+        sys.path.insert(0, str(BENCHMARK_DIR))
+        from bench_excel_io import build_design_book
+        with tempfile.NamedTemporaryFile(suffix=".xlsx", delete=False) as design_file:
+            design_file.write(build_design_book(50, 2))
+        try:
+            for warmup in (False, True):
+                result = measure_first_request(design_file.name, warmup)
+                label = "ウォームアップあり" if warmup else "ウォームアップなし"
+                warmup_text = f" ウォームアップ完了まで={result['warmup']:.2f}s" if warmup else ""
+                print(f"{label}: import={result['import']:.2f}s{warmup_text} 初回リクエスト={result['first']:.2f}s 2回目={result['second']:.2f}s")
+        finally:
+            os.remove(design_file.name)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
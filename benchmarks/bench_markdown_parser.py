@@ -0,0 +1,85 @@
+"""
+テスト仕様書（Markdown表）の解析のベンチマーク。
+
+LLMのストリーミング応答を模したチャンク列を解析し、以下を比較する。
+- iter_markdown_table_rows: 行単位で逐次解析する現在の方式
+- TSV変換 + pd.read_csv: 応答全体をTSVに変換してDataFrameとして読み込む従来の方式
+
+実行方法（プロジェクトルートで実行）:
+    python benchmarks/bench_markdown_parser.py --cases 5000
+"""
+import argparse
+import io
+import random
+import sys
+import time
+from pathlib import Path
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import function_app  # noqa: E402
+
+
+def build_unit_spec_markdown(cases: int) -> str:
+    lines = [
+        "| No | 大区分 | 中区分 | テストケース | 期待結果 | トレース元 |",
+        "|---|---|---|---|---|---|",
+    ]
+    for i in range(cases):
+        major = f"画面{i // 100}" if i % 100 == 0 else ""
+        minor = f"項目{i // 10}" if i % 10 == 0 else ""
+        lines.append(f"| {i + 1} | {major} | {minor} | 項目{i}に「A\\|B」を入力して登録を確認する | エラーメッセージが表示されること | 2.{i} |")
+    return "\n".join(lines) + "\n"
+
+
+def split_chunks(text: str, chunk_size: int) -> list[str]:
+    # ストリーミング応答のように、行の途中で区切られたチャンクに分割する
+    rng = random.Random(0)
+    chunks = []
+    position = 0
+    while position < len(text):
+        size = rng.randint(1, chunk_size)
+        chunks.append(text[position:position + size])
+        position += size
+    return chunks
+
+
+def parse_streaming(chunks: list[str]) -> list[dict[str, str]]:
+    return list(function_app.iter_unit_spec_rows(function_app.iter_lines(iter(chunks))))
+
+
+def parse_tsv(chunks: list[str]) -> pd.DataFrame:
+    table_lines = [line.strip("|").replace("|", "\t") for line in "".join(chunks).splitlines() if line.startswith("|")]
+    # セル内の「|」で列数がずれた行は読み込めないため読み飛ばす
+    return pd.read_csv(io.StringIO("\n".join(table_lines)), sep="\t", dtype=str, on_bad_lines="skip")
+
+
+def measure(label: str, func, repeat: int):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    elapsed = (time.perf_counter() - started) / repeat
+    print(f"{label:<30} {elapsed * 1000:8.1f}ms")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cases", type=int, default=5000, help="テストケース数")
+    parser.add_argument("--chunk-size", type=int, default=40, help="チャンクの最大文字数")
+    parser.add_argument("--repeat", type=int, default=5, help="計測の繰り返し回数")
+    args = parser.parse_args()
+
+    chunks = split_chunks(build_unit_spec_markdown(args.cases), args.chunk_size)
+    print(f"{args.cases}件 / {len(chunks)}チャンク")
+
+    rows = measure("逐次解析", lambda: parse_streaming(chunks), args.repeat)
+    df = measure("TSV変換 + read_csv", lambda: parse_tsv(chunks), args.repeat)
+
+    print(f"逐次解析: {len(rows)}行、セル内の「|」を保持: {rows[0]['テストケース']}")
+    print(f"TSV変換: {len(df)}行（区切り行を含み、列数がずれた行は欠落）")
+
+
+if __name__ == "__main__":
+    main()
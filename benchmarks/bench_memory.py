@@ -0,0 +1,105 @@
+"""
+単体テスト生成1件あたりのピークメモリの計測（LLMはモックを使用）。
+
+参照用の設計書（項目定義書を模した合成データ）ごとに別プロセスで単体テスト生成を実行し、
+テンプレートの初回読み込み後の常駐メモリからの増加量（ピーク）を計測する。
+結果は、function_appのメモリ見積もり（MEMORY_BUDGET_MBの判定に使用）と並べて出力する。
+
+実行方法（プロジェクトルートで実行）:
+    python benchmarks/bench_memory.py --rows 1000,5000,20000 --sheets 3
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+
+
+def read_status(field: str) -> int:
+    # /proc/self/statusの値（キロバイト単位）をバイト数で返す
+    with open("/proc/self/status", encoding="utf-8") as status:
+        for line in status:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) * 1024
+    raise KeyError(field)
+
+
+def reset_peak() -> bool:
+    # VmHWM（ピーク常駐メモリ）をリセットする（Linux 4.0以降）
+    try:
+        with open("/proc/self/clear_refs", "w", encoding="utf-8") as clear_refs:
+            clear_refs.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def measure(rows: int, sheets: int) -> dict:
+    # 子プロセスで1件分を計測する
+    work_dir = tempfile.mkdtemp(prefix="testgen_bench_memory_")
+    os.environ["LLM_CACHE_DIR"] = os.path.join(work_dir, "llm_cache")
+    os.environ["RUN_STORE_DIR"] = os.path.join(work_dir, "runs")
+    os.environ["JOB_RESULT_DIR"] = os.path.join(work_dir, "jobs")
+    os.environ["MEMORY_BUDGET_MB"] = "0"
+    sys.path[:0] = [str(PROJECT_ROOT), str(PROJECT_ROOT / "benchmarks")]
+    import function_app
+    from bench_excel_io import build_design_book
+    from mock_llm import MockLLMSettings, install_mock_llm
+
+    install_mock_llm(function_app, MockLLMSettings(latency=0, tokens_per_second=1_000_000))
+    design_path = Path(work_dir) / "design.xlsx"
+    design_path.write_bytes(build_design_book(rows, sheets))
+
+    # テンプレートのキャッシュはワーカーごとに1回だけ作成されるため、計測の対象外にする
+    function_app.load_template_workbook()
+    baseline = read_status("VmRSS")
+    peak_reset = reset_peak()
+    with tempfile.TemporaryFile() as output:
+        function_app.run_unit_test_pipeline(design_path, "design.xlsx", output, use_cache=False)
+        output_size = output.tell()
+    peak = read_status("VmHWM") if peak_reset else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    return {
+        "rows": rows,
+        "sheets": sheets,
+        "fileMB": round(design_path.stat().st_size / 1024 / 1024, 2),
+        "estimateMB": round(function_app.estimate_pipeline_memory(design_path) / 1024 / 1024, 1),
+        "peakMB": round((peak - baseline) / 1024 / 1024, 1),
+        "outputMB": round(output_size / 1024 / 1024, 2),
+        "peakReset": peak_reset,
+    }
+
+
+def int_list(value: str) -> list[int]:
+    return [int(item) for item in value.split(",") if item]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int_list, default=[1000, 5000, 20000], help="設計書1シートあたりの行数（カンマ区切り）")
+    parser.add_argument("--sheets", type=int, default=3, help="設計書のシート数")
+    parser.add_argument("--child", nargs=2, type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(*args.child)))
+        return
+
+    print(f"{'行数':>8} {'シート':>6} {'設計書':>9} {'見積もり':>10} {'ピーク増加':>10}")
+    for rows in args.rows:
+        completed = subprocess.run(
+            [sys.executable, __file__, "--child", str(rows), str(args.sheets)],
+            capture_output=True, text=True, check=True,
+        )
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        note = "" if result["peakReset"] else "（プロセス全体の最大値）"
+        print(f"{rows:>8} {args.sheets:>6} {result['fileMB']:>7}MB {result['estimateMB']:>8}MB {result['peakMB']:>8}MB{note}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,359 @@
+"""
+LLMモックを使ったエンドツーエンドのベンチマーク（実際のLLMは呼び出さない）。
+
+合成したExcel設計書を`upload`（非同期ジョブ）へ送信し、以下をシナリオごとに出力する。
+- ジョブ全体・ステージごとの所要時間（p50 / p95 / 最大）
+- スループット（ジョブ/分）
+- ピークメモリ（--trace-memory指定時はPythonのメモリ割り当てのピーク、それ以外はプロセスの最大RSS）
+- LLMモックへの呼び出し回数・スロットリング回数・プロンプトキャッシュから読み込んだトークン数
+
+シナリオは「シート数 × 行数 × 同時ジョブ数」の組み合わせで、それぞれキャッシュなし（cold）と
+同じ設計書の再アップロード（warm: LLM応答キャッシュ・差分再生成が有効）を計測する。
+
+実行方法（プロジェクトルートで実行）:
+    python benchmarks/bench_pipeline.py --sheets 1,4 --rows 50,500 --concurrency 1,4
+    python benchmarks/bench_pipeline.py --integration --throttle-rate 0.1 --output result.json
+    python benchmarks/bench_pipeline.py --batch 8 --sheets 2 --rows 50 --concurrency 1
+    python benchmarks/bench_pipeline.py --sheets 4 --rows 50 --skew 8 --concurrency 1 --section-pipeline both
+    python benchmarks/bench_pipeline.py --sheets 2 --rows 50 --concurrency 1 --common-sheets 3 --dedup both
+    python benchmarks/bench_pipeline.py --sheets 2 --rows 100 --skew 30 --concurrency 1 --sheet-window both --structuring-max-rows 100000
+
+--batchを指定すると、同じ件数の設計書を1件ずつ順にアップロードした場合と、ZIPにまとめて1回でアップロードした場合を比較する。
+--section-pipeline bothを指定すると、セクション単位のパイプライン（SECTION_PIPELINE_ENABLED=true）と、
+ステージごとに全シートを待ち合わせる方式を比較する。--skewを指定すると先頭シートの行数をその倍数にする（シートの大きさの偏り）。
+--common-sheetsを指定すると、設計書に定型シート（改訂履歴・表紙）と、先頭シートと内容が同じシートを指定数追加する。
+--dedup bothを指定すると、重複・定型シートの検出を有効にした場合と無効にした場合を比較する。
+--sheet-window bothを指定すると、大きなシートをウィンドウに分割して構造化する場合と分割しない場合を比較する
+（LLMモックの構造化の応答は--structuring-max-rows行で打ち切られるため、比較には大きな値を指定する）。
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import azure.functions as func
+from openpyxl import Workbook, load_workbook
+
+# 実行履歴・キャッシュ・成果物はベンチマーク専用の一時ディレクトリに保存する
+work_dir = tempfile.mkdtemp(prefix="testgen_bench_")
+os.environ["LLM_CACHE_DIR"] = os.path.join(work_dir, "llm_cache")
+os.environ["RUN_STORE_DIR"] = os.path.join(work_dir, "runs")
+os.environ["JOB_RESULT_DIR"] = os.path.join(work_dir, "jobs")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import function_app  # noqa: E402
+from bench_excel_io import build_design_book  # noqa: E402
+import mock_llm  # noqa: E402
+from mock_llm import MockLLMSettings, install_mock_llm  # noqa: E402
+
+
+# --- リクエストの組み立て ---
+def build_multipart_request(fields: dict[str, str], files: list[tuple[str, str, bytes]]) -> func.HttpRequest:
+    boundary = uuid.uuid4().hex
+    body = io.BytesIO()
+    for name, value in fields.items():
+        body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode("utf-8"))
+    for name, filename, content in files:
+        body.write(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n'.encode("utf-8")
+        )
+        body.write(content + b"\r\n")
+    body.write(f"--{boundary}--\r\n".encode("utf-8"))
+    return func.HttpRequest(
+        method="POST",
+        url="http://localhost:7071/api/upload",
+        headers={"Content-Type": f"multipart/form-data; boundary={boundary}"},
+        body=body.getvalue(),
+    )
+
+
+def build_transition_book(screens: int) -> bytes:
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "画面一覧"
+    ws.append(["画面ID", "画面名", "遷移先"])
+    for i in range(screens):
+        ws.append([f"SCR{i:03d}", f"画面{i}", f"SCR{(i + 1) % screens:03d}"])
+    # 遷移元ごとに複数の遷移を持つ画面遷移表（遷移元のセルは先頭行のみ記載）
+    ws = wb.create_sheet("画面遷移")
+    ws.append(["遷移元", "遷移先", "トリガー", "遷移条件"])
+    for i in range(screens):
+        ws.append([f"SCR{i:03d}", f"SCR{(i + 1) % screens:03d}", "「次へ」ボタン", "入力チェックが正常な場合"])
+        ws.append([None, f"SCR{(i + 7) % screens:03d}", "「戻る」ボタン", None])
+    buffer = io.BytesIO()
+    wb.save(buffer)
+    return buffer.getvalue()
+
+
+def add_common_sheets(design_bytes: bytes, copies: int) -> bytes:
+    # 多くの設計書に含まれる改訂履歴・表紙と、共通部分として複製されたシート（先頭シートと同じ内容）を追加する
+    wb = load_workbook(io.BytesIO(design_bytes))
+    ws = wb.create_sheet("改訂履歴", 0)
+    ws.append(["版数", "改訂日", "改訂内容", "改訂者"])
+    for i in range(20):
+        ws.append([f"1.{i}", f"2024/01/{i + 1:02d}", f"項目定義の修正{i}", "山田"])
+    ws = wb.create_sheet("表紙", 0)
+    ws.append(["詳細設計書"])
+    ws.append(["システム名", "テスト管理システム"])
+    source = wb["画面定義1"]
+    for i in range(copies):
+        wb.copy_worksheet(source).title = f"共通項目{i + 1}"
+    buffer = io.BytesIO()
+    wb.save(buffer)
+    return buffer.getvalue()
+
+
+def build_batch_archive(files: int, rows: int, sheets: int) -> bytes:
+    buffer = io.BytesIO()
+    design_bytes = build_design_book(rows, sheets)
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        for i in range(files):
+            zip_file.writestr(f"設計書{i}.xlsx", design_bytes)
+    return buffer.getvalue()
+
+
+def build_structured_design(screens: int) -> bytes:
+    sections = [f"## 画面{i}\n\n画面ID: SCR{i:03d}\n\n| 項目 | 型 |\n|---|---|\n| 氏名 | 文字列 |\n" for i in range(screens)]
+    return "\n".join(sections).encode("utf-8")
+
+
+# --- ジョブの実行と計測 ---
+def run_job(request: func.HttpRequest, poll_interval: float) -> dict:
+    """
+    ジョブを登録して完了まで待ち、所要時間とステージごとの所要時間を返す。
+    """
+    started = time.time()
+    response = function_app.upload(request)
+    if response.status_code != 202:
+        return {"ok": False, "error": response.get_body().decode("utf-8"), "seconds": time.time() - started, "stages": {}}
+    job_id = json.loads(response.get_body())["jobId"]
+
+    status_request = func.HttpRequest(method="GET", url=f"http://localhost:7071/api/jobs/{job_id}", body=b"", route_params={"job_id": job_id})
+    while True:
+        status = json.loads(function_app.job_status(status_request).get_body())
+        if status["status"] in ("succeeded", "failed"):
+            break
+        time.sleep(poll_interval)
+    finished = status["updatedAt"]
+
+    ok = status["status"] == "succeeded" and function_app.job_result(status_request).status_code == 200
+    stages = {
+        item["name"]: (item["completedAt"] or finished) - item["startedAt"]
+        for item in status["stages"] if item["startedAt"] is not None
+    }
+    return {"ok": ok, "error": status["error"], "seconds": finished - started, "stages": stages}
+
+
+def percentile(values: list[float], q: float) -> float:
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[int(q) - 1]
+
+
+def summarize(name: str, results: list[dict], wall_seconds: float, peak_bytes: int, mock_stats: dict) -> dict:
+    latencies = [r["seconds"] for r in results if r["ok"]]
+    stage_names = list(dict.fromkeys(stage for r in results for stage in r["stages"]))
+    summary = {
+        "scenario": name,
+        "jobs": len(results),
+        "failed": sum(not r["ok"] for r in results),
+        "errors": sorted({r["error"] for r in results if r["error"]}),
+        "wallSeconds": round(wall_seconds, 2),
+        "jobsPerMinute": round(len(latencies) / wall_seconds * 60, 1) if wall_seconds else None,
+        "latency": {
+            "p50": round(percentile(latencies, 50), 2), "p95": round(percentile(latencies, 95), 2), "max": round(max(latencies), 2),
+        } if latencies else None,
+        "stages": {
+            stage: {"p50": round(percentile(values, 50), 2), "p95": round(percentile(values, 95), 2)}
+            for stage in stage_names
+            if (values := [r["stages"][stage] for r in results if stage in r["stages"]])
+        },
+        "peakMemoryMB": round(peak_bytes / 1024 / 1024, 1),
+        "llm": mock_stats,
+    }
+    return summary
+
+
+def run_scenario(name: str, build_request, concurrency: int, jobs: int, args, service: str) -> dict:
+    # 同時に実行するジョブ数に合わせてジョブ実行用のワーカーを作り直す
+    if function_app.job_executor is not None:
+        function_app.job_executor.shutdown(wait=True)
+    function_app.job_executor = None
+    function_app.job_max_concurrency = concurrency
+    # プロセス全体の同時送信数の上限も省略時の値（LLM_MAX_CONCURRENCY × JOB_MAX_CONCURRENCY）に合わせる
+    function_app.llm_process_max_concurrency = function_app.llm_max_concurrency * concurrency
+    function_app.llm_request_slots = threading.BoundedSemaphore(function_app.llm_process_max_concurrency)
+    mock_stats = install_mock_llm(function_app, MockLLMSettings(
+        latency=args.latency,
+        tokens_per_second=args.tokens_per_second,
+        throttle_rate=args.throttle_rate,
+        rows_per_section=args.cases_per_section,
+        seed=0,
+    ), service=service, endpoint_count=args.endpoints)
+
+    if args.trace_memory:
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda index: run_job(build_request(index), args.poll_interval), range(jobs)))
+    wall_seconds = time.time() - started
+    if args.trace_memory:
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    else:
+        peak_bytes = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # Linuxではキロバイト単位
+
+    return summarize(name, results, wall_seconds, peak_bytes, mock_stats.snapshot())
+
+
+def print_summary(summary: dict):
+    latency = summary["latency"] or {}
+    print(
+        f"{summary['scenario']:<42} jobs={summary['jobs']:<3} failed={summary['failed']:<2} "
+        f"p50={latency.get('p50', '-')}s p95={latency.get('p95', '-')}s max={latency.get('max', '-')}s "
+        f"throughput={summary['jobsPerMinute']}/min peak={summary['peakMemoryMB']}MB "
+        f"llm_calls={sum(summary['llm']['calls'].values())} throttles={summary['llm']['throttles']} "
+        f"input_tokens={summary['llm']['inputTokens']} prompt_cache_read={summary['llm']['cacheReadTokens']}"
+    )
+    for stage, values in summary["stages"].items():
+        print(f"    {stage:<24} p50={values['p50']}s p95={values['p95']}s")
+    for error in summary["errors"]:
+        print(f"    error: {error}")
+
+
+def int_list(value: str) -> list[int]:
+    return [int(item) for item in value.split(",") if item]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sheets", type=int_list, default=[1, 4], help="設計書のシート数（カンマ区切り）")
+    parser.add_argument("--rows", type=int_list, default=[50, 500], help="1シートあたりの行数（カンマ区切り）")
+    parser.add_argument("--concurrency", type=int_list, default=[1, 4], help="同時に実行するジョブ数（カンマ区切り）")
+    parser.add_argument("--jobs", type=int, default=0, help="1シナリオあたりのジョブ数（省略時: 同時実行数の2倍）")
+    parser.add_argument("--skew", type=int, default=1, help="先頭シートの行数を--rowsの何倍にするか（シートの大きさの偏り）")
+    parser.add_argument("--section-pipeline", choices=["on", "off", "both"], default="on", help="セクション単位のパイプラインを使用するか（bothの場合は両方を計測）")
+    parser.add_argument("--common-sheets", type=int, default=0, help="定型シート（改訂履歴・表紙）と、先頭シートと内容が同じシートを指定数追加する")
+    parser.add_argument("--dedup", choices=["on", "off", "both"], default="on", help="重複・定型シートの検出を使用するか（bothの場合は両方を計測）")
+    parser.add_argument("--sheet-window", choices=["on", "off", "both"], default="on", help="大きなシートをウィンドウに分割して構造化するか（bothの場合は両方を計測）")
+    parser.add_argument("--structuring-max-rows", type=int, default=mock_llm.STRUCTURING_MAX_ROWS, help="LLMモックの構造化の応答に含める表の最大行数")
+    parser.add_argument("--integration", action="store_true", help="結合テスト生成も計測する")
+    parser.add_argument("--transition-factor", type=int, default=5, help="結合テストの画面遷移図の画面数（構造化詳細設計書の対象画面数に対する倍率）")
+    parser.add_argument("--batch", type=int, default=0, help="指定件数の設計書を、1件ずつ順に処理する場合とZIPで一括処理する場合を比較する")
+    parser.add_argument("--service", choices=["AWS", "AZURE"], default="AWS", help="モックするLLMサービス")
+    parser.add_argument("--endpoints", type=int, default=1, help="モックのエンドポイント数")
+    parser.add_argument("--latency", type=float, default=0.2, help="LLMモックの応答開始までの秒数")
+    parser.add_argument("--tokens-per-second", type=float, default=2000, help="LLMモックの出力速度")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="LLMモックがスロットリングを返す確率")
+    parser.add_argument("--cases-per-section", type=int, default=20, help="テスト仕様書1セクションあたりのテストケース数")
+    parser.add_argument("--poll-interval", type=float, default=0.05, help="ジョブ状態の確認間隔（秒）")
+    parser.add_argument("--trace-memory", action="store_true", help="tracemallocでシナリオごとのピークメモリを計測する（処理は遅くなる）")
+    parser.add_argument("--output", help="結果をJSONで保存するファイル")
+    parser.add_argument("--verbose", action="store_true", help="function_appのログを表示する")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR)
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.ERROR)
+    # テンプレートの初回読み込み（数秒）が最初のシナリオの所要時間に含まれないよう、先に読み込んでおく
+    function_app.load_template_workbook()
+
+    section_pipelines = {"on": [True], "off": [False], "both": [False, True]}[args.section_pipeline]
+    dedups = {"on": [True], "off": [False], "both": [False, True]}[args.dedup]
+    sheet_windows = {"on": [True], "off": [False], "both": [False, True]}[args.sheet_window]
+    default_signatures = function_app.get_sheet_signatures()
+    default_window_max_tokens = function_app.sheet_window_max_tokens
+    mock_llm.STRUCTURING_MAX_ROWS = args.structuring_max_rows
+    summaries = []
+    for sheets in args.sheets:
+        for rows in args.rows:
+            row_counts = [rows * args.skew] + [rows] * (sheets - 1)
+            design_bytes = build_design_book(rows, sheets, row_counts)
+            if args.common_sheets:
+                design_bytes = add_common_sheets(design_bytes, args.common_sheets)
+            for concurrency in args.concurrency:
+                jobs = args.jobs or concurrency * 2
+                for section_pipeline, dedup, sheet_window in [(s, d, w) for s in section_pipelines for d in dedups for w in sheet_windows]:
+                    function_app.section_pipeline_enabled = section_pipeline
+                    function_app.sheet_dedup_enabled = dedup
+                    function_app.sheet_signatures = default_signatures if dedup else []
+                    function_app.sheet_window_max_tokens = default_window_max_tokens if sheet_window else 0
+                    pipeline_name = ("section" if section_pipeline else "stage") + ("" if dedup else "_nodedup") + ("" if sheet_window else "_nowindow")
+                    for mode, use_cache in (("cold", "false"), ("warm", "true")):
+                        # coldはジョブごとにファイル名を変え、warmは同じファイル名で前回の実行結果を再利用させる
+                        def build_request(index: int, use_cache=use_cache, mode=mode, sheets=sheets, rows=rows, design_bytes=design_bytes, pipeline_name=pipeline_name):
+                            filename = f"設計書_{sheets}x{rows}_{pipeline_name}_{mode}_{index if mode == 'cold' else 0}.xlsx"
+                            return build_multipart_request(
+                                {"testType": "unit", "mode": "async", "useCache": use_cache},
+                                [("documentFile", filename, design_bytes)],
+                            )
+                        if mode == "warm":
+                            # 1回目の実行でキャッシュと実行履歴を作成しておく
+                            run_job(build_request(0), args.poll_interval)
+                        skew = f" skew={args.skew}" if args.skew > 1 else ""
+                        common = f" common={args.common_sheets}" if args.common_sheets else ""
+                        name = f"unit sheets={sheets} rows={rows}{skew}{common} {pipeline_name} c={concurrency} {mode}"
+                        summary = run_scenario(name, build_request, concurrency, jobs, args, args.service)
+                        print_summary(summary)
+                        summaries.append(summary)
+
+    if args.batch:
+        for sheets in args.sheets:
+            for rows in args.rows:
+                design_bytes = build_design_book(rows, sheets)
+                archive_bytes = build_batch_archive(args.batch, rows, sheets)
+                # ブラウザから1件ずつアップロードする場合（ジョブは順番に実行される）
+                def build_single_request(index: int, sheets=sheets, rows=rows, design_bytes=design_bytes):
+                    return build_multipart_request(
+                        {"testType": "unit", "mode": "async", "useCache": "false"},
+                        [("documentFile", f"設計書_{sheets}x{rows}_{index}.xlsx", design_bytes)],
+                    )
+                def build_batch_request(index: int, archive_bytes=archive_bytes):
+                    return build_multipart_request(
+                        {"testType": "unit", "mode": "async", "useCache": "false"},
+                        [("documentFile", "設計書一式.zip", archive_bytes)],
+                    )
+                for name, build_request, jobs in (("sequential", build_single_request, args.batch), ("batch", build_batch_request, 1)):
+                    summary = run_scenario(f"{name} files={args.batch} sheets={sheets} rows={rows}", build_request, 1, jobs, args, args.service)
+                    print_summary(summary)
+                    summaries.append(summary)
+
+    if args.integration:
+        for sheets in args.sheets:
+            # 画面遷移図はシステム全体（構造化詳細設計書の対象画面の--transition-factor倍）を模す
+            screens = sheets * 10
+            transition_bytes = build_transition_book(screens * args.transition_factor)
+            design_md = build_structured_design(screens)
+            for concurrency in args.concurrency:
+                def build_request(index: int):
+                    return build_multipart_request(
+                        {"testType": "integration", "mode": "async", "useCache": "false"},
+                        [("structuredDesignFiles", "構造化設計書.md", design_md), ("transitionDiagramFile", "画面一覧.xlsx", transition_bytes)],
+                    )
+                for transition_filter in (False, True):
+                    function_app.transition_filter_enabled = transition_filter
+                    name = f"integration screens={screens}/{screens * args.transition_factor} filter={'on' if transition_filter else 'off'} c={concurrency}"
+                    summary = run_scenario(name, build_request, concurrency, args.jobs or concurrency * 2, args, args.service)
+                    print_summary(summary)
+                    summaries.append(summary)
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(summaries, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"結果を{args.output}に保存しました。")
+
+
+if __name__ == "__main__":
+    main()
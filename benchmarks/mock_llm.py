@@ -0,0 +1,380 @@
+"""
+ベンチマーク用のLLMモック（AWS Bedrock / Azure OpenAIのクライアントの代替）。
+
+実際のLLMを呼び出さずに、以下を再現する。
+- 応答までの待ち時間（latency）と出力速度（tokens_per_second）
+- 一定の確率でのスロットリング（BedrockのThrottlingException、Azure OpenAIの429）
+- プロンプトキャッシュ（BedrockのcachePoint、Azure OpenAIの先頭一致による自動キャッシュ）
+- プロンプトの種類（構造化・テスト観点・テスト仕様書など）に応じた定型の応答
+
+使い方:
+    import function_app
+    from mock_llm import MockLLMSettings, install_mock_llm
+    install_mock_llm(function_app, MockLLMSettings(latency=0.2, tokens_per_second=2000))
+"""
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from types import SimpleNamespace
+
+import httpx
+import openai
+from botocore.exceptions import ClientError
+
+
+@dataclass
+class MockLLMSettings:
+    latency: float = 0.2             # 最初のトークンが返るまでの秒数
+    tokens_per_second: float = 2000  # 出力トークンの生成速度
+    prefill_tokens_per_second: float = 50000  # 入力トークンの処理速度（キャッシュから読み込んだ分は除く）
+    prompt_cache_min_tokens: int = 1024  # プロンプトキャッシュの対象になる先頭部分の最小トークン数
+    prompt_cache_ttl: float = 300    # プロンプトキャッシュの有効期間（秒）
+    throttle_rate: float = 0.0       # スロットリングを返す確率（0〜1）
+    retry_after: float = 1.0         # スロットリング時に返すRetry-After秒数
+    rows_per_section: int = 20       # テスト仕様書1セクションあたりのテストケース数
+    chunk_chars: int = 40            # ストリーミング応答の1チャンクあたりの文字数
+    responses: dict[str, str] = field(default_factory=dict)  # 種類ごとの固定応答（指定時は定型の応答より優先）
+    seed: int | None = None
+
+
+class MockStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.throttles = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cache_read_tokens = 0
+        self.cache_write_tokens = 0
+
+    def record(self, kind: str, usage: "MockUsage"):
+        with self.lock:
+            self.calls[kind] = self.calls.get(kind, 0) + 1
+            self.input_tokens += usage.input_tokens
+            self.output_tokens += usage.output_tokens
+            self.cache_read_tokens += usage.cache_read_tokens
+            self.cache_write_tokens += usage.cache_write_tokens
+
+    def record_throttle(self):
+        with self.lock:
+            self.throttles += 1
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                "calls": dict(self.calls),
+                "throttles": self.throttles,
+                "inputTokens": self.input_tokens,
+                "outputTokens": self.output_tokens,
+                "cacheReadTokens": self.cache_read_tokens,
+                "cacheWriteTokens": self.cache_write_tokens,
+            }
+
+
+def estimate_tokens(text: str) -> int:
+    # function_app.estimate_tokensと同じ概算（非ASCII文字は1文字1トークン、ASCII文字は4文字1トークン）
+    non_ascii = len(re.findall(r"[^\x00-\x7f]", text))
+    return non_ascii + (len(text) - non_ascii + 3) // 4
+
+
+# --- プロンプトの種類に応じた定型の応答 ---
+def detect_kind(system_prompt: str) -> str:
+    if "結合テスト仕様書" in system_prompt:
+        return "integration_spec"
+    if "テスト仕様書を作成" in system_prompt:
+        return "unit_spec"
+    if "テスト観点を抽出" in system_prompt:
+        return "perspectives"
+    if "画面関連情報" in system_prompt:
+        return "transition"
+    return "structuring"
+
+
+# 構造化の応答に含める表の最大行数（出力トークン数の上限を模す）
+STRUCTURING_MAX_ROWS = 200
+
+
+def render_structuring(user_prompt: str) -> str:
+    # 生データの各行（先頭の見出し行と、分割したシートの「前の部分の末尾」を除く）の先頭セルを項目名とした項目定義表を返す
+    data = user_prompt.split("--- Excelシート", 1)[-1]
+    lines = [line.strip() for line in data.splitlines()[1:] if "|" in line or "," in line or "\t" in line]
+    names = [re.split(r"\s*[|,\t]\s*", line)[0] for line in lines[1:]][:STRUCTURING_MAX_ROWS] or ["項目0"]
+    table = ["| 項目ID | 項目名 | 型 | 必須 | 備考 |", "|---|---|---|---|---|"]
+    table += [f"| ITEM-{name} | {name} | 文字列 | {'○' if i % 2 else ''} | 入力チェックあり |" for i, name in enumerate(names)]
+    return "### 項目定義\n\n" + "\n".join(table) + "\n\n### 処理概要\n\n- 入力内容を検証し、登録する。\n"
+
+
+def render_perspectives(user_prompt: str) -> str:
+    headings = re.findall(r"(?m)^## (.+)$", user_prompt)
+    headings = [h for h in headings if h.strip() != "目次"] or ["全体"]
+    return "\n\n".join(
+        f"## {heading}\n\n- **仕様概要**：{heading}の入力と登録\n- **業務ルール**：必須項目は省略不可\n"
+        f"- **テスト観点**：初期値、正常系、境界値、異常系"
+        for heading in headings
+    )
+
+
+def render_unit_spec(user_prompt: str, rows_per_section: int) -> str:
+    design = user_prompt.split("--- テスト観点 ---")[0]
+    headings = [h for h in re.findall(r"(?m)^\s*## (.+)$", design) if h.strip() != "目次"] or ["全体"]
+    lines = ["| No | 大区分 | 中区分 | テストケース | 期待結果 | トレース元 |", "|---|---|---|---|---|---|"]
+    no = 1
+    for heading in headings:
+        for i in range(rows_per_section):
+            major = heading if i == 0 else ""
+            minor = f"項目{i // 4}" if i % 4 == 0 else ""
+            lines.append(f"| {no} | {major} | {minor} | 項目{i // 4}に境界値{i % 4}を入力し登録を確認する | 入力値が保存されること | {heading} 項目{i // 4} |")
+            no += 1
+    return "\n".join(lines) + "\n"
+
+
+def render_transition(user_prompt: str) -> str:
+    ids = sorted(set(re.findall(r"SCR\d+", user_prompt)))[:100] or ["SCR001"]
+    table = ["| 画面ID | 画面名 | 遷移先 |", "|---|---|---|"]
+    table += [f"| {screen_id} | 画面{screen_id} | {ids[(i + 1) % len(ids)]} |" for i, screen_id in enumerate(ids)]
+    return "\n".join(table) + "\n"
+
+
+def render_integration_spec(user_prompt: str, rows: int) -> str:
+    ids = sorted(set(re.findall(r"SCR\d+", user_prompt)))[:20] or ["SCR001", "SCR002"]
+    lines = [
+        "| テストNo | 画面1 | 機能/操作/状況1 | 画面2 | 機能/操作/状況2 | 画面3 | 機能/操作/状況3 | 画面4 | 機能/操作/状況4 | 確認内容 |",
+        "|---|---|---|---|---|---|---|---|---|---|",
+    ]
+    for i in range(rows):
+        first, second = ids[i % len(ids)], ids[(i + 1) % len(ids)]
+        lines.append(f"| {i + 1} | {first} | ID=\"user{i}\"を入力し「次へ」ボタンをクリック | {second} | 「登録」ボタンをクリック |  |  |  |  | 登録されること |")
+    return "\n".join(lines) + "\n"
+
+
+class MockUsage:
+    """
+    呼び出し1回分のトークン数（input_tokensはプロンプトキャッシュの読み込み・書き込み分を除く）。
+    """
+
+    def __init__(self, input_tokens: int, output_tokens: int, cache_read_tokens: int = 0, cache_write_tokens: int = 0):
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+        self.cache_read_tokens = cache_read_tokens
+        self.cache_write_tokens = cache_write_tokens
+
+    def bedrock(self) -> dict:
+        return {
+            "inputTokens": self.input_tokens,
+            "outputTokens": self.output_tokens,
+            "totalTokens": self.input_tokens + self.cache_read_tokens + self.cache_write_tokens + self.output_tokens,
+            "cacheReadInputTokens": self.cache_read_tokens,
+            "cacheWriteInputTokens": self.cache_write_tokens,
+        }
+
+    def openai(self) -> SimpleNamespace:
+        # Azure OpenAIのprompt_tokensにはキャッシュから読み込んだトークンも含まれる
+        prompt_tokens = self.input_tokens + self.cache_read_tokens + self.cache_write_tokens
+        return SimpleNamespace(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=self.output_tokens,
+            total_tokens=prompt_tokens + self.output_tokens,
+            prompt_tokens_details=SimpleNamespace(cached_tokens=self.cache_read_tokens),
+        )
+
+
+class MockLLM:
+    """
+    プロンプトから応答を組み立て、設定に応じた待ち時間・スロットリング・プロンプトキャッシュを再現する共通部分。
+    """
+
+    def __init__(self, settings: MockLLMSettings, stats: MockStats):
+        self.settings = settings
+        self.stats = stats
+        self.random = random.Random(settings.seed)
+        self.random_lock = threading.Lock()
+        self.prompt_cache = {}  # 先頭部分のハッシュ → 有効期限
+        self.prompt_cache_lock = threading.Lock()
+
+    def should_throttle(self) -> bool:
+        with self.random_lock:
+            throttled = self.random.random() < self.settings.throttle_rate
+        if throttled:
+            self.stats.record_throttle()
+        return throttled
+
+    def use_prompt_cache(self, prefix: str | None) -> tuple[int, int]:
+        """
+        先頭部分のプロンプトキャッシュを参照し、(読み込みトークン数, 書き込みトークン数) を返す。
+        最小トークン数に満たない先頭部分はキャッシュしない。
+        """
+        tokens = estimate_tokens(prefix) if prefix else 0
+        if tokens < self.settings.prompt_cache_min_tokens:
+            return 0, 0
+        key = hash(prefix)
+        now = time.monotonic()
+        with self.prompt_cache_lock:
+            hit = self.prompt_cache.get(key, 0) > now
+            self.prompt_cache[key] = now + self.settings.prompt_cache_ttl
+        return (tokens, 0) if hit else (0, tokens)
+
+    def respond(self, system_prompt: str, user_prompt: str) -> tuple[str, str]:
+        kind = detect_kind(system_prompt)
+        # 設計書などはシステムプロンプトの先頭に置かれる場合もあるため、両方を入力として扱う
+        prompt = f"{system_prompt}\n{user_prompt}"
+        if kind in self.settings.responses:
+            text = self.settings.responses[kind]
+        elif kind == "structuring":
+            text = render_structuring(user_prompt)
+        elif kind == "perspectives":
+            text = render_perspectives(prompt)
+        elif kind == "unit_spec":
+            text = render_unit_spec(prompt, self.settings.rows_per_section)
+        elif kind == "transition":
+            text = render_transition(user_prompt)
+        else:
+            text = render_integration_spec(prompt, self.settings.rows_per_section)
+        return kind, text
+
+    def prepare(self, system_prompt: str, user_prompt: str, cached_prefix: str | None) -> tuple[str, str, MockUsage]:
+        kind, text = self.respond(system_prompt, user_prompt)
+        cache_read, cache_write = self.use_prompt_cache(cached_prefix)
+        input_tokens = estimate_tokens(system_prompt + user_prompt) - cache_read - cache_write
+        usage = MockUsage(input_tokens, estimate_tokens(text), cache_read, cache_write)
+        # キャッシュから読み込んだ部分を除く入力の処理時間を、最初のトークンまでの待ち時間に加える
+        time.sleep(self.settings.latency + (input_tokens + cache_write) / self.settings.prefill_tokens_per_second)
+        return kind, text, usage
+
+    def generate(self, system_prompt: str, user_prompt: str, cached_prefix: str | None = None) -> tuple[str, MockUsage]:
+        kind, text, usage = self.prepare(system_prompt, user_prompt, cached_prefix)
+        time.sleep(usage.output_tokens / self.settings.tokens_per_second)
+        self.stats.record(kind, usage)
+        return text, usage
+
+    def generate_stream(self, system_prompt: str, user_prompt: str, cached_prefix: str | None = None, usage_holder: list | None = None):
+        # 最初のチャンクまでlatency秒、以降はtokens_per_secondの速度でチャンクを返す
+        kind, text, usage = self.prepare(system_prompt, user_prompt, cached_prefix)
+        size = self.settings.chunk_chars
+        for position in range(0, len(text), size):
+            chunk = text[position:position + size]
+            time.sleep(estimate_tokens(chunk) / self.settings.tokens_per_second)
+            yield chunk
+        self.stats.record(kind, usage)
+        if usage_holder is not None:
+            usage_holder.append(usage)
+
+
+# --- AWS Bedrock（bedrock-runtime）のクライアントの代替 ---
+class MockBedrockClient:
+    def __init__(self, llm: MockLLM):
+        self.llm = llm
+
+    def throttle(self, operation: str):
+        raise ClientError(
+            {
+                "Error": {"Code": "ThrottlingException", "Message": "Too many requests, please wait before trying again."},
+                "ResponseMetadata": {"HTTPStatusCode": 429, "HTTPHeaders": {"retry-after": str(self.llm.settings.retry_after)}},
+            },
+            operation,
+        )
+
+    @staticmethod
+    def prompts(messages: list, system: list) -> tuple[str, str, str | None]:
+        # cachePointより前のシステムプロンプトをキャッシュ対象の先頭部分として扱う
+        texts = [block["text"] for block in system if "text" in block]
+        cache_index = next((i for i, block in enumerate(system) if "cachePoint" in block), None)
+        cached_prefix = "".join(block["text"] for block in system[:cache_index] if "text" in block) if cache_index is not None else None
+        return "\n".join(texts), messages[-1]["content"][0]["text"], cached_prefix
+
+    def converse(self, modelId: str, messages: list, system: list, inferenceConfig: dict | None = None, **kwargs) -> dict:
+        if self.llm.should_throttle():
+            self.throttle("Converse")
+        text, usage = self.llm.generate(*self.prompts(messages, system))
+        return {
+            "output": {"message": {"role": "assistant", "content": [{"text": text}]}},
+            "stopReason": "end_turn",
+            "usage": usage.bedrock(),
+        }
+
+    def converse_stream(self, modelId: str, messages: list, system: list, inferenceConfig: dict | None = None, **kwargs) -> dict:
+        if self.llm.should_throttle():
+            self.throttle("ConverseStream")
+        system_prompt, user_prompt, cached_prefix = self.prompts(messages, system)
+
+        def events():
+            yield {"messageStart": {"role": "assistant"}}
+            usage_holder = []
+            for chunk in self.llm.generate_stream(system_prompt, user_prompt, cached_prefix, usage_holder):
+                yield {"contentBlockDelta": {"contentBlockIndex": 0, "delta": {"text": chunk}}}
+            yield {"contentBlockStop": {"contentBlockIndex": 0}}
+            yield {"messageStop": {"stopReason": "end_turn"}}
+            yield {"metadata": {"usage": usage_holder[0].bedrock()}}
+
+        return {"stream": events()}
+
+
+# --- Azure OpenAI（AzureOpenAI）のクライアントの代替 ---
+class MockAzureCompletions:
+    def __init__(self, llm: MockLLM):
+        self.llm = llm
+
+    def create(self, model: str, messages: list, stream: bool = False, stream_options: dict | None = None, **kwargs):
+        if self.llm.should_throttle():
+            response = httpx.Response(
+                429,
+                request=httpx.Request("POST", "https://mock.openai.azure.com/openai/deployments/mock/chat/completions"),
+                headers={"retry-after": str(self.llm.settings.retry_after)},
+            )
+            raise openai.RateLimitError("Requests to the ChatCompletions_Create Operation have exceeded rate limit.", response=response, body=None)
+
+        # 自動プロンプトキャッシュは先頭が一致する部分に適用されるため、最初のメッセージを先頭部分として扱う
+        system_messages = [m["content"] for m in messages if m["role"] == "system"]
+        system_prompt = "\n".join(system_messages)
+        user_prompt = next(m["content"] for m in messages if m["role"] == "user")
+        cached_prefix = system_messages[0] if len(system_messages) > 1 else None
+        if not stream:
+            text, usage = self.llm.generate(system_prompt, user_prompt, cached_prefix)
+            return SimpleNamespace(
+                choices=[SimpleNamespace(message=SimpleNamespace(role="assistant", content=text), finish_reason="stop")],
+                usage=usage.openai(),
+            )
+
+        def chunks():
+            usage_holder = []
+            for chunk in self.llm.generate_stream(system_prompt, user_prompt, cached_prefix, usage_holder):
+                yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=chunk), finish_reason=None)], usage=None)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=None), finish_reason="stop")], usage=None)
+            if stream_options and stream_options.get("include_usage"):
+                # include_usage指定時は、最後にchoicesが空でusageを持つチャンクが返る
+                yield SimpleNamespace(choices=[], usage=usage_holder[0].openai())
+
+        return chunks()
+
+
+class MockAzureClient:
+    def __init__(self, llm: MockLLM):
+        self.chat = SimpleNamespace(completions=MockAzureCompletions(llm))
+
+
+def install_mock_llm(function_app, settings: MockLLMSettings, service: str = "AWS", endpoint_count: int = 1) -> MockStats:
+    """
+    function_appのLLMエンドポイントのプールを、モックのクライアントを持つエンドポイントに置き換える。
+    戻り値: モックへの呼び出し回数・トークン数の統計
+    """
+    stats = MockStats()
+    llm = MockLLM(settings, stats)
+    endpoints = []
+    for index in range(endpoint_count):
+        endpoint = function_app.LLMEndpoint(
+            name=f"mock-{service.lower()}-{index + 1}",
+            service=service,
+            model_id="mock-model",
+            region="mock-region",
+            access_key_id="mock",
+            secret_access_key="mock",
+            endpoint="https://mock.openai.azure.com",
+            api_key="mock",
+            api_version="mock",
+        )
+        endpoint.client = MockBedrockClient(llm) if service == "AWS" else MockAzureClient(llm)
+        endpoints.append(endpoint)
+    with function_app.llm_endpoints_lock:
+        function_app.llm_endpoints = endpoints
+    return stats
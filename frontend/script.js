@@ -3,6 +3,8 @@ const uploadBtn = document.querySelector("#uploadBtn");
 const testTypeRadios = document.querySelectorAll('input[name="testType"]');
 const unitTestInputs = document.querySelector("#unitTestInputs");
 const integrationTestInputs = document.querySelector("#integrationTestInputs");
+const useCacheCheckbox = document.querySelector("#useCacheCheckbox");
+const asyncModeCheckbox = document.querySelector("#asyncModeCheckbox");
 
 // ラジオボタンの切り替え処理
 testTypeRadios.forEach(radio => {
@@ -21,6 +23,7 @@ uploadBtn.addEventListener("click", async () => {
     const testType = document.querySelector('input[name="testType"]:checked').value;
     const formData = new FormData();
     formData.append("testType", testType);
+    formData.append("useCache", useCacheCheckbox.checked ? "true" : "false");
 
     if (testType === 'unit') {
         const file = document.querySelector("#unitFileInput").files[0];
@@ -44,32 +47,57 @@ uploadBtn.addEventListener("click", async () => {
         formData.append("transitionDiagramFile", transitionDiagram);
     }
 
+    // 非同期ジョブの状態は処理したインスタンスのメモリ上にのみ保持されるため、
+    // 複数インスタンスへスケールアウトする環境では既定の同期実行を使用する
+    const useAsync = asyncModeCheckbox.checked;
+    if (useAsync) {
+        formData.append("mode", "async");
+    }
+
     uploadBtn.disabled = true;
     status.textContent = "生成中...";
 
     // ==== ローカル開発用 ====
-    // const endpoint = "http://localhost:7071/api/upload";
+    // const apiBase = "http://localhost:7071/api";
 
     // ==== 本番環境用 ====
-    const endpoint = "https://poc-func.azurewebsites.net/api/upload";
+    const apiBase = "https://poc-func.azurewebsites.net/api";
 
     try {
-        const res = await fetch(endpoint, {
+        // 同期実行では生成結果が、非同期ジョブではジョブIDが返却される
+        const res = await fetch(`${apiBase}/upload`, {
             method: "POST",
             body: formData,
         });
 
-        console.log(res)
-
         if (!res.ok) {
             status.textContent = `エラー: ${res.status}`;
             uploadBtn.disabled = false;
             return;
         }
 
+        let resultRes = res;
+        if (useAsync) {
+            const job = await res.json();
+
+            // ジョブの完了をポーリングで待つ
+            const jobStatus = await waitForJob(`${apiBase}/${job.statusUrl}`);
+            if (jobStatus.status === "failed") {
+                status.textContent = `エラー: ${jobStatus.error}`;
+                return;
+            }
+
+            resultRes = await fetch(`${apiBase}/${job.resultUrl}`);
+            if (!resultRes.ok) {
+                status.textContent = `エラー: ${resultRes.status}`;
+                return;
+            }
+        }
+
         // ファイルダウンロード処理
-        const blob = await res.blob();
-        const contentDisposition = res.headers.get('content-disposition');
+
+        const blob = await resultRes.blob();
+        const contentDisposition = resultRes.headers.get('content-disposition');
         let filename = 'generated_files.zip'; // fallback filename
         if (contentDisposition) {
             const filenameMatch = contentDisposition.match(/filename\*=UTF-8''(.+)/);
@@ -98,3 +126,29 @@ uploadBtn.addEventListener("click", async () => {
         uploadBtn.disabled = false;
     }
 });
+
+// ジョブが完了（成功または失敗）するまで状態を取得し、進捗を表示する
+async function waitForJob(statusUrl) {
+    while (true) {
+        const res = await fetch(statusUrl);
+        if (!res.ok) {
+            throw new Error(`ジョブ状態の取得に失敗しました (${res.status})`);
+        }
+
+        const jobStatus = await res.json();
+        if (jobStatus.status === "succeeded" || jobStatus.status === "failed") {
+            return jobStatus;
+        }
+
+        const runningStage = jobStatus.stages.find(stage => stage.status === "running");
+        const completedCount = jobStatus.stages.filter(stage => stage.status === "completed").length;
+        if (runningStage) {
+            const detail = runningStage.detail ? ` ${runningStage.detail}` : "";
+            status.textContent = `生成中...（${runningStage.label}: ${completedCount + 1}/${jobStatus.stages.length}）${detail}`;
+        } else {
+            status.textContent = "生成待ち...";
+        }
+
+        await new Promise(resolve => setTimeout(resolve, 3000));
+    }
+}
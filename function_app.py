@@ -1,19 +1,40 @@
 import azure.functions as func
 import logging
 import io
-import pandas as pd
-from openpyxl import load_workbook
 import re
+import sys
 import zipfile
-from openai import AzureOpenAI
 from urllib.parse import quote
 from pathlib import Path
 import os
 from dotenv import load_dotenv
-import boto3
-from botocore.config import Config
 import json
 import time
+import threading
+import hashlib
+import unicodedata
+import uuid
+import random
+import tempfile
+import pickle
+import shutil
+import importlib.util
+import contextvars
+from contextlib import contextmanager
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import IO, TYPE_CHECKING, Iterator, TypedDict
+
+# pandas・openpyxl・LLMサービスのSDK（openai、boto3）は読み込みに時間がかかるため、使用する関数の中で読み込む
+# （ワーカーのコールドスタートを短縮し、LLMサービスは選択したもののSDKのみを読み込む）
+if TYPE_CHECKING:
+    import pandas as pd
+
+# OpenTelemetryはインストールされている場合のみ使用する（スパン・メトリクスの送信）
+try:
+    from opentelemetry import trace as otel_trace, metrics as otel_metrics
+except ImportError:
+    otel_trace = otel_metrics = None
 
 # .envファイルから環境変数を読み込む
 load_dotenv()
@@ -21,6 +42,22 @@ load_dotenv()
 # FunctionAppの初期化
 app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
 
+# --- 環境変数の読み込み ---
+# .env.exampleをコピーした.envには値が空のキー（KEY=）が含まれるため、空文字は未設定として扱い既定値を使用する
+def get_env(name: str, default: str | None = None) -> str | None:
+    value = os.getenv(name, "").strip()
+    return value if value else default
+
+def get_env_int(name: str, default: int) -> int:
+    return int(get_env(name) or default)
+
+def get_env_float(name: str, default: float) -> float:
+    return float(get_env(name) or default)
+
+def get_env_bool(name: str, default: bool) -> bool:
+    value = get_env(name)
+    return default if value is None else value.lower() == "true"
+
 # --- LLMサービス設定 ---
 llm_service = os.getenv("LLM_SERVICE", "AWS")
 
@@ -36,116 +73,1156 @@ aws_access_key_id = os.getenv("AWS_ACCESS_KEY_ID")
 aws_secret_access_key = os.getenv("AWS_SECRET_ACCESS_KEY")
 aws_bedrock_model_id = os.getenv("AWS_BEDROCK_MODEL_ID")
 
-# LLMクライアントの初期化用変数
-azure_client = None
-bedrock_client = None
-
-# 必須環境変数のチェック関数
-def validate_env():
-    if llm_service == "AZURE":
-        # Azure OpenAIに必要な環境変数がすべて設定されているか確認
-        required = [azure_api_key, azure_endpoint, azure_api_version, azure_deployment]
-        if not all(required):
-            raise ValueError("Azure OpenAI の必須環境変数が設定されていません。")
-    elif llm_service == "AWS":
-        # AWS Bedrockに必要な環境変数がすべて設定されているか確認
-        required = [aws_region, aws_access_key_id, aws_secret_access_key, aws_bedrock_model_id]
-        if not all(required):
-            raise ValueError("AWS Bedrock の必須環境変数が設定されていません。")
-    else:
-        # サポートされていないLLMサービスが指定された場合のエラー
-        raise ValueError(f"無効なLLMサービスが指定されました: {llm_service}")
-
-# LLMクライアントの初期化関数
-def initialize_client():
-    global azure_client, bedrock_client
-    validate_env()  # 環境変数の妥当性をチェック
-
-    if llm_service == "AZURE":
-        # Azure OpenAIクライアントの初期化
-        azure_client = AzureOpenAI(
-            api_version=azure_api_version,
-            azure_endpoint=azure_endpoint,
-            api_key=azure_api_key,
+# --- レート制限設定（1分あたりの上限、0または未設定の場合は制限なし） ---
+azure_rpm_limit = get_env_int("AZURE_OPENAI_RPM_LIMIT", 0)
+azure_tpm_limit = get_env_int("AZURE_OPENAI_TPM_LIMIT", 0)
+aws_rpm_limit = get_env_int("AWS_BEDROCK_RPM_LIMIT", 0)
+aws_tpm_limit = get_env_int("AWS_BEDROCK_TPM_LIMIT", 0)
+# 連続エラーが何回続いたら呼び出しを遮断するか、および遮断する秒数
+llm_circuit_failure_threshold = max(1, get_env_int("LLM_CIRCUIT_FAILURE_THRESHOLD", 8))
+llm_circuit_cooldown_seconds = get_env_float("LLM_CIRCUIT_COOLDOWN_SECONDS", 60)
+
+# --- マルチエンドポイント設定 ---
+# 複数のBedrockリージョン/Azure OpenAIデプロイを使う場合のエンドポイント定義（JSON配列）
+# 未設定の場合は LLM_SERVICE で選択したサービスの接続情報のみを使用する
+llm_endpoints_config = os.getenv("LLM_ENDPOINTS")
+# 応答がこの秒数を超えた場合に別のエンドポイントへ同じリクエストを送信する（0の場合は無効）
+llm_hedge_after_seconds = get_env_float("LLM_HEDGE_AFTER_SECONDS", 0)
+
+# --- 計測設定 ---
+# LLMの推定コストの計算に使う単価（USD / 100万トークン、エンドポイントごとにLLM_ENDPOINTSで上書き可能）
+llm_input_token_price = get_env_float("LLM_INPUT_TOKEN_PRICE", 0)
+llm_output_token_price = get_env_float("LLM_OUTPUT_TOKEN_PRICE", 0)
+# プロンプトキャッシュの読み込み・書き込みの単価（省略時は入力トークンの単価）
+llm_cache_read_token_price = get_env_float("LLM_CACHE_READ_TOKEN_PRICE", llm_input_token_price)
+llm_cache_write_token_price = get_env_float("LLM_CACHE_WRITE_TOKEN_PRICE", llm_input_token_price)
+# スパン・メトリクスをAzure Monitor（Application Insights）へ送信するか
+telemetry_enabled = get_env_bool("TELEMETRY_ENABLED", False)
+
+# --- プロンプトキャッシュ設定 ---
+# 複数の呼び出しで共通の先頭部分（設計書など）を、プロバイダ側のプロンプトキャッシュで再利用する
+# （BedrockはcachePointを付与、Azure OpenAIは先頭部分を揃えて自動キャッシュの対象にする）
+prompt_caching_enabled = get_env_bool("PROMPT_CACHING_ENABLED", True)
+
+# --- 並列実行設定 ---
+# 1件の設計書のシート単位のLLM呼び出しを同時に実行する最大数
+llm_max_concurrency = max(1, get_env_int("LLM_MAX_CONCURRENCY", 4))
+
+# テスト仕様書を設計書のセクション（シート）単位に分割して並列生成するか
+spec_sharding_enabled = get_env_bool("SPEC_SHARDING_ENABLED", True)
+
+# セクション（シート）ごとに構造化 → テスト観点抽出 → テスト仕様書生成を続けて実行するか
+# （falseの場合は全シートの構造化、設計書全体のテスト観点抽出、テスト仕様書生成の順にステージごとに待ち合わせる）
+section_pipeline_enabled = get_env_bool("SECTION_PIPELINE_ENABLED", True)
+
+# --- 実行履歴（差分再生成）設定 ---
+# 実行ごとのシート指紋・構造化結果・テストケースを保存するディレクトリ
+run_store_dir = os.getenv("RUN_STORE_DIR") or os.path.join(tempfile.gettempdir(), "testgen_runs")
+# 処理の途中経過（構造化・テスト観点・テストケースの完了分）をチェックポイントとして保存するか
+# （失敗した実行を再実行すると、完了した処理を再利用して続きから再開する）
+checkpoint_enabled = get_env_bool("CHECKPOINT_ENABLED", True)
+
+# --- 生成結果の検証・修復設定 ---
+# テスト観点・テスト仕様書の形式が不正な場合に、LLMへ修復を依頼する最大回数（0の場合は修復しない）
+llm_repair_max_attempts = max(0, get_env_int("LLM_REPAIR_MAX_ATTEMPTS", 2))
+
+# --- シートのテキスト化設定 ---
+# LLMへ渡すシートの形式（"pipe": セルを " | " で区切る、"csv"、"tsv"）
+sheet_text_format = get_env("SHEET_TEXT_FORMAT", "pipe").lower()
+
+# --- 大きなシートの分割設定 ---
+# 推定トークン数がこの値を超えるシートは、行単位のウィンドウに分割して並列に構造化する（0の場合は分割しない）
+sheet_window_max_tokens = get_env_int("SHEET_WINDOW_MAX_TOKENS", 8000)
+# 各ウィンドウの先頭に繰り返すシート先頭の行数（表の見出し行）
+sheet_window_header_rows = get_env_int("SHEET_WINDOW_HEADER_ROWS", 1)
+# 前のウィンドウの末尾から、文脈として各ウィンドウに含める行数
+sheet_window_overlap_rows = get_env_int("SHEET_WINDOW_OVERLAP_ROWS", 3)
+
+# --- 重複・定型シート設定 ---
+# 内容が同じシート（正規化したテキストが一致するシート）の構造化結果を、同じ設計書内・設計書間で再利用するか
+sheet_dedup_enabled = get_env_bool("SHEET_DEDUP_ENABLED", True)
+# 定型シート（改訂履歴・表紙など）の定義（JSON配列）。一致したシートはLLMで構造化せず、テストケースも生成しない
+# 未設定の場合は既定の定義（DEFAULT_SHEET_SIGNATURES）を使用し、"[]"の場合は定型シートを判定しない
+sheet_signatures_config = os.getenv("SHEET_SIGNATURES")
+
+# --- Excel入出力設定 ---
+# アップロードされたExcelの読み込みエンジン（"calamine": 高速な読み取り専用エンジン、"openpyxl"）
+excel_read_engine = get_env("EXCEL_READ_ENGINE", "calamine").lower()
+# テスト仕様書の書き込み先テンプレート
+unit_test_template_path = "単体テスト仕様書.xlsx"
+
+# --- LLM応答キャッシュ設定 ---
+# 同一の設計書を再アップロードした場合などに、同じプロンプトへのLLM呼び出しを省略する
+llm_cache_enabled = get_env_bool("LLM_CACHE_ENABLED", True)
+llm_cache_max_entries = max(0, get_env_int("LLM_CACHE_MAX_ENTRIES", 256))
+llm_cache_dir = os.getenv("LLM_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "testgen_llm_cache")
+llm_cache_max_bytes = max(0, get_env_int("LLM_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+
+# --- 非同期ジョブ設定 ---
+# バックグラウンドで同時に実行するジョブ数
+job_max_concurrency = max(1, get_env_int("JOB_MAX_CONCURRENCY", 2))
+# 完了したジョブの状態と成果物を保持する秒数
+job_retention_seconds = get_env_int("JOB_RETENTION_SECONDS", 3600)
+# ジョブの成果物（ZIP）を保存するディレクトリ
+job_result_dir = os.getenv("JOB_RESULT_DIR") or os.path.join(tempfile.gettempdir(), "testgen_jobs")
+
+# --- LLM同時送信数設定（プロセス全体） ---
+# 同時に処理するリクエスト・ジョブ・ヘッジリクエストを合わせて、LLMへ同時に送信するリクエストの最大数
+# （HTTP接続プールのサイズもこれに合わせる。省略時は非同期ジョブを上限まで同時に実行できる数）
+llm_process_max_concurrency = max(1, get_env_int("LLM_PROCESS_MAX_CONCURRENCY", llm_max_concurrency * job_max_concurrency))
+
+# --- ウォームアップ設定 ---
+# ワーカーの起動時に、バックグラウンドでライブラリ・LLMクライアント・テンプレートExcelを読み込んでおくか
+warmup_enabled = get_env_bool("WARMUP_ENABLED", False)
+
+# --- メモリ設定 ---
+# 同時に実行する単体テスト生成全体で使用するメモリの上限（MB、見積もり値、0の場合は制限なし）
+memory_budget_mb = max(0, get_env_int("MEMORY_BUDGET_MB", 1024))
+# 同期実行で返却するZIPをメモリ上に保持する上限（MB、超える分は一時ファイルに書き出す）
+artifact_spool_mb = max(0, get_env_int("ARTIFACT_SPOOL_MB", 16))
+
+# --- 結合テスト設定 ---
+# 構造化詳細設計書に記載された画面（画面ID・画面名）を含まない画面遷移データを、LLMへ渡す前に除外するか
+transition_filter_enabled = get_env_bool("TRANSITION_FILTER_ENABLED", True)
+
+# --- バッチ処理設定（ZIPにまとめた複数の設計書の一括生成） ---
+# 1つのZIPに含められる設計書の最大数
+batch_max_files = max(1, get_env_int("BATCH_MAX_FILES", 50))
+# 展開後の設計書の合計サイズの上限（バイト）
+batch_max_total_bytes = max(1, get_env_int("BATCH_MAX_TOTAL_BYTES", 200 * 1024 * 1024))
+# 同時に処理する設計書の数（LLM呼び出しの同時実行数はLLM_MAX_CONCURRENCYで全設計書共通）
+batch_file_concurrency = max(1, get_env_int("BATCH_FILE_CONCURRENCY", 4))
+
+# LLMエンドポイントのプール（初回呼び出し時に生成）
+llm_endpoints = None
+# 並列実行時にプールが重複して生成されないようにするためのロック
+llm_endpoints_lock = threading.Lock()
+# プロセス全体でLLMへ同時に送信中のリクエスト数の上限（接続プールのサイズを超えないようにする）
+llm_request_slots = threading.BoundedSemaphore(llm_process_max_concurrency)
+# ヘッジリクエスト用のワーカーと送信回数
+hedge_executor = None
+hedge_stats = {"hedged": 0, "hedge_wins": 0}
+
+# LLM応答キャッシュ（メモリ上はLRU、ディスク上はサイズ上限付きで保持）
+llm_cache = OrderedDict()
+llm_cache_lock = threading.Lock()
+llm_cache_stats = {"hits": 0, "misses": 0}
+
+# 非同期ジョブの状態（ジョブID → 状態）と実行用ワーカー
+jobs = {}
+jobs_lock = threading.Lock()
+job_executor = None
+
+# 定型シートの定義（初回使用時に読み込む）
+sheet_signatures = None
+
+# テスト仕様書テンプレートの読み込み結果（ワーカーごとに1回だけ読み込み、リクエストごとに複製する）
+template_workbook_bytes = None
+template_workbook_lock = threading.Lock()
+
+# --- 計測（ステージごとの所要時間・トークン使用量・リトライ回数・推定コスト） ---
+# 実行中のスパン（LLM呼び出しのトークン使用量はこのスパンと上位のスパンに加算する）
+current_span = contextvars.ContextVar("current_span", default=None)
+
+# OpenTelemetryのトレーサーとメトリクス（未インストールの場合はNone）
+if telemetry_enabled and os.getenv("APPLICATIONINSIGHTS_CONNECTION_STRING"):
+    try:
+        from azure.monitor.opentelemetry import configure_azure_monitor
+        configure_azure_monitor()
+    except ImportError:
+        logging.warning("azure-monitor-opentelemetryがインストールされていないため、Azure Monitorへの送信は行いません。")
+otel_tracer = otel_trace.get_tracer("testgen") if otel_trace else None
+otel_meter = otel_metrics.get_meter("testgen") if otel_metrics else None
+otel_token_counter = otel_meter.create_counter("testgen.llm.tokens", unit="{token}", description="LLMのトークン使用量") if otel_meter else None
+otel_stage_duration = otel_meter.create_histogram("testgen.stage.duration", unit="s", description="ステージの所要時間") if otel_meter else None
+
+class MetricsSpan:
+    """
+    計測区間1件。所要時間と、区間内（下位の区間を含む）のLLM呼び出し回数・トークン数・リトライ回数・推定コストを保持する。
+    """
+
+    def __init__(self, metrics: "PipelineMetrics", name: str, parent: "MetricsSpan | None" = None, attributes: dict | None = None):
+        self.metrics = metrics
+        self.name = name
+        self.parent = parent
+        self.attributes = attributes or {}
+        self.started_at = time.time()
+        self.started = time.monotonic()
+        self.duration = None
+        self.counts = {
+            "llmCalls": 0, "cacheHits": 0, "inputTokens": 0, "outputTokens": 0,
+            "promptCacheReadTokens": 0, "promptCacheWriteTokens": 0, "retries": 0, "throttles": 0,
+        }
+        self.cost = 0.0
+        self.otel_span = None
+        if otel_tracer:
+            context = otel_trace.set_span_in_context(parent.otel_span) if parent and parent.otel_span else None
+            self.otel_span = otel_tracer.start_span(name, context=context, attributes=self.attributes)
+
+    def end(self):
+        if self.duration is not None:
+            return
+        self.duration = time.monotonic() - self.started
+        if self.otel_span:
+            for key, value in self.counts.items():
+                self.otel_span.set_attribute(f"testgen.{key}", value)
+            self.otel_span.set_attribute("testgen.costUsd", self.cost)
+            self.otel_span.end()
+        if otel_stage_duration and self.parent is not None and self.parent.parent is None:
+            otel_stage_duration.record(self.duration, {"pipeline": self.metrics.name, "stage": self.name})
+
+    def to_dict(self) -> dict:
+        duration = self.duration if self.duration is not None else time.monotonic() - self.started
+        return {
+            "name": self.name,
+            "parent": self.parent.name if self.parent else None,
+            "attributes": self.attributes,
+            "startedAt": self.started_at,
+            "durationSeconds": round(duration, 3),
+            **self.counts,
+            "costUsd": round(self.cost, 6),
+        }
+
+class PipelineMetrics:
+    """
+    パイプライン1回分の計測結果。ステージ（構造化・テスト観点など）と、その中の区間（シートごとの構造化など）をスパンとして記録する。
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.lock = threading.Lock()
+        self.root = MetricsSpan(self, name)
+        self.spans = [self.root]
+        self.stage = None
+        current_span.set(self.root)
+
+    def start_stage(self, name: str):
+        # 実行中のステージを終了し、次のステージを開始する
+        if self.stage:
+            self.stage.end()
+        self.stage = MetricsSpan(self, name, self.root)
+        with self.lock:
+            self.spans.append(self.stage)
+        current_span.set(self.stage)
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        # 実行中のスパンの下位に区間を記録する（ワーカースレッドではbind_contextでコンテキストを引き継ぐ）
+        parent = current_span.get() or self.root
+        span = MetricsSpan(self, name, parent, attributes)
+        with self.lock:
+            self.spans.append(span)
+        token = current_span.set(span)
+        try:
+            yield span
+        finally:
+            current_span.reset(token)
+            span.end()
+
+    def add(self, span: MetricsSpan, cost: float = 0.0, **counts):
+        with self.lock:
+            while span is not None:
+                for key, value in counts.items():
+                    span.counts[key] += value
+                span.cost += cost
+                span = span.parent
+
+    def finish(self) -> dict:
+        if self.stage:
+            self.stage.end()
+        self.root.end()
+        current_span.set(None)
+        summary = self.to_dict()
+        total = summary["total"]
+        logging.info(
+            f"計測結果（{self.name}）: {total['durationSeconds']}秒、LLM呼び出し{total['llmCalls']}回"
+            f"（キャッシュ{total['cacheHits']}回、リトライ{total['retries']}回）、"
+            f"入力{total['inputTokens']}トークン（プロンプトキャッシュ読み込み{total['promptCacheReadTokens']}、"
+            f"書き込み{total['promptCacheWriteTokens']}を除く）、出力{total['outputTokens']}トークン、推定コスト${total['costUsd']}"
+        )
+        return summary
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            spans = [span.to_dict() for span in self.spans]
+        return {
+            "pipeline": self.name,
+            "total": spans[0],
+            "stages": [span for span in spans if span["parent"] == self.name],
+            "spans": spans[1:],
+        }
+
+def bind_context(fn):
+    """
+    現在のコンテキスト（実行中のスパン）を引き継いでfnを実行する関数を返す。
+    ThreadPoolExecutorのワーカーで実行する処理に使用する。
+    """
+    context = contextvars.copy_context()
+    def run(*args, **kwargs):
+        return context.copy().run(fn, *args, **kwargs)
+    return run
+
+def record_llm_usage(endpoint: "LLMEndpoint", input_tokens: int, output_tokens: int, cache_read_tokens: int = 0, cache_write_tokens: int = 0):
+    """
+    LLM呼び出し1回分のトークン使用量と推定コストを、実行中のスパンに記録する。
+    input_tokens: プロンプトキャッシュの読み込み・書き込み分を除いた入力トークン数
+    """
+    cost = (
+        input_tokens * endpoint.input_token_price
+        + output_tokens * endpoint.output_token_price
+        + cache_read_tokens * endpoint.cache_read_token_price
+        + cache_write_tokens * endpoint.cache_write_token_price
+    ) / 1_000_000
+    if otel_token_counter:
+        attributes = {"endpoint": endpoint.name, "model": endpoint.model_id or ""}
+        otel_token_counter.add(input_tokens, {**attributes, "type": "input"})
+        otel_token_counter.add(output_tokens, {**attributes, "type": "output"})
+        otel_token_counter.add(cache_read_tokens, {**attributes, "type": "cache_read"})
+        otel_token_counter.add(cache_write_tokens, {**attributes, "type": "cache_write"})
+    span = current_span.get()
+    if span:
+        span.metrics.add(
+            span, cost, llmCalls=1, inputTokens=input_tokens, outputTokens=output_tokens,
+            promptCacheReadTokens=cache_read_tokens, promptCacheWriteTokens=cache_write_tokens,
+        )
+
+def record_llm_retry(throttled: bool):
+    span = current_span.get()
+    if span:
+        span.metrics.add(span, retries=1, throttles=int(throttled))
+
+def record_llm_cache_hit():
+    span = current_span.get()
+    if span:
+        span.metrics.add(span, cacheHits=1)
+
+# --- レート制限・リトライ制御 ---
+class RateLimiter:
+    """
+    プロセス内で共有するトークンバケット方式のレート制限。
+    1分あたりのリクエスト数・トークン数を制限し、スロットリングを受けた場合は
+    全スレッドの送信を一時停止したうえで送信レートを下げる（成功が続くと徐々に回復する）。
+    """
+
+    def __init__(self, name: str, requests_per_minute: int, tokens_per_minute: int):
+        self.name = name
+        self.requests_per_minute = requests_per_minute  # 0の場合は制限なし
+        self.tokens_per_minute = tokens_per_minute      # 0の場合は制限なし
+        self.rate_scale = 1.0         # スロットリングから学習した送信レートの倍率
+        self.request_allowance = float(requests_per_minute)
+        self.token_allowance = float(tokens_per_minute)
+        self.blocked_until = 0.0      # スロットリング後、全スレッドの送信を再開する時刻
+        self.consecutive_throttles = 0
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self, now: float):
+        # 経過時間に応じて許容量を補充する（上限は1分あたりの許容量）
+        elapsed_minutes = (now - self.updated_at) / 60
+        self.updated_at = now
+        if self.requests_per_minute:
+            capacity = self.requests_per_minute * self.rate_scale
+            self.request_allowance = min(capacity, self.request_allowance + elapsed_minutes * capacity)
+        if self.tokens_per_minute:
+            capacity = self.tokens_per_minute * self.rate_scale
+            self.token_allowance = min(capacity, self.token_allowance + elapsed_minutes * capacity)
+
+    def acquire(self, tokens: int):
+        """
+        リクエストを送信できるまで待機し、許容量を消費する。
+        tokens: このリクエストで消費する推定トークン数
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.refill(now)
+                wait = max(0.0, self.blocked_until - now)
+                if wait == 0 and self.requests_per_minute and self.request_allowance < 1:
+                    wait = (1 - self.request_allowance) * 60 / (self.requests_per_minute * self.rate_scale)
+                if wait == 0 and self.tokens_per_minute:
+                    # 1回で上限を超えるリクエストは、バケットが満杯になれば送信する
+                    required = min(tokens, self.tokens_per_minute * self.rate_scale)
+                    if self.token_allowance < required:
+                        wait = (required - self.token_allowance) * 60 / (self.tokens_per_minute * self.rate_scale)
+                if wait == 0:
+                    self.request_allowance -= 1
+                    self.token_allowance -= tokens
+                    return
+            time.sleep(min(wait, 5))
+
+    def record_success(self):
+        with self.lock:
+            self.consecutive_throttles = 0
+            self.rate_scale = min(1.0, self.rate_scale + 0.05)
+
+    def record_throttle(self, retry_after: float | None) -> float:
+        """
+        スロットリングを記録し、全スレッドの送信を停止する秒数を返す。
+        Retry-Afterが指定されている場合はその秒数以上、ない場合はジッター付きの指数バックオフで待機する。
+        """
+        with self.lock:
+            self.consecutive_throttles += 1
+            self.rate_scale = max(0.1, self.rate_scale * 0.7)
+            if retry_after is not None:
+                delay = retry_after + random.uniform(0, 1)
+            else:
+                delay = random.uniform(0.5, 1.0) * min(60, 2 ** self.consecutive_throttles)
+            self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+            return self.blocked_until - time.monotonic()
+
+class CircuitBreaker:
+    """
+    一時的な障害が閾値まで連続した場合に一定時間呼び出しを遮断し、停止中のサービスへの送信を止める。
+    遮断中のエンドポイントは選択の対象から外し（他のエンドポイントへ切り替える）、切り替え先がない場合は遮断時間の経過まで待機する。
+    遮断時間の経過後は試行を許可し、再度失敗した場合はただちに遮断する。
+    """
+
+    def __init__(self, name: str, failure_threshold: int, cooldown_seconds: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def wait_until_closed(self):
+        # 遮断中の場合は遮断時間が経過するまで待機する（呼び出し元のリトライ回数は消費しない）
+        with self.lock:
+            if self.opened_at is None:
+                return
+            remaining = self.cooldown_seconds - (time.monotonic() - self.opened_at)
+        if remaining > 0:
+            logging.warning(f"{self.name} APIで連続してエラーが発生したため呼び出しを停止中です。{remaining:.1f}秒後に再開します。")
+            time.sleep(remaining)
+        with self.lock:
+            if self.opened_at is not None and time.monotonic() - self.opened_at >= self.cooldown_seconds:
+                # 遮断時間が経過したら試行を許可（1回失敗すると再度遮断）
+                self.opened_at = None
+                self.failures = self.failure_threshold - 1
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold and self.opened_at is None:
+                self.opened_at = time.monotonic()
+                logging.error(f"{self.name} APIで{self.failures}回連続してエラーが発生したため、{self.cooldown_seconds}秒間呼び出しを停止します。")
+
+# リトライで回復が見込めるBedrockのエラーコード
+BEDROCK_THROTTLING_CODES = {"ThrottlingException", "TooManyRequestsException"}
+BEDROCK_TRANSIENT_CODES = {"ServiceUnavailableException", "InternalServerException", "ModelNotReadyException", "ModelTimeoutException"}
+
+def classify_llm_error(e: Exception) -> tuple[str, float | None]:
+    """
+    LLM呼び出しのエラーを分類する。
+    戻り値: (分類, Retry-Afterの秒数)
+    分類は "throttle"（レート制限）、"transient"（一時的な障害）、"fatal"（リトライ不可）のいずれか。
+    """
+    # SDKの例外はそのSDKを読み込み済みの場合にのみ発生するため、読み込まれているSDKの例外のみ判定する
+    openai = sys.modules.get("openai")
+    if openai is not None:
+        if isinstance(e, openai.RateLimitError):
+            return "throttle", parse_retry_after(e.response.headers)
+        if isinstance(e, (openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)):
+            return "transient", None
+        if isinstance(e, openai.APIStatusError):
+            if e.status_code == 429:
+                return "throttle", parse_retry_after(e.response.headers)
+            return ("transient" if e.status_code >= 500 else "fatal"), None
+
+    botocore_exceptions = sys.modules.get("botocore.exceptions")
+    if botocore_exceptions is not None:
+        if isinstance(e, botocore_exceptions.ClientError):
+            code = e.response.get("Error", {}).get("Code", "")
+            metadata = e.response.get("ResponseMetadata", {})
+            status_code = metadata.get("HTTPStatusCode", 0)
+            if code in BEDROCK_THROTTLING_CODES or status_code == 429:
+                return "throttle", parse_retry_after(metadata.get("HTTPHeaders", {}))
+            if code in BEDROCK_TRANSIENT_CODES or status_code >= 500:
+                return "transient", None
+            return "fatal", None
+        if isinstance(e, (botocore_exceptions.ReadTimeoutError, botocore_exceptions.ConnectTimeoutError, botocore_exceptions.EndpointConnectionError)):
+            return "transient", None
+
+    # 型で判定できない例外はメッセージで判定する（ストリーミング中のエラーなど）
+    error_message = str(e)
+    if "ThrottlingException" in error_message or "Too many requests" in error_message:
+        return "throttle", None
+    return "fatal", None
+
+def get_bedrock_error_code(e: Exception) -> str | None:
+    # BedrockのClientErrorのエラーコード（botocoreを読み込んでいない場合、ClientError以外の場合はNone）
+    botocore_exceptions = sys.modules.get("botocore.exceptions")
+    if botocore_exceptions is not None and isinstance(e, botocore_exceptions.ClientError):
+        return e.response.get("Error", {}).get("Code")
+    return None
+
+def parse_retry_after(headers) -> float | None:
+    # retry-after-ms（Azure OpenAI）または retry-after（秒）ヘッダーから待機秒数を取得する
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        pass
+    return None
+
+# --- LLMエンドポイント ---
+class LLMEndpoint:
+    """
+    LLMの呼び出し先1件（BedrockのリージョンまたはAzure OpenAIのデプロイ）。
+    クライアント、レート制限、サーキットブレーカー、稼働状況の統計をエンドポイントごとに保持する。
+    """
+
+    def __init__(self, name: str, service: str, model_id: str | None, weight: float = 1.0,
+                 region: str | None = None, access_key_id: str | None = None, secret_access_key: str | None = None,
+                 endpoint: str | None = None, api_key: str | None = None, api_version: str | None = None,
+                 rpm_limit: int = 0, tpm_limit: int = 0,
+                 input_token_price: float = 0.0, output_token_price: float = 0.0,
+                 cache_read_token_price: float | None = None, cache_write_token_price: float | None = None):
+        self.name = name
+        self.service = service
+        self.model_id = model_id  # BedrockのモデルID、またはAzure OpenAIのデプロイ名
+        self.weight = max(weight, 0.01)
+        self.region = region
+        self.access_key_id = access_key_id
+        self.secret_access_key = secret_access_key
+        self.endpoint = endpoint
+        self.api_key = api_key
+        self.api_version = api_version
+        self.input_token_price = input_token_price    # USD / 100万トークン
+        self.output_token_price = output_token_price
+        self.cache_read_token_price = input_token_price if cache_read_token_price is None else cache_read_token_price
+        self.cache_write_token_price = input_token_price if cache_write_token_price is None else cache_write_token_price
+        self.rate_limiter = RateLimiter(name, rpm_limit, tpm_limit)
+        self.circuit_breaker = CircuitBreaker(name, llm_circuit_failure_threshold, llm_circuit_cooldown_seconds)
+        self.client = None
+        self.lock = threading.Lock()
+        # BedrockでcachePointを付与するか（cachePointに対応していないモデルと判明した場合はFalseにする）
+        self.prompt_caching = prompt_caching_enabled
+        # 稼働状況の統計
+        self.in_flight = 0
+        self.requests = 0
+        self.successes = 0
+        self.failures = 0
+        self.throttles = 0
+        self.latency_ewma = None  # 応答時間の指数移動平均（秒）
+        self.last_error = None
+
+    # 必須設定のチェック
+    def validate(self):
+        if self.service == "AZURE":
+            # Azure OpenAIに必要な設定がすべてあるか確認
+            required = [self.api_key, self.endpoint, self.api_version, self.model_id]
+            if not all(required):
+                raise ValueError(f"Azure OpenAI の必須環境変数が設定されていません。（{self.name}）")
+        elif self.service == "AWS":
+            # AWS Bedrockに必要な設定がすべてあるか確認
+            required = [self.region, self.access_key_id, self.secret_access_key, self.model_id]
+            if not all(required):
+                raise ValueError(f"AWS Bedrock の必須環境変数が設定されていません。（{self.name}）")
+        else:
+            # サポートされていないLLMサービスが指定された場合のエラー
+            raise ValueError(f"無効なLLMサービスが指定されました: {self.service}")
+
+    # クライアントを取得する（未初期化の場合は初期化する）
+    def get_client(self):
+        with self.lock:
+            if self.client is None:
+                self.client = self.create_client()
+            return self.client
+
+    def create_client(self):
+        if self.service == "AZURE":
+            # Azure OpenAIクライアントの初期化（SDKはAzure OpenAIを使用する場合のみ読み込む）
+            import httpx
+            from openai import AzureOpenAI
+            # プロセス全体の同時送信数に合わせて接続プールを確保する
+            http_client = httpx.Client(
+                limits=httpx.Limits(
+                    max_connections=llm_process_max_concurrency,
+                    max_keepalive_connections=llm_process_max_concurrency,
+                ),
+                timeout=httpx.Timeout(600, connect=60),
+            )
+            return AzureOpenAI(
+                api_version=self.api_version,
+                azure_endpoint=self.endpoint,
+                api_key=self.api_key,
+                http_client=http_client,
+                max_retries=0,  # リトライはcall_llm側のレート制限と合わせて制御する
+            )
+        # AWS Bedrockクライアントの初期化（タイムアウト・接続プール設定付き、SDKはBedrockを使用する場合のみ読み込む）
+        import boto3
+        from botocore.config import Config
+        config = Config(
+            read_timeout=600,
+            connect_timeout=60,
+            max_pool_connections=llm_process_max_concurrency,
+            retries={"total_max_attempts": 1},  # リトライはcall_llm側のレート制限と合わせて制御する
         )
-    elif llm_service == "AWS":
-        # AWS Bedrockクライアントの初期化（タイムアウト設定付き）
-        config = Config(read_timeout=600, connect_timeout=60)
-        bedrock_client = boto3.client(
+        return boto3.client(
             "bedrock-runtime",
-            region_name=aws_region,
-            aws_access_key_id=aws_access_key_id,
-            aws_secret_access_key=aws_secret_access_key,
+            region_name=self.region,
+            aws_access_key_id=self.access_key_id,
+            aws_secret_access_key=self.secret_access_key,
             config=config,
         )
 
+    # Azure OpenAIへ送信するメッセージ（共通の先頭部分を最初のメッセージにして、自動プロンプトキャッシュの対象にする）
+    @staticmethod
+    def build_messages(system_prompt: str, user_prompt: str, shared_prefix: str | None) -> list[dict]:
+        messages = [{"role": "system", "content": shared_prefix}] if shared_prefix else []
+        messages.append({"role": "system", "content": system_prompt})
+        messages.append({"role": "user", "content": user_prompt})
+        return messages
+
+    # Bedrockへ送信するシステムプロンプト（共通の先頭部分の直後にcachePointを付与する）
+    @staticmethod
+    def build_system_blocks(system_prompt: str, shared_prefix: str | None, cache_point: bool) -> list[dict]:
+        blocks = []
+        if shared_prefix:
+            blocks.append({"text": shared_prefix})
+            if cache_point:
+                blocks.append({"cachePoint": {"type": "default"}})
+        blocks.append({"text": system_prompt})
+        return blocks
+
+    def send_bedrock(self, operation, system_prompt: str, user_prompt: str, shared_prefix: str | None) -> dict:
+        """
+        BedrockのConverse API（converseまたはconverse_stream）を呼び出す。
+        プロンプトキャッシュに対応していないモデルはcachePointを含むリクエストをValidationExceptionで拒否するため、
+        その場合はcachePointを付けずに1回だけ再送し、成功した場合はこのエンドポイントでの付与を停止する。
+        """
+        def send(cache_point: bool) -> dict:
+            return operation(
+                modelId=self.model_id,
+                messages=[{"role": "user", "content": [{"text": user_prompt}]}],
+                system=self.build_system_blocks(system_prompt, shared_prefix, cache_point),
+                inferenceConfig={"maxTokens": 64000},
+            )
+
+        cache_point = self.prompt_caching and bool(shared_prefix)
+        try:
+            return send(cache_point)
+        except Exception as e:
+            if not cache_point or get_bedrock_error_code(e) != "ValidationException":
+                raise
+            logging.warning(f"{self.name} APIでcachePointを含むリクエストが拒否されたため、プロンプトキャッシュを使用せずに再送します: {e}")
+            response = send(False)
+            self.prompt_caching = False
+            logging.warning(f"{self.name} APIのモデル（{self.model_id}）はプロンプトキャッシュに対応していないため、以降はcachePointを付与しません。")
+            return response
+
+    # Azure OpenAIのusageを記録する（prompt_tokensにはキャッシュから読み込んだトークンも含まれる）
+    def record_openai_usage(self, usage):
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = (getattr(details, "cached_tokens", None) or 0) if details else 0
+        record_llm_usage(self, usage.prompt_tokens - cached_tokens, usage.completion_tokens, cache_read_tokens=cached_tokens)
+
+    # Bedrockのusageを記録する（inputTokensにはキャッシュの読み込み・書き込み分は含まれない）
+    def record_bedrock_usage(self, usage: dict):
+        record_llm_usage(
+            self, usage.get("inputTokens", 0), usage.get("outputTokens", 0),
+            cache_read_tokens=usage.get("cacheReadInputTokens", 0),
+            cache_write_tokens=usage.get("cacheWriteInputTokens", 0),
+        )
+
+    def converse(self, system_prompt: str, user_prompt: str, shared_prefix: str | None = None) -> str:
+        client = self.get_client()
+        if self.service == "AZURE":
+            # Azure OpenAIにチャット形式でリクエストを送信
+            response = client.chat.completions.create(
+                model=self.model_id,
+                messages=self.build_messages(system_prompt, user_prompt, shared_prefix),
+                max_completion_tokens=32768,
+            )
+            if response.usage:
+                self.record_openai_usage(response.usage)
+            return response.choices[0].message.content
+
+        # AWS BedrockにConverse APIでリクエストを送信
+        response = self.send_bedrock(client.converse, system_prompt, user_prompt, shared_prefix)
+        # レスポンスの構造を確認してから取得
+        if 'output' in response and 'message' in response['output']:
+            self.record_bedrock_usage(response.get('usage', {}))
+            return response['output']['message']['content'][0]['text']
+        logging.error(f"予期しないレスポンス構造: {json.dumps(response, ensure_ascii=False)}")
+        raise RuntimeError("AWS Bedrockからの応答形式が不正です。")
+
+    def open_stream(self, system_prompt: str, user_prompt: str, shared_prefix: str | None = None):
+        client = self.get_client()
+        if self.service == "AZURE":
+            # Azure OpenAIにストリーミング指定でリクエストを送信
+            return client.chat.completions.create(
+                model=self.model_id,
+                messages=self.build_messages(system_prompt, user_prompt, shared_prefix),
+                max_completion_tokens=32768,
+                stream=True,
+                stream_options={"include_usage": True},  # 最後のチャンクでトークン使用量を受け取る
+            )
+        # AWS BedrockにConverseStream APIでリクエストを送信
+        response = self.send_bedrock(client.converse_stream, system_prompt, user_prompt, shared_prefix)
+        return response["stream"]
+
+    def iter_stream(self, stream) -> Iterator[str]:
+        if self.service == "AZURE":
+            for event in stream:
+                if event.choices and event.choices[0].delta.content:
+                    yield event.choices[0].delta.content
+                if getattr(event, "usage", None):
+                    self.record_openai_usage(event.usage)
+        else:
+            for event in stream:
+                if "contentBlockDelta" in event:
+                    text = event["contentBlockDelta"]["delta"].get("text")
+                    if text:
+                        yield text
+                elif "metadata" in event:
+                    self.record_bedrock_usage(event["metadata"].get("usage", {}))
+
+    # サーキットブレーカーが遮断中でなければ利用可能
+    def is_available(self) -> bool:
+        breaker = self.circuit_breaker
+        with breaker.lock:
+            return breaker.opened_at is None or time.monotonic() - breaker.opened_at >= breaker.cooldown_seconds
+
+    # スロットリングにより送信を停止中か
+    def is_paused(self) -> bool:
+        return self.rate_limiter.blocked_until > time.monotonic()
+
+    # 重み当たりの実行中リクエスト数（少ないほど優先して選択する）
+    def load(self) -> float:
+        return (self.in_flight + 1) / self.weight
+
+    # 送信の開始を記録する（プロセス全体の同時送信数の上限に達している場合は空きが出るまで待機する）
+    def begin(self) -> float:
+        llm_request_slots.acquire()
+        with self.lock:
+            self.in_flight += 1
+            self.requests += 1
+        return time.monotonic()
+
+    def record_success(self, started: float):
+        latency = time.monotonic() - started
+        with self.lock:
+            self.in_flight -= 1
+            self.successes += 1
+            self.latency_ewma = latency if self.latency_ewma is None else self.latency_ewma * 0.8 + latency * 0.2
+        llm_request_slots.release()
+        self.rate_limiter.record_success()
+        self.circuit_breaker.record_success()
+
+    def record_failure(self, started: float, kind: str, error_message: str):
+        with self.lock:
+            self.in_flight -= 1
+            self.failures += 1
+            if kind == "throttle":
+                self.throttles += 1
+            self.last_error = error_message
+        llm_request_slots.release()
+        # レート制限は送信レートの調整（RateLimiter）で対処するため、遮断の判定には一時的な障害のみを数える
+        if kind == "transient":
+            self.circuit_breaker.record_failure()
+
+    # 結果を記録せずに実行中リクエストから外す（ストリーミングの受信を途中で打ち切った場合など）
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+        llm_request_slots.release()
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                "name": self.name,
+                "service": self.service,
+                "modelId": self.model_id,
+                "weight": self.weight,
+                "available": self.is_available(),
+                "pausedSeconds": round(max(0.0, self.rate_limiter.blocked_until - time.monotonic()), 1),
+                "rateScale": round(self.rate_limiter.rate_scale, 2),
+                "inFlight": self.in_flight,
+                "requests": self.requests,
+                "successes": self.successes,
+                "failures": self.failures,
+                "throttles": self.throttles,
+                "avgLatencySeconds": round(self.latency_ewma, 2) if self.latency_ewma is not None else None,
+                "lastError": self.last_error,
+            }
+
+def load_llm_endpoints() -> list[LLMEndpoint]:
+    """
+    LLM_ENDPOINTS（JSON配列）からエンドポイントのプールを生成する。
+    未設定の場合は LLM_SERVICE と各サービスの接続情報から1件のエンドポイントを生成する。
+    各項目で省略した接続情報・上限値は、サービスごとの環境変数の値を使用する。
+    """
+    if llm_endpoints_config:
+        try:
+            entries = json.loads(llm_endpoints_config)
+        except ValueError:
+            raise ValueError("LLM_ENDPOINTS の形式が不正です（JSON配列で指定してください）。")
+        if not isinstance(entries, list) or not entries:
+            raise ValueError("LLM_ENDPOINTS の形式が不正です（JSON配列で指定してください）。")
+    else:
+        entries = [{"name": llm_service, "service": llm_service}]
+
+    endpoints = []
+    for i, entry in enumerate(entries, start=1):
+        service = str(entry.get("service", llm_service)).upper()
+        name = entry.get("name", f"{service}-{i}")
+        if service not in ("AZURE", "AWS"):
+            # サポートされていないLLMサービスが指定された場合のエラー
+            raise ValueError(f"無効なLLMサービスが指定されました: {service}")
+        if service == "AZURE":
+            endpoint = LLMEndpoint(
+                name, service, entry.get("deployment", azure_deployment),
+                weight=float(entry.get("weight", 1)),
+                endpoint=entry.get("endpoint", azure_endpoint),
+                api_key=entry.get("apiKey", azure_api_key),
+                api_version=entry.get("apiVersion", azure_api_version),
+                rpm_limit=int(entry.get("rpmLimit", azure_rpm_limit)),
+                tpm_limit=int(entry.get("tpmLimit", azure_tpm_limit)),
+                input_token_price=float(entry.get("inputTokenPrice", llm_input_token_price)),
+                output_token_price=float(entry.get("outputTokenPrice", llm_output_token_price)),
+                cache_read_token_price=float(entry.get("cacheReadTokenPrice", llm_cache_read_token_price)),
+                cache_write_token_price=float(entry.get("cacheWriteTokenPrice", llm_cache_write_token_price)),
+            )
+        else:
+            endpoint = LLMEndpoint(
+                name, service, entry.get("modelId", aws_bedrock_model_id),
+                weight=float(entry.get("weight", 1)),
+                region=entry.get("region", aws_region),
+                access_key_id=entry.get("accessKeyId", aws_access_key_id),
+                secret_access_key=entry.get("secretAccessKey", aws_secret_access_key),
+                rpm_limit=int(entry.get("rpmLimit", aws_rpm_limit)),
+                tpm_limit=int(entry.get("tpmLimit", aws_tpm_limit)),
+                input_token_price=float(entry.get("inputTokenPrice", llm_input_token_price)),
+                output_token_price=float(entry.get("outputTokenPrice", llm_output_token_price)),
+                cache_read_token_price=float(entry.get("cacheReadTokenPrice", llm_cache_read_token_price)),
+                cache_write_token_price=float(entry.get("cacheWriteTokenPrice", llm_cache_write_token_price)),
+            )
+        endpoint.validate()  # 環境変数の妥当性をチェック
+        endpoints.append(endpoint)
+    return endpoints
+
+# エンドポイントのプールを取得する関数（初回呼び出し時に生成）
+def get_llm_endpoints() -> list[LLMEndpoint]:
+    global llm_endpoints
+    with llm_endpoints_lock:
+        if llm_endpoints is None:
+            llm_endpoints = load_llm_endpoints()
+        return llm_endpoints
+
+def select_endpoint(exclude: set) -> LLMEndpoint:
+    """
+    呼び出し先のエンドポイントを選択する。
+    遮断中・除外対象のエンドポイントを避け、送信停止中でないもの → 重み当たりの実行中リクエスト数が少ないもの
+    → 平均応答時間が短いもの、の順に優先する。候補がない場合は除外対象も含めて選択する。
+    """
+    endpoints = get_llm_endpoints()
+    candidates = [e for e in endpoints if e not in exclude and e.is_available()]
+    if not candidates:
+        candidates = [e for e in endpoints if e.is_available()] or endpoints
+    return min(candidates, key=lambda e: (e.is_paused(), e.load(), e.latency_ewma or 0))
+
+# LLM応答キャッシュのキーを生成する関数
+def get_llm_cache_key(system_prompt: str, user_prompt: str, shared_prefix: str | None = None) -> str:
+    """
+    プロバイダ、モデル（デプロイ）ID、共通の先頭部分、システムプロンプト、ユーザープロンプトからSHA-256のキーを生成する。
+    複数のエンドポイントを使う場合は、プール全体のプロバイダとモデルIDの組をキーに含める。
+    """
+    models = ",".join(sorted({f"{e.service}:{e.model_id}" for e in get_llm_endpoints()}))
+    digest = hashlib.sha256()
+    for part in (models, shared_prefix or "", system_prompt, user_prompt):
+        digest.update(part.encode('utf-8'))
+        digest.update(b"\0")  # 区切り文字（連結時の衝突防止）
+    return digest.hexdigest()
+
+# LLM応答キャッシュから応答を取得する関数
+def read_llm_cache(key: str) -> str | None:
+    """
+    メモリ → ディスクの順にキャッシュを参照する。見つからない場合はNoneを返す。
+    """
+    with llm_cache_lock:
+        if key in llm_cache:
+            llm_cache.move_to_end(key)
+            llm_cache_stats["hits"] += 1
+            return llm_cache[key]
+
+    cache_path = Path(llm_cache_dir) / f"{key}.txt"
+    try:
+        text = cache_path.read_text(encoding='utf-8')
+        os.utime(cache_path)  # 最終アクセス時刻を更新（ディスク側の追い出し順に使用）
+    except OSError:
+        with llm_cache_lock:
+            llm_cache_stats["misses"] += 1
+        return None
+
+    with llm_cache_lock:
+        store_llm_cache_in_memory(key, text)
+        llm_cache_stats["hits"] += 1
+    return text
+
+# メモリ上のLRUキャッシュに格納する関数（llm_cache_lockを取得した状態で呼び出す）
+def store_llm_cache_in_memory(key: str, text: str):
+    if llm_cache_max_entries == 0:
+        return
+    llm_cache[key] = text
+    llm_cache.move_to_end(key)
+    while len(llm_cache) > llm_cache_max_entries:
+        llm_cache.popitem(last=False)
+
+# LLM応答をキャッシュへ保存する関数
+def write_llm_cache(key: str, text: str):
+    with llm_cache_lock:
+        store_llm_cache_in_memory(key, text)
+
+    if llm_cache_max_bytes == 0:
+        return
+    try:
+        cache_dir = Path(llm_cache_dir)
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        # 書き込み途中のファイルを読まれないよう、一時ファイル経由で置き換える
+        tmp_path = cache_dir / f"{key}.{threading.get_ident()}.tmp"
+        tmp_path.write_text(text, encoding='utf-8')
+        os.replace(tmp_path, cache_dir / f"{key}.txt")
+        evict_llm_disk_cache()
+    except OSError as e:
+        # キャッシュの保存失敗は処理全体を止めない
+        logging.warning(f"LLM応答キャッシュの保存に失敗しました: {e}")
+
+# ディスクキャッシュの合計サイズが上限を超えた場合、古いものから削除する関数
+def evict_llm_disk_cache():
+    entries = []
+    for path in Path(llm_cache_dir).glob("*.txt"):
+        try:
+            stat = path.stat()
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= llm_cache_max_bytes:
+            break
+        try:
+            path.unlink()
+            total_size -= size
+        except OSError:
+            continue
+
 # LLMサービスを呼び出す共通関数
-def call_llm(system_prompt: str, user_prompt: str, max_retries: int = 5) -> str:
+def call_llm(system_prompt: str, user_prompt: str, max_retries: int = 5, use_cache: bool = True, shared_prefix: str | None = None) -> str:
     """
     指定されたLLMサービス（AzureまたはAWS）を使ってプロンプトを送信し、応答を取得する。
     system_prompt: システムプロンプト（モデルの振る舞いを定義）
     user_prompt: ユーザーからの入力
     max_retries: 最大リトライ回数
+    use_cache: Falseの場合は応答キャッシュを参照せずにLLMを呼び出す（結果はキャッシュに保存される）
+    shared_prefix: 複数の呼び出しで共通の先頭部分（設計書など）。システムプロンプトより前に配置し、プロンプトキャッシュの対象にする
     戻り値: モデルからの応答テキスト
     """
-    global azure_client, bedrock_client
-    
-    # クライアントが未初期化の場合は初期化する
-    if llm_service == "AZURE" and azure_client is None:
-        initialize_client()
-    elif llm_service == "AWS" and bedrock_client is None:
-        initialize_client()
-    
+    if not llm_cache_enabled:
+        return invoke_llm(system_prompt, user_prompt, max_retries, shared_prefix)
+
+    cache_key = get_llm_cache_key(system_prompt, user_prompt, shared_prefix)
+    if use_cache:
+        cached = read_llm_cache(cache_key)
+        if cached is not None:
+            logging.info(f"LLM応答キャッシュを使用しました（hits={llm_cache_stats['hits']}, misses={llm_cache_stats['misses']}）")
+            record_llm_cache_hit()
+            return cached
+
+    response_text = invoke_llm(system_prompt, user_prompt, max_retries, shared_prefix)
+    write_llm_cache(cache_key, response_text)
+    return response_text
+
+# LLMサービスの応答をストリーミングで受け取る共通関数
+def call_llm_stream(system_prompt: str, user_prompt: str, max_retries: int = 5, use_cache: bool = True, shared_prefix: str | None = None) -> Iterator[str]:
+    """
+    call_llmのストリーミング版。応答テキストをチャンク単位で返すジェネレータ。
+    キャッシュにヒットした場合は応答全体を1チャンクとして返す。
+    """
+    cache_key = get_llm_cache_key(system_prompt, user_prompt, shared_prefix) if llm_cache_enabled else None
+    if cache_key and use_cache:
+        cached = read_llm_cache(cache_key)
+        if cached is not None:
+            logging.info(f"LLM応答キャッシュを使用しました（hits={llm_cache_stats['hits']}, misses={llm_cache_stats['misses']}）")
+            record_llm_cache_hit()
+            yield cached
+            return
+
+    # 応答全体はキャッシュへの書き込みのためにのみ保持する（キャッシュを使わない場合は保持しない）
+    chunks = []
+    for chunk in invoke_llm_stream(system_prompt, user_prompt, max_retries, shared_prefix):
+        if cache_key:
+            chunks.append(chunk)
+        yield chunk
+    if cache_key:
+        write_llm_cache(cache_key, "".join(chunks))
+
+# LLMサービスへ実際にリクエストを送信する関数（キャッシュを介さない）
+def invoke_llm(system_prompt: str, user_prompt: str, max_retries: int = 5, shared_prefix: str | None = None) -> str:
+    # 複数のエンドポイントがあり、ヘッジが有効な場合は遅い呼び出しを別エンドポイントで並行して実行する
+    if llm_hedge_after_seconds > 0 and len(get_llm_endpoints()) > 1:
+        return invoke_llm_hedged(system_prompt, user_prompt, max_retries, shared_prefix)
+    return invoke_llm_with_failover(system_prompt, user_prompt, max_retries, shared_prefix)
+
+def invoke_llm_with_failover(system_prompt: str, user_prompt: str, max_retries: int = 5, shared_prefix: str | None = None) -> str:
+    """
+    エンドポイントを選択してリクエストを送信する。レート制限や一時的な障害の場合は別のエンドポイントへ切り替えてリトライする。
+    """
+    estimated_tokens = estimate_tokens(shared_prefix or "") + estimate_tokens(system_prompt) + estimate_tokens(user_prompt)
+    failed = set()
     for attempt in range(max_retries):
+        endpoint = select_endpoint(failed)
+        endpoint.circuit_breaker.wait_until_closed()
+        endpoint.rate_limiter.acquire(estimated_tokens)
+        started = endpoint.begin()
         try:
-            if llm_service == "AZURE":
-                # Azure OpenAIにチャット形式でリクエストを送信
-                response = azure_client.chat.completions.create(
-                    model=azure_deployment,
-                    messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": user_prompt},
-                    ],
-                    max_completion_tokens=32768,
-                )
-                return response.choices[0].message.content
-
-            elif llm_service == "AWS":
-                # AWS BedrockにConverse APIでリクエストを送信
-                response = bedrock_client.converse(
-                    modelId=aws_bedrock_model_id,
-                    messages=[{"role": "user", "content": [{"text": user_prompt}]}],
-                    system=[{"text": system_prompt}],
-                    inferenceConfig={"maxTokens": 64000},
-                )
-                # レスポンスの構造を確認してから取得
-                if 'output' in response and 'message' in response['output']:
-                    return response['output']['message']['content'][0]['text']
-                else:
-                    logging.error(f"予期しないレスポンス構造: {json.dumps(response, ensure_ascii=False)}")
-                    raise RuntimeError("AWS Bedrockからの応答形式が不正です。")
-
+            response_text = endpoint.converse(system_prompt, user_prompt, shared_prefix)
+            endpoint.record_success(started)
+            return response_text
         except Exception as e:
-            error_message = str(e)
-            # ThrottlingExceptionの場合はリトライ
-            if "ThrottlingException" in error_message or "Too many requests" in error_message:
-                if attempt < max_retries - 1:
-                    wait_time = (2 ** attempt) + (attempt * 2)  # エクスポネンシャルバックオフ
-                    logging.warning(f"{llm_service} API レート制限エラー。{wait_time}秒後にリトライします（{attempt + 1}/{max_retries}）")
-                    time.sleep(wait_time)
-                    continue
-                else:
-                    logging.error(f"{llm_service} API呼び出しが最大リトライ回数に達しました")
-                    raise RuntimeError(f"{llm_service} APIのレート制限エラー。しばらく待ってから再試行してください。")
-            else:
-                # その他のエラーは即座に失敗
-                logging.error(f"{llm_service} API呼び出し中にエラーが発生しました: {error_message}")
-                raise RuntimeError(f"{llm_service} API呼び出しに失敗しました: {error_message}")
+            handle_llm_error(endpoint, started, e, attempt, max_retries, failed)
     
-    raise RuntimeError(f"{llm_service} API呼び出しに失敗しました")
+    raise RuntimeError("LLM API呼び出しに失敗しました")
 
+def invoke_llm_hedged(system_prompt: str, user_prompt: str, max_retries: int = 5, shared_prefix: str | None = None) -> str:
+    """
+    リクエストを送信し、LLM_HEDGE_AFTER_SECONDS秒以内に応答がない場合は別のエンドポイントへ同じリクエストを送信する。
+    先に成功した応答を返す（もう一方の応答は破棄する）。
+    """
+    executor = get_hedge_executor()
+    primary = executor.submit(bind_context(invoke_llm_with_failover), system_prompt, user_prompt, max_retries, shared_prefix)
+    done, _ = wait([primary], timeout=llm_hedge_after_seconds)
+    if done:
+        return primary.result()
+
+    # 実行中のリクエストがあるエンドポイントは負荷が高いと判定されるため、別のエンドポイントが選択される
+    logging.info(f"応答が{llm_hedge_after_seconds}秒を超えたため、別のエンドポイントへ同じリクエストを送信します。")
+    hedge = executor.submit(bind_context(invoke_llm_with_failover), system_prompt, user_prompt, max_retries, shared_prefix)
+    with llm_endpoints_lock:
+        hedge_stats["hedged"] += 1
+
+    pending = {primary, hedge}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                if future is hedge:
+                    with llm_endpoints_lock:
+                        hedge_stats["hedge_wins"] += 1
+                return future.result()
+            error = future.exception()
+    raise error
+
+def get_hedge_executor() -> ThreadPoolExecutor:
+    global hedge_executor
+    with llm_endpoints_lock:
+        if hedge_executor is None:
+            # 元のリクエストとヘッジリクエストの両方を受け付けられるよう、プロセス全体の同時送信数の2倍以上を確保する
+            hedge_executor = ThreadPoolExecutor(
+                max_workers=max(8, llm_process_max_concurrency * 2),
+                thread_name_prefix="hedge",
+            )
+        return hedge_executor
+
+# ストリーミングの受信中に一時的なエラーが発生し、先頭から受信し直す必要がある場合のエラー
+class LLMStreamInterrupted(RuntimeError):
+    def __init__(self, message: str, attempts: int):
+        super().__init__(message)
+        self.attempts = attempts  # 中断までに使用したリトライ回数
+
+# LLMサービスからストリーミングで応答を受け取る関数（キャッシュを介さない）
+def invoke_llm_stream(system_prompt: str, user_prompt: str, max_retries: int = 5, shared_prefix: str | None = None) -> Iterator[str]:
+    """
+    応答テキストを生成された順にチャンク単位で返すジェネレータ。
+    ストリームの開始時と、最初のチャンクを返すまでのエラーは、エンドポイントを切り替えてリトライする。
+    チャンクを返した後のエラーは、通常の呼び出しと同じ判定・バックオフを行ったうえでLLMStreamInterruptedを送出する
+    （途中まで返したテキストの重複を避けるため、呼び出し元で先頭から受信し直す）。
+    """
+    estimated_tokens = estimate_tokens(shared_prefix or "") + estimate_tokens(system_prompt) + estimate_tokens(user_prompt)
+    failed = set()
+    for attempt in range(max_retries):
+        endpoint = select_endpoint(failed)
+        endpoint.circuit_breaker.wait_until_closed()
+        endpoint.rate_limiter.acquire(estimated_tokens)
+        started = endpoint.begin()
+        received = False
+        finished = False
+        try:
+            stream = endpoint.open_stream(system_prompt, user_prompt, shared_prefix)
+            for chunk in endpoint.iter_stream(stream):
+                received = True
+                yield chunk
+            endpoint.record_success(started)
+            finished = True
+            return
+        except Exception as e:
+            finished = True
+            if received:
+                logging.error(f"{endpoint.name} API のストリーミング受信中にエラーが発生しました: {e}")
+            # リトライ不可・最大リトライ回数に達した場合はRuntimeErrorを送出する
+            handle_llm_error(endpoint, started, e, attempt, max_retries, failed)
+            if received:
+                raise LLMStreamInterrupted(f"{endpoint.name} API のストリーミング受信が中断されました: {e}", attempt + 1)
+        finally:
+            # 呼び出し元が受信を途中で打ち切った場合
+            if not finished:
+                endpoint.release()
+
+    raise RuntimeError("LLM API呼び出しに失敗しました")
+
+def handle_llm_error(endpoint: LLMEndpoint, started: float, e: Exception, attempt: int, max_retries: int, failed: set):
+    """
+    LLM呼び出しのエラーを記録し、リトライの準備をする（リトライ不可の場合は例外を送出）。
+    他に利用可能なエンドポイントがある場合は待機せずに切り替え、ない場合はバックオフして同じエンドポイントでリトライする。
+    """
+    error_message = str(e)
+    kind, retry_after = classify_llm_error(e)
+    endpoint.record_failure(started, kind, error_message)
+    if kind == "fatal":
+        # リトライで回復しないエラーは即座に失敗
+        logging.error(f"{endpoint.name} API呼び出し中にエラーが発生しました: {error_message}")
+        raise RuntimeError(f"{endpoint.name} API呼び出しに失敗しました: {error_message}")
 
-def structuring(prompt: str) -> str:
+    if attempt >= max_retries - 1:
+        logging.error(f"{endpoint.name} API呼び出しが最大リトライ回数に達しました")
+        if kind == "throttle":
+            raise RuntimeError(f"{endpoint.name} APIのレート制限エラー。しばらく待ってから再試行してください。")
+        raise RuntimeError(f"{endpoint.name} API呼び出しに失敗しました: {error_message}")
+
+    record_llm_retry(kind == "throttle")
+    if kind == "throttle":
+        # このエンドポイントへの全スレッドの送信を停止する（待機は次回のrate_limiter.acquire()で行う）
+        wait_time = endpoint.rate_limiter.record_throttle(retry_after)
+        logging.warning(f"{endpoint.name} API レート制限エラー。{wait_time:.1f}秒間このエンドポイントへの送信を停止します（{attempt + 1}/{max_retries}）")
+    else:
+        logging.warning(f"{endpoint.name} API 一時的なエラー（{error_message}）（{attempt + 1}/{max_retries}）")
+
+    failed.add(endpoint)
+    alternatives = [e for e in get_llm_endpoints() if e not in failed and e.is_available()]
+    if alternatives:
+        logging.warning(f"{endpoint.name} から別のエンドポイントへ切り替えてリトライします。")
+        return
+
+    # 切り替え先がない場合は、すべてのエンドポイントを再び候補にして待機する
+    failed.clear()
+    if kind != "throttle":
+        # 一時的な障害はこのスレッドのみジッター付きの指数バックオフで待機する
+        wait_time = random.uniform(0.5, 1.0) * min(30, 2 ** (attempt + 1))
+        logging.warning(f"{wait_time:.1f}秒後にリトライします。")
+        time.sleep(wait_time)
+
+
+def structuring(prompt: str, use_cache: bool = True) -> str:
     system_prompt = '''
         あなたは業務システムの設計書を解析し、構造化されたMarkdownドキュメントを作成する専門家です。
 
@@ -176,9 +1253,9 @@ def structuring(prompt: str) -> str:
         - 複数の表が含まれる場合は、見出しで区切る
         - 出力形式はMarkdown
     '''
-    return call_llm(system_prompt, prompt)
+    return call_llm(system_prompt, prompt, use_cache=use_cache)
 
-def extract_test_perspectives(prompt: str) -> str:
+def extract_test_perspectives(prompt: str, use_cache: bool = True, shared_prefix: str | None = None) -> str:
     system_prompt = '''
         あなたはソフトウェアテストの専門家です。提供された設計書からテスト観点を抽出してください。
 
@@ -203,9 +1280,12 @@ def extract_test_perspectives(prompt: str) -> str:
         - 要確認事項がない場合は「なし」と記載
         - 出力形式はMarkdown
     '''
-    return call_llm(system_prompt, prompt)
+    return call_llm(system_prompt, prompt, use_cache=use_cache, shared_prefix=shared_prefix)
 
-def create_test_spec(prompt: str) -> str:
+def create_test_spec(prompt: str, use_cache: bool = True, shared_prefix: str | None = None, max_retries: int = 5) -> Iterator[str]:
+    """
+    テスト仕様書（Markdown表）を生成し、応答をチャンク単位で返す。
+    """
     system_prompt = '''
         あなたはソフトウェア品質保証の専門家です。
         提供された設計書とテスト観点をもとに、実務レベルのテスト仕様書を作成してください。
@@ -245,9 +1325,9 @@ def create_test_spec(prompt: str) -> str:
         - 設計書の順序を無視した並び替え
         - 語尾の不統一
     '''
-    return call_llm(system_prompt, prompt)
+    return call_llm_stream(system_prompt, prompt, max_retries, use_cache=use_cache, shared_prefix=shared_prefix)
 
-def structuring_transition(prompt: str) -> str:
+def structuring_transition(prompt: str, use_cache: bool = True) -> str:
     system_prompt = '''
         あなたは業務システムの画面関連情報を解析し、構造化されたMarkdownドキュメントを作成する専門家です。
 
@@ -272,9 +1352,9 @@ def structuring_transition(prompt: str) -> str:
         - ヘッダー行を適切に認識
         - 出力形式はMarkdown
     '''
-    return call_llm(system_prompt, prompt)
+    return call_llm(system_prompt, prompt, use_cache=use_cache)
 
-def create_integration_test_spec(prompt: str) -> str:
+def create_integration_test_spec(prompt: str, use_cache: bool = True, shared_prefix: str | None = None) -> str:
     system_prompt = '''
         あなたは結合テストの専門家です。構造化詳細設計書と画面関連情報から、実行可能な結合テスト仕様書を作成してください。
 
@@ -304,7 +1384,7 @@ def create_integration_test_spec(prompt: str) -> str:
         - 例：「営業所=xx、得意先コード=xx、見積日=xx、現場名=xx、請負内容=xxを入力し、「登録」ボタンをクリック」
         - 確認内容：「～であること」「～されること」で統一
     '''
-    return call_llm(system_prompt, prompt)
+    return call_llm(system_prompt, prompt, use_cache=use_cache, shared_prefix=shared_prefix)
 
 @app.route(route="upload", methods=["POST"])
 def upload(req: func.HttpRequest) -> func.HttpResponse:
@@ -317,243 +1397,2167 @@ def upload(req: func.HttpRequest) -> func.HttpResponse:
     else:
         return func.HttpResponse("無効なテストタイプです", status_code=400)
 
-def generate_unit_test(req: func.HttpRequest) -> func.HttpResponse:
-    try:
-        file = req.files.get("documentFile")
-        if not file:
-            return func.HttpResponse("ファイルがアップロードされていません", status_code=400)
-        
-        file_bytes = file.read()
-        filename = file.filename
-        
-        if not filename.endswith('.xlsx'):
-            return func.HttpResponse("Excelファイル(.xlsx)のみ対応しています", status_code=400)
-            
-    except Exception as e:
-        logging.error(f"ファイル取得エラー: {e}")
-        return func.HttpResponse("ファイルの取得に失敗しました", status_code=400)
-
-    logging.info(f"{filename} を受信しました。単体テスト生成を開始します。")
+@app.route(route="cache/stats", methods=["GET"])
+def cache_stats(req: func.HttpRequest) -> func.HttpResponse:
+    with llm_cache_lock:
+        stats = {
+            "enabled": llm_cache_enabled,
+            "hits": llm_cache_stats["hits"],
+            "misses": llm_cache_stats["misses"],
+            "memory_entries": len(llm_cache),
+        }
+    return func.HttpResponse(json.dumps(stats), status_code=200, mimetype="application/json")
 
+# エンドポイントの稼働状況には直近のエラー（プロバイダのエラー本文）を含むため、関数キーによる認証を必須とする
+@app.route(route="llm/endpoints", methods=["GET"], auth_level=func.AuthLevel.FUNCTION)
+def llm_endpoint_stats(req: func.HttpRequest) -> func.HttpResponse:
     try:
-        # アップロードされたExcelファイル（バイナリ）をメモリ上で読み込み、全シートを辞書形式で取得
-        # すべてのシートが {シート名: DataFrame} の形式で格納される
-        # header=Noneで全行をデータとして読み込み、_clean_sheet()でヘッダーを設定
-        excel_data = pd.read_excel(io.BytesIO(file_bytes), sheet_name=None, header=None)
-
-        # Markdown構造化のためのリスト初期化
-        toc_list = [] # 目次(Table of Contents)用のリスト
-        md_sheets = [] # 各シートのmd文字列を格納するリスト
-
-        # --- 各シートの処理 ---
-        for sheet_name, df in excel_data.items():
-            # 目次用のアンカーを生成 (GitHub-flavored)
-            anchor = re.sub(r'[^a-z0-9-]', '', sheet_name.strip().lower().replace(' ', '-'))
-            toc_list.append(f'- [{sheet_name}](#{anchor})')
-            
-            sheet_content = f"## {sheet_name}\n\n"
+        endpoints = [endpoint.snapshot() for endpoint in get_llm_endpoints()]
+    except ValueError as ve:
+        return func.HttpResponse(str(ve), status_code=500)
+    with llm_endpoints_lock:
+        stats = {"endpoints": endpoints, "hedgeAfterSeconds": llm_hedge_after_seconds, **hedge_stats}
+    return func.HttpResponse(json.dumps(stats, ensure_ascii=False), status_code=200, mimetype="application/json")
 
-            # --- すべてのシートをAIで構造化 ---
-            logging.info(f"「{sheet_name}」シートをAIで構造化します。")
-            try:
-                # DataFrameを行ごとにテキスト化（セル区切りを明示）
-                raw_text = '\n'.join(df.apply(lambda row: ' | '.join(row.astype(str).fillna('')), axis=1))
-                
-                structuring_prompt = f'''
-                    --- Excelシート「{sheet_name}」 ---
-                    {raw_text}
-                '''
-                structured_content = structuring(structuring_prompt)
-                sheet_content += structured_content
-                
-            except Exception as e:
-                logging.error(f"AIによるシート構造化中にエラー: {e}")
-                sheet_content += "（AIによる構造化に失敗しました）"
-            
-            md_sheets.append(sheet_content)
+# リクエストでキャッシュ利用が許可されているか判定する関数
+def is_cache_requested(req: func.HttpRequest) -> bool:
+    # フォーム項目 useCache=false の場合はキャッシュを参照しない
+    return req.form.get("useCache", "true").lower() != "false"
 
-        # --- 1. 全体を結合して最終的なMarkdown設計書を生成 ---
-        logging.info("全シートの処理が完了。最終的な設計書を組み立てます。")
-        md_output_first = f"# {filename}\n\n"
-        md_output_first += "## 目次\n\n"
-        md_output_first += "\n".join(toc_list)
-        md_output_first += "\n\n---\n\n"
-        md_output_first += "\n\n---\n\n".join(md_sheets)
-        logging.info("Markdown設計書をメモリ上に生成しました。")
-        
-        # --- 2. AIによるテスト観点抽出 ---
-        logging.info("設計書全体をAIに渡し、テスト観点を抽出します。")
-        extract_test_perspectives_prompt = f'''
-            --- 設計書 ---
-            {md_output_first}
-        '''
-        md_output_second = extract_test_perspectives(extract_test_perspectives_prompt)
-        logging.info("テスト観点抽出が完了し、メモリ上に保持しました。")
+def read_excel_sheets(source: bytes | Path) -> dict[str, "pd.DataFrame"]:
+    """
+    アップロードされたExcel（バイト列、または一時ファイルのパス）の全シートを {シート名: DataFrame} の形式で読み込む。
+    書式やスタイルは読み込まず、セルの値のみを取得する（header=Noneで全行をデータとして扱う）。
+    calamineが利用できない環境ではopenpyxl（読み取り専用モード）で読み込む。
+    """
+    engine = excel_read_engine
+    if engine == "calamine" and importlib.util.find_spec("python_calamine") is None:
+        logging.warning("python-calamineがインストールされていないため、openpyxlでExcelを読み込みます。")
+        engine = "openpyxl"
+    if engine not in ("calamine", "openpyxl"):
+        raise ValueError("無効なExcel読み込みエンジンが指定されました")
+    import pandas as pd
+    return pd.read_excel(io.BytesIO(source) if isinstance(source, bytes) else source, sheet_name=None, header=None, engine=engine)
 
-        # --- 3. AIによるテスト仕様書生成 ---
-        logging.info("設計書全体をAIに渡し、テスト仕様書を生成します。")
-        test_gen_prompt = f'''
-            --- 設計書 ---
-            {md_output_first}
-            
-            --- テスト観点 ---
-            {md_output_second}
-        '''
+def serialize_sheet(df: "pd.DataFrame", text_format: str | None = None) -> str:
+    """
+    シートのDataFrameをLLMへ渡すテキストに変換する（列単位のベクトル演算で処理）。
+    - 空セル（NaN）は空文字として扱い、全セルが空の行・列は除外する
+    - "pipe"形式では行末の空セルは出力しない（行の途中の空セルは見出しとの列位置を保つためそのまま出力する）
+    - "csv"/"tsv"形式では列位置を保ったまま区切り文字で出力する
+    """
+    text_format = text_format or sheet_text_format
 
-        md_output_third = create_test_spec(test_gen_prompt)
-        logging.info("テスト仕様書の生成が完了し、メモリ上に保持しました。")
+    # 空セル（NaN・NaT）を空文字にしてから文字列化し、前後の空白を除去
+    # （日時型の列はfillna("")で空文字にならないため、object型にしてから置き換える）
+    text_df = df.astype(object).where(df.notna(), "").astype(str).apply(lambda col: col.str.strip())
 
-        # --- 4. テスト仕様書(Markdown)をExcelに変換 ---
-        logging.info("テスト仕様書をMarkdownからExcel形式に変換します。")
-        
-        # Markdownから表部分だけを抽出
-        md_lines = [line.strip() for line in md_output_third.splitlines() if line.strip().startswith("|")]
-        
-        if not md_lines:
-            logging.error("テスト仕様書にMarkdown表が見つかりませんでした")
-            return func.HttpResponse("テスト仕様書の生成に失敗しました（表形式が見つかりません）", status_code=500)
-        
-        tsv_text = "\n".join([line.strip("|").replace("|", "\t") for line in md_lines])
+    # 全セルが空の行・列を除外
+    non_empty = text_df != ""
+    text_df = text_df.loc[non_empty.any(axis=1), non_empty.any(axis=0)]
+    if text_df.empty:
+        return ""
 
-        # DataFrame化
-        df = pd.read_csv(io.StringIO(tsv_text), sep="\t")
-        df.columns = [col.strip() for col in df.columns]
-        
-        # 必須列の存在確認（6列構成）
-        required_columns = ["No", "大区分", "中区分", "テストケース", "期待結果", "トレース元"]
-        missing_columns = [col for col in required_columns if col not in df.columns]
-        if missing_columns:
-            logging.error(f"必須列が不足しています: {missing_columns}")
-            return func.HttpResponse(f"テスト仕様書の形式が不正です（不足列: {', '.join(missing_columns)}）", status_code=500)
-        
-        # 既存テンプレートを読み込み
-        template_path = "単体テスト仕様書.xlsx"
-        wb = load_workbook(template_path)
-        ws = wb.active
-
-        # マッピング定義（DataFrame列名 → Excel列番号）
-        column_map = {
-            "No": 1,           # A列
-            "大区分": 2,       # B列
-            "中区分": 6,       # F列
-            "テストケース": 10, # J列
-            "期待結果": 23,     # W列
-            "トレース元": 42    # AP列
-        }
+    if text_format in ("csv", "tsv"):
+        sep = "," if text_format == "csv" else "\t"
+        return text_df.to_csv(index=False, header=False, sep=sep, lineterminator="\n").rstrip("\n")
 
-        # DataFrameをA11,B11,F11,J11,W11,AP11に書き込み
-        start_row = 11
-        for i, row in enumerate(df.itertuples(index=False), start=start_row):
-            for col_name, excel_col in column_map.items():
-                if col_name in df.columns:
-                    ws.cell(row=i, column=excel_col, value=getattr(row, col_name))
-
-        # バッファに保存（メモリ上）
-        excel_buffer = io.BytesIO()
-        wb.save(excel_buffer)
-        excel_buffer.seek(0)
-        excel_bytes = excel_buffer.read()
-        
-        logging.info("テンプレートExcelへの書き込みが完了しました。")
+    # 列ごとに文字列連結して各行のテキストを組み立てる
+    columns = [text_df[col] for col in text_df.columns]
+    lines = columns[0]
+    for col in columns[1:]:
+        lines = lines + " | " + col
+    # 行末の空セルを除去
+    lines = lines.str.replace(r"(?:\s*\|)+\s*$", "", regex=True)
+    return "\n".join(lines)
 
-        # --- 5. 全成果物をZIPファイルにまとめる ---
-        logging.info("全成果物をZIPファイルにまとめています。")
-        base_name = Path(filename).stem
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
-            zip_file.writestr(f"{base_name}_構造化設計書.md", md_output_first.encode('utf-8'))
-            zip_file.writestr(f"{base_name}_テスト観点.md", md_output_second.encode('utf-8'))
-            zip_file.writestr(f"{base_name}_テスト仕様書.md", md_output_third.encode('utf-8'))
-            zip_file.writestr(f"{base_name}_テスト仕様書.xlsx", excel_bytes)
-        
-        zip_buffer.seek(0)
-        zip_bytes = zip_buffer.read()
-        logging.info("ZIPファイルの作成が完了しました。")
-        
-        # --- 6. ユーザーへの返却（ZIPファイル） ---
-        output_filename = f"テスト仕様書_{Path(filename).stem}.zip"
-        encoded_filename = quote(output_filename)
-        headers = {
-            "Content-Disposition": f"attachment; filename*=UTF-8''{encoded_filename}",
-            "Content-Type": "application/zip",
-            "Access-Control-Expose-Headers": "Content-Disposition"
-        }
-        return func.HttpResponse(zip_bytes, status_code=200, headers=headers)
+def estimate_tokens(text: str) -> int:
+    """
+    テキストのトークン数を概算する（日本語などの非ASCII文字は1文字1トークン、ASCII文字は4文字1トークン）。
+    """
+    non_ascii = len(re.findall(r"[^\x00-\x7f]", text))
+    return non_ascii + (len(text) - non_ascii + 3) // 4
 
-    except ValueError as ve:
-        logging.error(f"設定エラー: {ve}")
-        return func.HttpResponse(str(ve), status_code=500)
-    except Exception as e:
-        logging.error(f"処理全体で予期せぬエラーが発生: {e}")
-        return func.HttpResponse("処理中にサーバーエラーが発生しました", status_code=500)
+# --- 大きなシートの分割 ---
+def split_sheet_windows(lines: list[str]) -> list[tuple[int, int, int]]:
+    """
+    テキスト化したシートの行を、推定トークン数がSHEET_WINDOW_MAX_TOKENS以内のウィンドウに分割する。
+    各ウィンドウには先頭のSHEET_WINDOW_HEADER_ROWS行（見出し行）と、前のウィンドウの末尾の
+    SHEET_WINDOW_OVERLAP_ROWS行（文脈）を含めたうえで、収まるだけの行を割り当てる（最低1行）。
+    戻り値: (文脈の開始行, 割り当てた行の開始行, 終了行) のリスト（行番号は0始まり、終了行は含まない）
+    """
+    header_count = min(max(0, sheet_window_header_rows), len(lines))
+    line_tokens = [estimate_tokens(line) + 1 for line in lines]
+    if sheet_window_max_tokens <= 0 or sum(line_tokens) <= sheet_window_max_tokens:
+        return [(header_count, header_count, len(lines))]
 
-def generate_integration_test(req: func.HttpRequest) -> func.HttpResponse:
-    try:
-        structured_design_files = req.files.getlist("structuredDesignFiles")
-        transition_diagram_file = req.files.get("transitionDiagramFile")
-        
-        if not structured_design_files or not transition_diagram_file:
-            return func.HttpResponse("必須ファイルが不足しています", status_code=400)
-            
-    except Exception as e:
-        logging.error(f"ファイル取得エラー: {e}")
-        return func.HttpResponse("ファイルの取得に失敗しました", status_code=400)
+    header_tokens = sum(line_tokens[:header_count])
+    windows = []
+    start = header_count
+    while start < len(lines):
+        context_start = max(header_count, start - max(0, sheet_window_overlap_rows)) if windows else start
+        tokens = header_tokens + sum(line_tokens[context_start:start])
+        end = start
+        while end < len(lines) and (end == start or tokens + line_tokens[end] <= sheet_window_max_tokens):
+            tokens += line_tokens[end]
+            end += 1
+        windows.append((context_start, start, end))
+        start = end
+    return windows
 
-    logging.info("結合テスト生成を開始します。")
+def build_window_prompt(sheet_name: str, lines: list[str], window: tuple[int, int, int], index: int, total: int) -> str:
+    context_start, start, end = window
+    header_text = "\n".join(lines[:min(max(0, sheet_window_header_rows), len(lines))])
+    rows_text = "\n".join(lines[start:end])
+    prompt = f'''
+            以下は大きなシートを{total}部分に分割したうちの{index + 1}番目（{start + 1}〜{end}行目）です。
+            シートの先頭行（見出し行）は各部分の先頭に繰り返しています。他の部分と同じ見出し・表の列構成で構造化してください。
+        '''
+    if context_start < start:
+        context_text = "\n".join(lines[context_start:start])
+        prompt += f'''
+            「前の部分の末尾」は文脈の参照用です。構造化の結果には含めないでください。
+            --- 前の部分の末尾 ---
+            {context_text}
+        '''
+    prompt += f'''
+            --- Excelシート「{sheet_name}」 ---
+            {header_text}
+            {rows_text}
+        '''
+    return prompt
 
+def stitch_structured_windows(parts: list[str]) -> str:
+    """
+    ウィンドウごとの構造化結果を、1つのセクションのMarkdownに結合する。
+    - 同じ見出しの内容は、最初に出現した見出しの下にまとめる（見出しは繰り返さない）
+    - 同じ見出しの下にある同じ列見出しの表は、1つの表に結合する
+    - 重なり部分で前のウィンドウと重複した行（同じ表の同じ行、同じ見出しの下の同じ文）は出力しない
+    """
+    def heading_level(heading: str) -> int:
+        return len(heading) - len(heading.lstrip("#"))
+
+    def last_text_block(section: dict) -> list[str] | None:
+        # 見出しの最後のブロックが文の段落であれば返す（表の場合はNone）
+        if section["blocks"] and all(section["blocks"][-1] is not lines for lines, _ in section["tables"].values()):
+            return section["blocks"][-1]
+        return None
+
+    order = [""]  # 見出しの出現順（""は見出しより前の部分）
+    sections = {"": {"blocks": [], "tables": {}, "seen": set()}}
+    for part in parts:
+        heading = ""
+        table = None  # 行を追加中の表（[行のリスト, 出力済みの行のキー]）
+        text_block = None  # 文を追加中の段落
+        paragraph_break = False  # 出力した文の後に空行があったか（重複を除いた文の後の空行は段落の区切りにしない）
+        parents = []  # 箇条書きの上位の行（字下げ, 文）。同じ文でも上位の行が異なれば重複としない
+        emitted = []  # このウィンドウで出力した行（ウィンドウの終了後に、重複の判定対象に加える）
+        lines = part.strip().splitlines()
+        index = 0
+        while index < len(lines):
+            line = lines[index].rstrip()
+            stripped = line.strip()
+            index += 1
+            section = sections[heading]
+
+            if stripped.startswith("#"):
+                if stripped not in sections:
+                    # 新しい見出しは、このウィンドウの直前の見出しの下位・同位の見出しの後ろに挿入する
+                    position = order.index(heading) + 1
+                    while position < len(order) and heading_level(order[position]) >= heading_level(stripped):
+                        position += 1
+                    order.insert(position, stripped)
+                    sections[stripped] = {"blocks": [], "tables": {}, "seen": set()}
+                heading = stripped
+                table, text_block, paragraph_break, parents = None, None, False, []
+            elif stripped.startswith("|"):
+                text_block, parents = None, []
+                key = tuple(normalize_header_cell(cell) for cell in split_markdown_row(stripped))
+                if index < len(lines) and is_separator_row(split_markdown_row(lines[index])):
+                    # 表の列見出し（直後が区切り行）。同じ見出しの下に同じ列見出しの表があればその続きとする
+                    if key not in section["tables"]:
+                        section["tables"][key] = ([line, lines[index].rstrip()], set())
+                        section["blocks"].append(section["tables"][key][0])
+                    table = section["tables"][key]
+                    index += 1
+                    continue
+                if table is None and section["tables"]:
+                    # 列見出しのない行は、この見出しの下で最後に追加した表の続きとする
+                    table = list(section["tables"].values())[-1]
+                if table is None:
+                    section["blocks"].append([line])
+                elif key not in table[1]:
+                    emitted.append((table[1], key))
+                    table[0].append(line)
+            elif not stripped:
+                paragraph_break = text_block is not None
+                text_block = None
+            else:
+                table = None
+                indent = len(line) - len(line.lstrip())
+                while parents and parents[-1][0] >= indent:
+                    parents.pop()
+                key = tuple(text for _, text in parents) + (stripped,)
+                parents.append((indent, stripped))
+                if key in section["seen"]:
+                    continue
+                emitted.append((section["seen"], key))
+                if text_block is None:
+                    text_block = None if paragraph_break else last_text_block(section)
+                    if text_block is None:
+                        text_block = []
+                        section["blocks"].append(text_block)
+                text_block.append(line)
+                paragraph_break = False
+        for seen, key in emitted:
+            seen.add(key)
+
+    output = []
+    for heading in order:
+        if heading:
+            output.append(heading)
+        output += ["\n".join(block) for block in sections[heading]["blocks"]]
+    return "\n\n".join(output) + "\n"
+
+# シートの構造化に失敗した場合に設計書へ記載する文言
+STRUCTURING_FAILED_NOTE = "（AIによる構造化に失敗しました）"
+
+def structure_sheet(sheet_name: str, raw_text: str, use_cache: bool = True, executor: ThreadPoolExecutor | None = None) -> str:
+    """
+    1シート分のテキストをAIで構造化し、見出し付きのMarkdownを返す。
+    推定トークン数がSHEET_WINDOW_MAX_TOKENSを超えるシートは行単位のウィンドウに分けて構造化し、1つのセクションに結合する
+    （executorを指定した場合はウィンドウを並列に構造化する）。
+    構造化に失敗した場合もエラー文言を含むMarkdownを返し、他シートの処理は継続させる。
+    """
+    sheet_content = f"## {sheet_name}\n\n"
+
+    lines = raw_text.split("\n")
+    windows = split_sheet_windows(lines)
     try:
-        # 複数の構造化詳細設計書を読み込み、結合
-        structured_design_md = ""
-        for design_file in structured_design_files:
-            content = design_file.read().decode('utf-8')
-            structured_design_md += f"\n\n# {design_file.filename}\n\n{content}\n\n---\n\n"
-        logging.info(f"{len(structured_design_files)}件の構造化詳細設計書を読み込みました。")
-        
-        # 画面一覧/画面遷移図を読み込み、AIで構造化
-        logging.info("画面一覧/画面遷移図（Excel）をAIで構造化します。")
-        transition_data = pd.read_excel(io.BytesIO(transition_diagram_file.read()), sheet_name=None, header=None)
-        transition_md = ""
-        for sheet_name, df in transition_data.items():
-            raw_text = '\n'.join(df.apply(lambda row: ' | '.join(row.astype(str).fillna('')), axis=1))
-            prompt = f'--- 画面一覧/画面遷移図「{sheet_name}」 ---\n{raw_text}'
-            transition_md += f"## {sheet_name}\n\n{structuring_transition(prompt)}\n\n"
-        logging.info("画面一覧/画面遷移図の構造化が完了しました。")
-        
-        # 結合テスト仕様書を直接生成
-        logging.info("結合テスト仕様書を生成します。")
-        test_spec_prompt = f'''
-            --- 構造化詳細設計書 ---
-            {structured_design_md}
-            
-            --- 画面一覧/画面遷移図 ---
-            {transition_md}
+        if len(windows) == 1:
+            logging.info(f"「{sheet_name}」シートをAIで構造化します。")
+            structuring_prompt = f'''
+            --- Excelシート「{sheet_name}」 ---
+            {raw_text}
         '''
-        test_spec_md = create_integration_test_spec(test_spec_prompt)
-        logging.info("結合テスト仕様書の生成が完了しました。")
-        
-        # ZIPファイルにまとめる
-        logging.info("全成果物をZIPファイルにまとめています。")
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
-            zip_file.writestr("1_画面関連情報.md", transition_md.encode('utf-8'))
-            zip_file.writestr("2_結合テスト仕様書.md", test_spec_md.encode('utf-8'))
+            structured_content = structuring(structuring_prompt, use_cache=use_cache)
+        else:
+            logging.info(f"「{sheet_name}」シートは推定{estimate_tokens(raw_text)}トークンのため、{len(windows)}部分に分割してAIで構造化します。")
+            span = current_span.get()
+            if span:
+                span.attributes["windows"] = len(windows)
+            def structure_window(index: int) -> str:
+                return structuring(build_window_prompt(sheet_name, lines, windows[index], index, len(windows)), use_cache=use_cache)
+            structured_content = stitch_structured_windows(run_in_parallel(executor, structure_window, range(len(windows))))
+        sheet_content += structured_content
+
+    except Exception as e:
+        logging.error(f"AIによるシート構造化中にエラー: {e}")
+        sheet_content += STRUCTURING_FAILED_NOTE
+
+    return sheet_content
+
+# --- 重複・定型シートの検出 ---
+# 既定の定型シートの定義（SHEET_SIGNATURESで置き換え可能）
+DEFAULT_SHEET_SIGNATURES = [
+    {"name": "改訂履歴", "sheetName": r"^(?:改訂|変更|更新|改版)履歴$"},
+    {"name": "改訂履歴", "keywords": ["改訂日", "改訂内容"]},
+    {"name": "表紙", "sheetName": r"^表紙$"},
+]
+# keywordsを探す範囲（テキスト化したシートの先頭の行数）
+SHEET_SIGNATURE_HEADER_LINES = 5
+# 定型シートの内容をそのまま記載する最大行数
+BOILERPLATE_SUMMARY_MAX_LINES = 30
+
+def normalize_sheet_text(raw_text: str) -> str:
+    # 全角・半角、空白の数、空行の違いを無視して比較するためのテキスト
+    lines = (re.sub(r"\s+", " ", line).strip() for line in unicodedata.normalize("NFKC", raw_text).splitlines())
+    return "\n".join(line for line in lines if line)
+
+def get_sheet_signatures() -> list[dict]:
+    """
+    定型シートの定義を返す（初回のみSHEET_SIGNATURESを読み込む）。
+    各定義のキー: name（表示名）、sheetName（シート名の正規表現）、keywords（先頭行にすべて含まれる語句）、
+    action（"summary": 内容をそのまま記載する、"skip": 記載しない。省略時: summary）
+    """
+    global sheet_signatures
+    if sheet_signatures is not None:
+        return sheet_signatures
+    if sheet_signatures_config:
+        try:
+            entries = json.loads(sheet_signatures_config)
+        except ValueError:
+            raise ValueError("SHEET_SIGNATURES の形式が不正です（JSON配列で指定してください）。")
+        if not isinstance(entries, list):
+            raise ValueError("SHEET_SIGNATURES の形式が不正です（JSON配列で指定してください）。")
+    else:
+        entries = DEFAULT_SHEET_SIGNATURES
+
+    signatures = []
+    for entry in entries:
+        if not isinstance(entry, dict) or not (entry.get("sheetName") or entry.get("keywords")):
+            raise ValueError("SHEET_SIGNATURES の各定義には sheetName または keywords を指定してください。")
+        action = entry.get("action", "summary")
+        if action not in ("summary", "skip"):
+            raise ValueError(f"SHEET_SIGNATURES の action が不正です: {action}")
+        try:
+            sheet_name_pattern = re.compile(entry["sheetName"]) if entry.get("sheetName") else None
+        except re.error:
+            raise ValueError(f"SHEET_SIGNATURES の sheetName の正規表現が不正です: {entry['sheetName']}")
+        signatures.append({
+            "name": entry.get("name") or entry.get("sheetName") or "定型シート",
+            "sheetName": sheet_name_pattern,
+            "keywords": [unicodedata.normalize("NFKC", keyword) for keyword in entry.get("keywords", [])],
+            "action": action,
+        })
+    sheet_signatures = signatures
+    return sheet_signatures
+
+def match_sheet_signature(sheet_name: str, raw_text: str) -> dict | None:
+    # シート名と先頭行の語句が、いずれかの定型シートの定義にすべて一致する場合はその定義を返す
+    normalized_name = unicodedata.normalize("NFKC", sheet_name).strip()
+    header = "\n".join(normalize_sheet_text(raw_text).splitlines()[:SHEET_SIGNATURE_HEADER_LINES])
+    for signature in get_sheet_signatures():
+        if signature["sheetName"] and not signature["sheetName"].search(normalized_name):
+            continue
+        if not all(keyword in header for keyword in signature["keywords"]):
+            continue
+        return signature
+    return None
+
+def render_boilerplate_sheet(sheet_name: str, raw_text: str, signature: dict) -> str:
+    """
+    定型シートをLLMを使わずにMarkdownにする。
+    "summary"の場合は元のテキストの先頭部分をそのまま記載し、"skip"の場合は省略した旨のみを記載する。
+    """
+    sheet_content = f"## {sheet_name}\n\n"
+    if signature["action"] == "skip":
+        return sheet_content + f"（定型シート「{signature['name']}」のため省略しました）"
+    lines = [line for line in raw_text.splitlines() if line.strip()]
+    sheet_content += f"（定型シート「{signature['name']}」のため、AIによる構造化を行わずに内容を記載しています）\n\n"
+    sheet_content += "\n".join(f"- {line}" for line in lines[:BOILERPLATE_SUMMARY_MAX_LINES])
+    if len(lines) > BOILERPLATE_SUMMARY_MAX_LINES:
+        sheet_content += f"\n- （以下{len(lines) - BOILERPLATE_SUMMARY_MAX_LINES}行省略）"
+    return sheet_content
+
+def get_structured_content_cache_key(normalized_text: str) -> str:
+    # 内容が同じシートの構造化結果（見出しを除く）を、設計書・シート名によらず再利用するためのキャッシュキー
+    return get_llm_cache_key("構造化結果（正規化したシートの内容）", normalized_text)
+
+# --- 実行履歴（差分再生成） ---
+def compute_fingerprint(*parts: str) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode('utf-8'))
+        digest.update(b"\0")  # 区切り文字（連結時の衝突防止）
+    return digest.hexdigest()
+
+def get_run_path(run_id: str) -> Path | None:
+    # 実行IDはuuid4().hexの形式のみ受け付ける（パスの改ざん防止）
+    if not re.fullmatch(r"[0-9a-f]{32}", run_id or ""):
+        return None
+    return Path(run_store_dir) / "runs" / f"{run_id}.json"
+
+def get_run_journal_path(run_id: str) -> Path | None:
+    # 処理の途中経過（チェックポイント）を1件ずつ追記するジャーナル（実行の完了時に実行結果へまとめて削除する）
+    run_path = get_run_path(run_id)
+    return run_path.with_suffix(".journal.jsonl") if run_path else None
+
+def get_latest_run_pointer(filename: str) -> Path:
+    return Path(run_store_dir) / "latest" / f"{compute_fingerprint(filename)}.txt"
+
+def load_previous_run(filename: str, previous_run_id: str | None = None) -> dict | None:
+    """
+    前回の実行結果を読み込む。previous_run_idが指定されていない場合は、同じファイル名の直近の実行を使用する。
+    """
+    if not previous_run_id:
+        try:
+            previous_run_id = get_latest_run_pointer(filename).read_text(encoding='utf-8').strip()
+        except OSError:
+            return None
+
+    run_path = get_run_path(previous_run_id)
+    if run_path is None:
+        logging.warning(f"不正な実行IDが指定されました: {previous_run_id}")
+        return None
+    try:
+        if run_path.exists():
+            run = json.loads(run_path.read_text(encoding='utf-8'))
+        else:
+            # 完了していない実行は、チェックポイントのジャーナルから途中経過を復元する
+            run = read_run_journal(get_run_journal_path(previous_run_id))
+    except (OSError, ValueError) as e:
+        logging.warning(f"前回の実行結果を読み込めませんでした（{previous_run_id}）: {e}")
+        return None
+    if not is_valid_run(run):
+        logging.warning(f"前回の実行結果の形式が不正なため、使用しません（{previous_run_id}）。")
+        return None
+    return run
+
+def is_valid_run(run) -> bool:
+    """
+    保存された実行結果（チェックポイント）の形式を検証する。
+    不正な内容（途中で書き込みが途切れたもの、古い形式のものなど）は再利用しない。
+    """
+    def is_text(value, optional: bool = False) -> bool:
+        return isinstance(value, str) or (optional and value is None)
+
+    if not isinstance(run, dict) or not isinstance(run.get("sheets"), list) or not isinstance(run.get("shards"), list):
+        return False
+    for sheet in run["sheets"]:
+        if not isinstance(sheet, dict) or not is_text(sheet.get("name")) or not is_text(sheet.get("fingerprint")):
+            return False
+        if not is_text(sheet.get("structured"), optional=True) or not is_text(sheet.get("perspectives"), optional=True):
+            return False
+    for shard in run["shards"]:
+        if not isinstance(shard, dict) or not is_text(shard.get("fingerprint")) or not isinstance(shard.get("rows"), list):
+            return False
+        for row in shard["rows"]:
+            if not isinstance(row, dict) or not all(is_text(row.get(col)) for col in UNIT_SPEC_COLUMN_MAP):
+                return False
+    return True
+
+def save_run(run: dict):
+    """
+    実行結果（シートの指紋・構造化結果、セクションごとのテストケース）を保存し、ファイル名の直近の実行として登録する。
+    LLMによる生成がすべて完了した時点で呼び出し（statusは"completed"）、途中経過のジャーナルを削除する。
+    """
+    try:
+        run_path = get_run_path(run["runId"])
+        run_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = run_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(run, ensure_ascii=False), encoding='utf-8')
+        os.replace(tmp_path, run_path)
+
+        pointer = get_latest_run_pointer(run["filename"])
+        pointer.parent.mkdir(parents=True, exist_ok=True)
+        pointer.write_text(run["runId"], encoding='utf-8')
+        # 途中経過のジャーナルは実行結果にまとめたため不要
+        get_run_journal_path(run["runId"]).unlink(missing_ok=True)
+    except OSError as e:
+        # 保存の失敗は生成結果の返却を妨げない
+        logging.warning(f"実行結果の保存に失敗しました: {e}")
+
+def start_run_journal(run: dict):
+    """
+    チェックポイントのジャーナルを作成し、ファイル名の直近の実行として登録する。
+    先頭行には実行結果の初期値（前回の実行から引き継いだ内容）を書き込み、以降はappend_run_journalで完了した処理を1件ずつ追記する
+    （完了のたびに実行結果全体を書き直さないため、保存の所要時間は処理の数に比例する）。
+    """
+    try:
+        journal_path = get_run_journal_path(run["runId"])
+        journal_path.parent.mkdir(parents=True, exist_ok=True)
+        journal_path.write_text(json.dumps(run, ensure_ascii=False) + "\n", encoding='utf-8')
+
+        pointer = get_latest_run_pointer(run["filename"])
+        pointer.parent.mkdir(parents=True, exist_ok=True)
+        pointer.write_text(run["runId"], encoding='utf-8')
+    except OSError as e:
+        logging.warning(f"チェックポイントの保存に失敗しました: {e}")
+
+def append_run_journal(run_id: str, entries: list[dict], lock: threading.Lock):
+    # entries: {"sheet": シートの実行結果} または {"shard": セクションのテストケース}（シリアライズはロックの外で行う）
+    text = "".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in entries)
+    try:
+        with lock, open(get_run_journal_path(run_id), "a", encoding='utf-8') as journal:
+            journal.write(text)
+    except OSError as e:
+        logging.warning(f"チェックポイントの保存に失敗しました: {e}")
+
+def read_run_journal(journal_path: Path) -> dict:
+    """
+    ジャーナルの先頭行（実行結果の初期値）に、追記された完了分を順に反映した実行結果を返す。
+    書き込みの途中で途切れた行は読み飛ばす。
+    """
+    lines = journal_path.read_text(encoding='utf-8').splitlines()
+    run = json.loads(lines[0]) if lines else None
+    if not isinstance(run, dict) or not isinstance(run.get("sheets"), list) or not isinstance(run.get("shards"), list):
+        return run
+    sheets = {sheet.get("name"): sheet for sheet in run["sheets"] if isinstance(sheet, dict)}
+    shards = {shard.get("fingerprint"): shard for shard in run["shards"] if isinstance(shard, dict)}
+    for line in lines[1:]:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue
+        if isinstance(entry, dict) and isinstance(entry.get("sheet"), dict):
+            sheets[entry["sheet"].get("name")] = entry["sheet"]
+        elif isinstance(entry, dict) and isinstance(entry.get("shard"), dict):
+            shards[entry["shard"].get("fingerprint")] = entry["shard"]
+    run["sheets"] = list(sheets.values())
+    run["shards"] = list(shards.values())
+    return run
+
+# テスト仕様書の生成結果が不正な場合のエラー（メッセージはそのまま利用者に返却する）
+class SpecGenerationError(Exception):
+    pass
+
+# アップロードされたZIPファイルが不正な場合のエラー（メッセージはそのまま利用者に返却する）
+class BatchArchiveError(Exception):
+    pass
+
+# パイプラインの進捗を通知する関数（progressが指定されていない同期実行時は何もしない）
+def notify_progress(progress, stage: str, detail: str | None = None):
+    if progress is not None:
+        progress(stage, detail)
+
+# ZIPファイルをダウンロード用のHTTPレスポンスとして返却する関数
+def build_zip_response(zip_bytes: bytes, output_filename: str, run_id: str | None = None) -> func.HttpResponse:
+    encoded_filename = quote(output_filename)
+    headers = {
+        "Content-Disposition": f"attachment; filename*=UTF-8''{encoded_filename}",
+        "Content-Type": "application/zip",
+        "Access-Control-Expose-Headers": "Content-Disposition, X-Run-Id"
+    }
+    # 実行ID（次回の差分再生成で previousRunId として指定可能）
+    if run_id:
+        headers["X-Run-Id"] = run_id
+    return func.HttpResponse(zip_bytes, status_code=200, headers=headers)
+
+def write_metrics_to_zip(zip_file: zipfile.ZipFile, metrics: PipelineMetrics):
+    # 計測を終了し、結果をmetrics.jsonとしてZIPに追加する
+    summary = metrics.finish()
+    zip_file.writestr("metrics.json", json.dumps(summary, ensure_ascii=False, indent=2).encode('utf-8'))
+
+# リクエストで非同期ジョブモードが指定されているか判定する関数
+def is_async_requested(req: func.HttpRequest) -> bool:
+    # フォーム項目 mode=async の場合はジョブIDを即時返却し、バックグラウンドで処理する
+    return req.form.get("mode", "sync").lower() == "async"
+
+# チャンク単位のテキストを、改行ごとの行に組み立てて返す関数
+def iter_lines(chunks: Iterator[str]) -> Iterator[str]:
+    pending = ""
+    for chunk in chunks:
+        pending += chunk
+        *lines, pending = pending.split("\n")
+        yield from lines
+    if pending:
+        yield pending
+
+# 単体テスト仕様書の列定義（Markdown表の列名 → テンプレートExcelの列番号）
+UNIT_SPEC_COLUMN_MAP = {
+    "No": 1,           # A列
+    "大区分": 2,       # B列
+    "中区分": 6,       # F列
+    "テストケース": 10, # J列
+    "期待結果": 23,     # W列
+    "トレース元": 42    # AP列
+}
+
+# 結合テスト仕様書の列定義（10列固定）
+INTEGRATION_SPEC_COLUMNS = [
+    "テストNo",
+    "画面1", "機能/操作/状況1",
+    "画面2", "機能/操作/状況2",
+    "画面3", "機能/操作/状況3",
+    "画面4", "機能/操作/状況4",
+    "確認内容",
+]
+
+# 解析済みの行の型（キーはMarkdown表の列名）
+UnitSpecRow = TypedDict("UnitSpecRow", {col: str for col in UNIT_SPEC_COLUMN_MAP})
+IntegrationSpecRow = TypedDict("IntegrationSpecRow", {col: str for col in INTEGRATION_SPEC_COLUMNS})
+
+# Markdown表の区切り行（|---|:---:| など）の判定用
+MARKDOWN_SEPARATOR_CELL = re.compile(r":?-+:?")
+# エスケープされていない「|」（セルの区切り）
+MARKDOWN_CELL_DELIMITER = re.compile(r"(?<!\\)\|")
+
+def split_markdown_row(line: str) -> list[str]:
+    """
+    Markdown表の1行をセルのリストに分割する（「\\|」はセル内の「|」として扱う）。
+    """
+    line = line.strip()
+    if line.startswith("|"):
+        line = line[1:]
+    if line.endswith("|") and not line.endswith("\\|"):
+        line = line[:-1]
+    if "\\|" not in line:
+        return [cell.strip() for cell in line.split("|")]
+    return [cell.strip().replace("\\|", "|") for cell in MARKDOWN_CELL_DELIMITER.split(line)]
+
+def normalize_header_cell(cell: str) -> str:
+    # 見出しの強調（**列名**）や空白の揺れを取り除く
+    return re.sub(r"[\s*_`]", "", cell)
+
+def is_separator_row(cells: list[str]) -> bool:
+    return any(cells) and all(MARKDOWN_SEPARATOR_CELL.fullmatch(cell.replace(" ", "")) for cell in cells if cell)
+
+def iter_markdown_table_rows(lines: Iterator[str], required_columns: list[str], fill_down_columns: list[str] | None = None, overflow_column: str | None = None) -> Iterator[dict[str, str]]:
+    """
+    Markdown表の行を受け取った順に解析し、データ行を {列名: 値} の辞書で返す（required_columnsの列のみ）。
+    - ヘッダー行は直後の区切り行で判定し、必須列を含まない表（説明用の表など）は読み飛ばす
+    - 同じヘッダーの表が複数ある場合や、空行で表が途切れた場合も続きの行として扱う
+    - セル数がヘッダーより多い行は、エスケープされていない「|」がセル内にあるものとして、
+      超過分をoverflow_columnのセルに「|」で連結する（省略時は最終列）
+    - fill_down_columnsの列（左から上位の区分）が空欄の場合は直前の行の値で補完する
+      （上位の区分の値が変わった場合、下位の区分は補完しない）
+    必須列を含む表が1つもない場合はSpecGenerationErrorを送出する。
+    """
+    fill_down_columns = fill_down_columns or []
+    header = None              # 現在有効なヘッダー（必須列を含む表のもの）
+    column_index = {}          # 列名 → セル位置
+    pending = None             # 表の先頭行（ヘッダーかどうかは次の行で判定する）
+    in_table = False
+    in_code_fence = False
+    skipping_table = False     # 必須列を含まない表を読み飛ばしているか
+    first_header = None        # エラーメッセージ用に最初に見つかった表のヘッダー
+    previous = {}              # 補完用の直前の値
+
+    def to_row(cells: list[str]) -> dict[str, str]:
+        overflow_index = column_index[overflow_column] if overflow_column in column_index else len(header) - 1
+        extra = len(cells) - len(header)
+        if extra > 0:
+            cells = cells[:overflow_index] + ["|".join(cells[overflow_index:overflow_index + extra + 1])] + cells[overflow_index + extra + 1:]
+        row = {col: (cells[index] if index < len(cells) else "") for col, index in column_index.items()}
+
+        # 上位の区分から順に空欄を補完する
+        parent_changed = False
+        for col in fill_down_columns:
+            if row[col]:
+                parent_changed = parent_changed or row[col] != previous.get(col)
+                previous[col] = row[col]
+            elif not parent_changed:
+                row[col] = previous.get(col, "")
+            else:
+                previous[col] = ""
+        return row
+
+    for line in lines:
+        stripped = line.strip()
+        if stripped.startswith("```"):
+            in_code_fence = not in_code_fence
+            continue
+        if in_code_fence or not stripped.startswith("|"):
+            # 表以外の行で表が終わる（先頭行だけの表は、有効なヘッダーと同じ列数なら続きの行として扱う）
+            if pending is not None and header is not None and not skipping_table and len(pending) >= len(header):
+                yield to_row(pending)
+            pending = None
+            in_table = False
+            continue
+
+        cells = split_markdown_row(stripped)
+        if not in_table:
+            in_table = True
+            pending = cells
+            continue
+
+        if pending is not None:
+            first, pending = pending, None
+            if is_separator_row(cells):
+                # 新しい表のヘッダー
+                normalized = [normalize_header_cell(cell) for cell in first]
+                first_header = first_header or normalized
+                if all(col in normalized for col in required_columns):
+                    header = normalized
+                    column_index = {col: normalized.index(col) for col in required_columns}
+                    skipping_table = False
+                else:
+                    logging.warning(f"必須列を含まない表を読み飛ばします: {first}")
+                    skipping_table = True
+                continue
+            # 区切り行がない場合は、空行で途切れた表の続きとして扱う
+            if header is not None and not skipping_table:
+                yield to_row(first)
+
+        if header is None or skipping_table or is_separator_row(cells) or not any(cells):
+            continue
+        yield to_row(cells)
+
+    if pending is not None and header is not None and not skipping_table and len(pending) >= len(header):
+        yield to_row(pending)
+
+    if header is None:
+        missing_columns = [col for col in required_columns if col not in (first_header or [])]
+        logging.error(f"必須列が不足しています: {missing_columns}")
+        raise SpecGenerationError(f"テスト仕様書の形式が不正です（不足列: {', '.join(missing_columns)}）")
+
+def iter_unit_spec_rows(lines: Iterator[str]) -> Iterator[UnitSpecRow]:
+    # 省略された大区分・中区分は直前の行の値で補完する
+    return iter_markdown_table_rows(lines, list(UNIT_SPEC_COLUMN_MAP), fill_down_columns=["大区分", "中区分"], overflow_column="テストケース")
+
+def iter_integration_spec_rows(lines: Iterator[str]) -> Iterator[IntegrationSpecRow]:
+    return iter_markdown_table_rows(lines, INTEGRATION_SPEC_COLUMNS, overflow_column="確認内容")
+
+# --- 生成結果の検証・修復 ---
+# 空欄を許さない列（空欄の行は該当行のみ修復を依頼する）
+UNIT_SPEC_REQUIRED_VALUES = ["テストケース", "期待結果"]
+
+def find_invalid_spec_rows(rows: list[UnitSpecRow]) -> list[int]:
+    return [index for index, row in enumerate(rows) if not all(row.get(col, "").strip() for col in UNIT_SPEC_REQUIRED_VALUES)]
+
+def record_repair():
+    # 修復の依頼回数を実行中のスパンに記録する
+    span = current_span.get()
+    if span:
+        span.attributes["repairs"] = span.attributes.get("repairs", 0) + 1
+
+def stream_unit_spec_rows(prompt: str, use_cache: bool = True, shared_prefix: str | None = None, on_row=None, max_retries: int = 5) -> tuple[list[UnitSpecRow], str | None, str]:
+    """
+    テスト仕様書を生成し、(行, 形式が不正な場合の理由（正常な場合はNone）, 応答テキスト) を返す。
+    応答テキストは修復の依頼に使うため、形式が不正な場合（必須列を含む表がない場合）のみ返す。
+    表の行を解析できた時点で形式の不備はなくなるため、応答の行は最初の行を解析するまでのみ保持する
+    （応答全体をキャッシュ用の保持と二重に持たない）。
+    受信の途中で中断された場合は、残りのリトライ回数の範囲で先頭から生成し直す（途中まで受信した行は破棄する）。
+    on_row: 行を解析するたびに呼び出されるコールバック（生成し直した場合は、前回までに通知した件数を超えた行のみ通知する）
+    """
+    reported = 0
+    while True:
+        response_lines = []
+        def record(lines: Iterator[str]) -> Iterator[str]:
+            for line in lines:
+                if not rows:
+                    response_lines.append(line)
+                yield line
+        rows = []
+        try:
+            for row in iter_unit_spec_rows(record(iter_lines(create_test_spec(prompt, use_cache=use_cache, shared_prefix=shared_prefix, max_retries=max_retries)))):
+                if not rows:
+                    response_lines.clear()
+                rows.append(row)
+                if on_row and len(rows) > reported:
+                    reported += 1
+                    on_row()
+        except LLMStreamInterrupted as interrupted:
+            max_retries -= interrupted.attempts
+            logging.warning(f"テスト仕様書の受信が中断されたため、先頭から生成し直します: {interrupted}")
+            continue
+        except SpecGenerationError as se:
+            return rows, str(se), "\n".join(response_lines)
+        return rows, None, ""
+
+def generate_unit_spec_rows(test_gen_prompt: str, use_cache: bool = True, shared_prefix: str | None = None, on_row=None) -> list[UnitSpecRow]:
+    """
+    テスト仕様書（Markdown表）を生成して行を返す。生成結果は以下を検証し、不正な場合は修復を依頼する（最大LLM_REPAIR_MAX_ATTEMPTS回）。
+    - 必須列を含む表がない場合: 前回の出力と不足列を示し、表全体の出し直しを依頼する
+    - テストケース・期待結果が空欄の行がある場合: 該当行のみを示し、同じNoの行の修正を依頼する
+    修復後も必須列を含む表がない場合はSpecGenerationErrorを送出する（空欄の行はそのまま返す）。
+    修復の依頼はLLM応答キャッシュを参照しない（再実行時に、失敗した修復の応答を再利用しないため）。
+    on_row: 行を解析するたびに呼び出されるコールバック（進捗の通知に使用）
+    """
+    rows, problem, response_text = stream_unit_spec_rows(test_gen_prompt, use_cache, shared_prefix, on_row)
+    for attempt in range(1, llm_repair_max_attempts + 1):
+        invalid = find_invalid_spec_rows(rows) if problem is None else []
+        if problem is None and not invalid:
+            break
+        record_repair()
+        if problem is not None:
+            logging.warning(f"テスト仕様書の形式が不正なため、修復を依頼します（{attempt}回目）: {problem}")
+            repair_prompt = f'''
+            {test_gen_prompt}
+            --- 前回の出力 ---
+            {response_text}
+
+            --- 修正の依頼 ---
+            前回の出力は次の理由で不正です: {problem}
+            6列（{", ".join(UNIT_SPEC_COLUMN_MAP)}）のMarkdown表として、テスト仕様書全体を出力し直してください。
+            '''
+            rows, problem, response_text = stream_unit_spec_rows(repair_prompt, False, shared_prefix, on_row)
+            continue
+
+        logging.warning(f"テストケース・期待結果が空欄の行が{len(invalid)}件あるため、該当行の修復を依頼します（{attempt}回目）。")
+        repair_prompt = f'''
+            {test_gen_prompt}
+            --- 修正が必要な行 ---
+            {render_markdown_table(list(UNIT_SPEC_COLUMN_MAP), [rows[index] for index in invalid])}
+
+            --- 修正の依頼 ---
+            上記の行は{"・".join(UNIT_SPEC_REQUIRED_VALUES)}が空欄です。同じNoのまま空欄を埋めた行のみを、6列のMarkdown表で出力してください。
+            '''
+        repaired_rows, repair_problem, _ = stream_unit_spec_rows(repair_prompt, False, shared_prefix)
+        if repair_problem is not None:
+            logging.warning(f"修復の応答を解析できませんでした: {repair_problem}")
+            continue
+        repaired = {row["No"]: row for row in repaired_rows}
+        for index in invalid:
+            replacement = repaired.get(rows[index]["No"])
+            if replacement:
+                # 修復した行で空欄の値のみ補う（大区分・中区分などは元の行の値を優先する）
+                rows[index] = {col: rows[index][col] or replacement[col] for col in UNIT_SPEC_COLUMN_MAP}
+
+    if problem is not None:
+        raise SpecGenerationError(problem)
+    if invalid := find_invalid_spec_rows(rows):
+        logging.warning(f"テストケース・期待結果が空欄の行が{len(invalid)}件残っています。")
+    return rows
+
+def extract_validated_perspectives(prompt: str, use_cache: bool = True, shared_prefix: str | None = None) -> str:
+    """
+    テスト観点を抽出する。機能・処理単位の「## 」セクションがない場合は、前回の出力を示して修復を依頼する
+    （修復の依頼はLLM応答キャッシュを参照しない）。
+    """
+    perspectives_md = extract_test_perspectives(prompt, use_cache=use_cache, shared_prefix=shared_prefix)
+    for attempt in range(1, llm_repair_max_attempts + 1):
+        if split_markdown_sections(perspectives_md):
+            break
+        logging.warning(f"テスト観点に「## 」セクションがないため、修復を依頼します（{attempt}回目）。")
+        record_repair()
+        repair_prompt = f'''
+            {prompt}
+            --- 前回の出力 ---
+            {perspectives_md}
+
+            --- 修正の依頼 ---
+            前回の出力には機能・処理単位の「## 」セクションがありません。出力形式に従って、テスト観点全体を出力し直してください。
+            '''
+        perspectives_md = extract_test_perspectives(repair_prompt, use_cache=False, shared_prefix=shared_prefix)
+    return perspectives_md
+
+# 行の辞書からMarkdown表を組み立てる関数（セル内の「|」と改行はエスケープする）
+def render_markdown_table(columns: list[str], rows: list[dict[str, str]]) -> str:
+    def escape(value: str) -> str:
+        return value.replace("|", "\\|").replace("\n", "<br>")
+    lines = ["| " + " | ".join(columns) + " |", "|" + "|".join(["---"] * len(columns)) + "|"]
+    for row in rows:
+        lines.append("| " + " | ".join(escape(row.get(col, "")) for col in columns) + " |")
+    return "\n".join(lines) + "\n"
+
+# Markdownを「## 」見出し単位のセクションに分割する関数（見出しより前の文章は除外）
+def split_markdown_sections(md: str) -> list[str]:
+    return [part for part in re.split(r'(?m)^(?=## )', md) if part.startswith("## ")]
+
+def assign_perspectives_to_sections(design_sections: list[str], perspectives_md: str) -> list[str]:
+    """
+    テスト観点の各「## 」セクションを、見出しの語句が最も多く含まれる設計書セクションに割り当てる。
+    どの設計書セクションにも該当しない観点は、取りこぼしを防ぐため全セクションに含める。
+    戻り値: 設計書セクションと同じ順序の、テスト観点Markdownのリスト
+    """
+    assigned = [[] for _ in design_sections]
+    for section in split_markdown_sections(perspectives_md):
+        heading = section.splitlines()[0][3:].strip()
+        keywords = [word for word in re.split(r'[\s:：、。（）()「」【】/・]+', heading) if len(word) >= 2]
+        # 長い語句ほど一致の重みを大きくする
+        scores = [sum(len(word) for word in keywords if word in design) for design in design_sections]
+        best = max(scores, default=0)
+        if best == 0:
+            for perspectives in assigned:
+                perspectives.append(section)
+        else:
+            assigned[scores.index(best)].append(section)
+    return ["\n\n".join(perspectives) or "（該当するテスト観点なし）" for perspectives in assigned]
+
+# Markdown表のセル文字列をExcelへ書き込む値に変換する関数
+def to_cell_value(col_name: str, text: str):
+    # No列の数字のみ数値として書き込む（他の列は「001」等の表記をそのまま残す。「①」「²」等はint()で変換できないため除く）
+    if text == "":
+        return None
+    if col_name == "No" and text.isascii() and text.isdigit():
+        return int(text)
+    return text
+
+def load_template_workbook():
+    """
+    テスト仕様書テンプレートの複製を返す。
+    テンプレートの解析は数秒かかるため、ワーカーごとに初回のみ読み込み、以降はシリアライズ済みの内容から複製する。
+    """
+    return pickle.loads(get_template_workbook_bytes())
+
+def get_template_workbook_bytes() -> bytes:
+    # テンプレートを解析してシリアライズした内容を返す（初回のみ解析する。ウォームアップからも呼び出される）
+    global template_workbook_bytes
+    with template_workbook_lock:
+        if template_workbook_bytes is None:
+            from openpyxl import load_workbook
+            started = time.monotonic()
+            template_workbook_bytes = pickle.dumps(load_workbook(unit_test_template_path))
+            logging.info(f"テンプレートExcelを読み込みました（{time.monotonic() - started:.1f}秒）。")
+        return template_workbook_bytes
+
+def write_spec_rows(ws, rows: list[dict[str, str]], start_row: int):
+    """
+    テスト仕様書の行をstart_row行目から順にシートへ書き込む（空のセルは書き込まない）。
+    """
+    columns = list(UNIT_SPEC_COLUMN_MAP.items())
+    for row_index, row in enumerate(rows, start=start_row):
+        for col_name, excel_col in columns:
+            value = to_cell_value(col_name, row.get(col_name, ""))
+            if value is not None:
+                ws.cell(row=row_index, column=excel_col, value=value)
+
+@contextmanager
+def llm_task_executor(shared_executor: ThreadPoolExecutor | None = None):
+    """
+    シート・セクション単位のLLM呼び出しを実行するワーカーを返す。
+    shared_executorが指定された場合（バッチ処理）はそれを使い、同時実行数の上限を全設計書で共有する。
+    """
+    if shared_executor is not None:
+        yield shared_executor
+        return
+    with ThreadPoolExecutor(max_workers=llm_max_concurrency) as executor:
+        yield executor
+
+def run_in_parallel(executor: ThreadPoolExecutor | None, fn, items) -> list:
+    """
+    itemsの各要素にfnをexecutorで並列に適用し、入力順に結果を返す（executorがNoneの場合は順に実行する）。
+    executorのワーカー内から呼び出しても処理が詰まらないよう、まだ開始されていないタスクは呼び出し元のスレッドで実行する。
+    """
+    items = list(items)
+    if executor is None:
+        return [fn(item) for item in items]
+    futures = [executor.submit(bind_context(fn), item) for item in items]
+    try:
+        return [fn(item) if future.cancel() else future.result() for item, future in zip(items, futures)]
+    finally:
+        for future in futures:
+            future.cancel()
+
+def generate_unit_test(req: func.HttpRequest) -> func.HttpResponse:
+    try:
+        file = req.files.get("documentFile")
+        if not file:
+            return func.HttpResponse("ファイルがアップロードされていません", status_code=400)
         
-        zip_buffer.seek(0)
-        zip_bytes = zip_buffer.read()
-        logging.info("ZIPファイルの作成が完了しました。")
+        file_bytes = file.read()
+        filename = file.filename
+        use_cache = is_cache_requested(req)
+        # 差分再生成の元にする実行ID（省略時は同じファイル名の直近の実行）
+        previous_run_id = req.form.get("previousRunId") or None
         
-        output_filename = "結合テスト仕様書.zip"
-        encoded_filename = quote(output_filename)
-        headers = {
-            "Content-Disposition": f"attachment; filename*=UTF-8''{encoded_filename}",
-            "Content-Type": "application/zip",
-            "Access-Control-Expose-Headers": "Content-Disposition"
+        if not filename.endswith(('.xlsx', '.zip')):
+            return func.HttpResponse("Excelファイル(.xlsx)、またはExcelファイルをまとめたZIPファイル(.zip)のみ対応しています", status_code=400)
+
+    except Exception as e:
+        logging.error(f"ファイル取得エラー: {e}")
+        return func.HttpResponse("ファイルの取得に失敗しました", status_code=400)
+
+    if filename.endswith('.zip'):
+        # 複数の設計書をまとめたZIPはバッチ処理として一括で生成する
+        return generate_batch_unit_test(req, file_bytes, filename, use_cache)
+
+    logging.info(f"{filename} を受信しました。単体テスト生成を開始します。")
+
+    run_id = uuid.uuid4().hex
+
+    # 見積もりがメモリの上限を超える設計書は処理しない
+    memory_estimate = estimate_pipeline_memory(file_bytes)
+    if not memory_budget.fits(memory_estimate):
+        return func.HttpResponse(memory_budget.describe_excess(memory_estimate), status_code=413)
+
+    if is_async_requested(req):
+        # 待機中・実行中のジョブがアップロード内容をメモリに保持しないよう、一時ファイルに書き出す
+        upload_path = spill_upload(file_bytes, ".xlsx")
+        job_id = submit_job(
+            lambda progress, output: run_unit_test_pipeline(upload_path, filename, output, use_cache, progress, run_id, previous_run_id),
+            UNIT_TEST_STAGES,
+            input_paths=[upload_path],
+        )
+        return build_job_accepted_response(job_id, run_id)
+
+    try:
+        with open_artifact_output() as output:
+            output_filename = run_unit_test_pipeline(file_bytes, filename, output, use_cache, None, run_id, previous_run_id)
+            return build_zip_response(read_artifact(output), output_filename, run_id)
+
+    except SpecGenerationError as se:
+        # 完了した処理はチェックポイントとして保存済み（同じファイルを再アップロードすると続きから再開する）
+        headers = {"X-Run-Id": run_id, "Access-Control-Expose-Headers": "X-Run-Id"}
+        return func.HttpResponse(str(se), status_code=500, headers=headers)
+    except ValueError as ve:
+        logging.error(f"設定エラー: {ve}")
+        return func.HttpResponse(str(ve), status_code=500)
+    except Exception as e:
+        logging.error(f"処理全体で予期せぬエラーが発生: {e}")
+        return func.HttpResponse("処理中にサーバーエラーが発生しました", status_code=500)
+
+def run_unit_test_pipeline(source: bytes | Path, filename: str, output: IO[bytes], use_cache: bool = True, progress=None, run_id: str | None = None, previous_run_id: str | None = None, llm_executor: ThreadPoolExecutor | None = None) -> str:
+    """
+    単体テスト生成の全工程（構造化 → テスト観点 → テスト仕様書 → Excel → ZIP）を実行する。
+    source: 設計書（バイト列、または一時ファイルのパス）
+    output: 成果物のZIPを書き込むファイル（各成果物は完成した時点でZIPに書き込み、メモリ上に複製を残さない）
+    progress: ステージ開始時に呼び出されるコールバック（非同期ジョブの進捗更新に使用）
+    run_id: 今回の実行結果を保存する実行ID（Noneの場合は保存しない）
+    previous_run_id: 差分再生成の元にする実行ID（Noneの場合は同じファイル名の直近の実行）
+    llm_executor: シート・セクション単位のLLM呼び出しを実行するワーカー（バッチ処理で複数の設計書に共通のもの）
+    use_cacheがFalseの場合は前回の実行結果を再利用しない
+    戻り値: 返却用ファイル名
+    """
+    # 設計書の大きさから必要なメモリを見積もり、同時に実行中の生成全体で上限を超えないよう待機する
+    with memory_budget.reserve(estimate_pipeline_memory(source), filename):
+        with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as zip_file:
+            write_unit_test_artifacts(zip_file, source, filename, use_cache, progress, run_id, previous_run_id, llm_executor)
+    return f"テスト仕様書_{Path(filename).stem}.zip"
+
+def write_unit_test_artifacts(zip_file: zipfile.ZipFile, source: bytes | Path, filename: str, use_cache: bool, progress, run_id: str | None, previous_run_id: str | None, llm_executor: ThreadPoolExecutor | None):
+    # アップロードされたExcelファイルを読み込み、全シートを辞書形式で取得
+    # すべてのシートが {シート名: DataFrame} の形式で格納される
+    metrics = PipelineMetrics("unit_test")
+    notify_progress(progress, "structuring")
+    metrics.start_stage("read")
+    excel_data = read_excel_sheets(source)
+    sheet_names = list(excel_data.keys())
+    base_name = Path(filename).stem
+
+    # Markdown構造化のためのリスト初期化
+    toc_list = [] # 目次(Table of Contents)用のリスト
+
+    # 目次はシート順に生成
+    for sheet_name in sheet_names:
+        # 目次用のアンカーを生成 (GitHub-flavored)
+        anchor = re.sub(r'[^a-z0-9-]', '', sheet_name.strip().lower().replace(' ', '-'))
+        toc_list.append(f'- [{sheet_name}](#{anchor})')
+
+    # --- 前回の実行結果の読み込み（差分再生成） ---
+    # シート内容の指紋が一致するシートは、前回の構造化結果とテストケースを再利用する
+    previous_run = load_previous_run(filename, previous_run_id) if use_cache else None
+    previous_sheets = {sheet["name"]: sheet for sheet in previous_run["sheets"]} if previous_run else {}
+    previous_shards = {shard["fingerprint"]: shard["rows"] for shard in previous_run["shards"]} if previous_run else {}
+
+    # DataFrameをテキスト化（セル区切りを明示）し、指紋を計算
+    sheet_texts = {}
+    sheet_fingerprints = {}
+    for sheet_name, df in excel_data.items():
+        raw_text = serialize_sheet(df)
+        logging.info(f"「{sheet_name}」シートをテキスト化しました（{len(raw_text)}文字、推定{estimate_tokens(raw_text)}トークン）。")
+        sheet_texts[sheet_name] = raw_text
+        sheet_fingerprints[sheet_name] = compute_fingerprint(sheet_name, raw_text)
+    # 以降はテキストのみを使用するため、DataFrameは解放する
+    del excel_data
+
+    # --- 重複シート・定型シートの検出 ---
+    # 定型シートはLLMで構造化せず、内容が同じシートは先頭のシートの構造化結果を再利用する
+    boilerplate_signatures = {}  # シート名 → 一致した定型シートの定義
+    duplicate_of = {}  # シート名 → 内容が同じ先頭のシート名
+    content_keys = {}  # シート名 → 正規化した内容のキャッシュキー（設計書間での再利用に使用）
+    first_sheet_by_content = {}
+    for sheet_name in sheet_names:
+        signature = match_sheet_signature(sheet_name, sheet_texts[sheet_name])
+        if signature:
+            logging.info(f"「{sheet_name}」シートは定型シート（{signature['name']}）のため、AIによる構造化とテストケース生成を省略します。")
+            boilerplate_signatures[sheet_name] = signature
+        elif sheet_dedup_enabled:
+            content_keys[sheet_name] = get_structured_content_cache_key(normalize_sheet_text(sheet_texts[sheet_name]))
+            original = first_sheet_by_content.setdefault(content_keys[sheet_name], sheet_name)
+            if original != sheet_name:
+                logging.info(f"「{sheet_name}」シートは「{original}」シートと内容が同じため、構造化結果を再利用します。")
+                duplicate_of[sheet_name] = original
+    metrics.root.attributes.update(duplicateSheets=len(duplicate_of), boilerplateSheets=len(boilerplate_signatures))
+    # シートごとの構造化結果（内容が同じシートは先頭のシートの結果を待って再利用する）
+    structured_futures = {sheet_name: Future() for sheet_name in sheet_names}
+
+    # --- チェックポイント（途中経過の保存） ---
+    # 完了した構造化結果・テスト観点・テストケースをその都度ジャーナルへ追記し、
+    # 後続の処理で失敗した場合も、再実行時は完了した処理を再利用して続きから再開できるようにする
+    checkpoint = {"sheets": {}, "perspectives": {}, "shards": {}}
+    checkpoint_lock = threading.Lock()
+    journal_lock = threading.Lock()
+
+    def build_sheet_record(sheet_name: str) -> dict:
+        # 構造化に失敗したシートは次回の再利用対象にしない
+        md_sheet = checkpoint["sheets"][sheet_name]
+        succeeded = not md_sheet.endswith(STRUCTURING_FAILED_NOTE)
+        return {
+            "name": sheet_name,
+            "fingerprint": sheet_fingerprints[sheet_name],
+            "structured": md_sheet if succeeded else None,
+            # セクション単位のパイプラインで抽出したテスト観点（設計書全体から抽出した場合はNone）
+            "perspectives": checkpoint["perspectives"].get(sheet_name) if succeeded else None,
         }
-        return func.HttpResponse(zip_bytes, status_code=200, headers=headers)
 
+    def build_run_record(status: str) -> dict:
+        sheets = []
+        for sheet_name in sheet_names:
+            previous_sheet = previous_sheets.get(sheet_name)
+            if sheet_name in checkpoint["sheets"]:
+                sheets.append(build_sheet_record(sheet_name))
+            elif previous_sheet and previous_sheet["fingerprint"] == sheet_fingerprints[sheet_name]:
+                # 今回の実行でまだ完了していないシートは、前回の結果を引き継ぐ
+                sheets.append(previous_sheet)
+        shards = [{"fingerprint": fingerprint, "rows": rows} for fingerprint, rows in checkpoint["shards"].items()]
+        shards += [
+            {"fingerprint": fingerprint, "rows": rows}
+            for fingerprint, rows in previous_shards.items()
+            if fingerprint in sheet_fingerprints.values() and fingerprint not in checkpoint["shards"]
+        ]
+        return {"runId": run_id, "filename": filename, "createdAt": time.time(), "status": status, "sheets": sheets, "shards": shards}
+
+    def save_checkpoint(status: str = "partial", **updates):
+        # updates: 完了した処理の結果（sheets/perspectives/shardsごとの {キー: 値}）
+        # 途中経過は完了した分のみをジャーナルへ追記し、完了時に実行結果全体を1回だけ書き込む
+        if not run_id:
+            return
+        if status == "completed":
+            with checkpoint_lock:
+                run = build_run_record(status)
+            save_run(run)
+            return
+        entries = []
+        with checkpoint_lock:
+            for key, values in updates.items():
+                checkpoint[key].update(values)
+                for name in values:
+                    entries.append({"shard": {"fingerprint": name, "rows": values[name]}} if key == "shards" else {"sheet": build_sheet_record(name)})
+        if checkpoint_enabled:
+            append_run_journal(run_id, entries, journal_lock)
+
+    if run_id and checkpoint_enabled:
+        start_run_journal(build_run_record("partial"))
+
+    # 進捗の通知（セクションごとの処理は並行して進むため、全セクションが完了した段階を実行中のステージとして通知する）
+    completed = {"structuring": 0, "perspectives": 0, "rows": 0}
+    completed_lock = threading.Lock()
+    def on_completed(key: str, count: int = 1):
+        with completed_lock:
+            completed[key] += count
+            if completed["structuring"] < len(sheet_names):
+                notify_progress(progress, "structuring", f"{completed['structuring']}/{len(sheet_names)}シートを構造化済み")
+            elif completed["perspectives"] < len(sheet_names):
+                notify_progress(progress, "perspectives", f"{completed['perspectives']}/{len(sheet_names)}セクションのテスト観点を抽出済み")
+            else:
+                notify_progress(progress, "spec", f"{completed['rows']}件のテストケースを生成済み")
+
+    def structure_distinct_sheet(sheet_name: str, span) -> str:
+        # 他の設計書（または別名のシート）で構造化済みの内容であれば、見出しのみ置き換えて再利用する
+        heading = f"## {sheet_name}\n\n"
+        content_key = content_keys.get(sheet_name) if use_cache and llm_cache_enabled else None
+        if content_key:
+            cached = read_llm_cache(content_key)
+            if cached is not None:
+                logging.info(f"「{sheet_name}」シートは構造化済みの内容と同じため、構造化結果を再利用します。")
+                span.attributes["reusedContent"] = True
+                return heading + cached
+        # 大きなシートのウィンドウは、シート・セクション単位の処理と同じワーカーで並列に構造化する
+        md_sheet = structure_sheet(sheet_name, sheet_texts[sheet_name], use_cache=use_cache, executor=executor)
+        if content_key and not md_sheet.endswith(STRUCTURING_FAILED_NOTE):
+            write_llm_cache(content_key, md_sheet.removeprefix(heading))
+        return md_sheet
+
+    def structure_or_reuse(sheet_name: str) -> str:
+        try:
+            with metrics.span("structuring.sheet", sheet=sheet_name) as span:
+                previous_sheet = previous_sheets.get(sheet_name)
+                if previous_sheet and previous_sheet["fingerprint"] == sheet_fingerprints[sheet_name] and previous_sheet["structured"]:
+                    logging.info(f"「{sheet_name}」シートは前回から変更がないため、構造化結果を再利用します。")
+                    span.attributes["reused"] = True
+                    md_sheet = previous_sheet["structured"]
+                elif sheet_name in boilerplate_signatures:
+                    span.attributes["boilerplate"] = boilerplate_signatures[sheet_name]["name"]
+                    md_sheet = render_boilerplate_sheet(sheet_name, sheet_texts[sheet_name], boilerplate_signatures[sheet_name])
+                elif sheet_name in duplicate_of:
+                    # 先頭のシートは先に実行を開始しているため、その完了を待っても処理は詰まらない
+                    original = duplicate_of[sheet_name]
+                    span.attributes["duplicateOf"] = original
+                    md_sheet = f"## {sheet_name}\n\n" + structured_futures[original].result().removeprefix(f"## {original}\n\n")
+                else:
+                    md_sheet = structure_distinct_sheet(sheet_name, span)
+        except Exception as e:
+            structured_futures[sheet_name].set_exception(e)
+            raise
+        structured_futures[sheet_name].set_result(md_sheet)
+        save_checkpoint(sheets={sheet_name: md_sheet})
+        on_completed("structuring")
+        return md_sheet
+
+    def assemble_design(md_sheets: list[str]) -> str:
+        # 目次と全シートの構造化結果を結合して、最終的なMarkdown設計書を生成する
+        md_output = f"# {filename}\n\n"
+        md_output += "## 目次\n\n"
+        md_output += "\n".join(toc_list)
+        md_output += "\n\n---\n\n"
+        md_output += "\n\n---\n\n".join(md_sheets)
+        return md_output
+
+    def generate_rows(test_gen_prompt: str, shared_prefix: str | None, fingerprint: str | None) -> list[dict[str, str]]:
+        if fingerprint in previous_shards:
+            logging.info("前回から変更がないセクションのため、テストケースを再利用します。")
+            rows = [dict(row) for row in previous_shards[fingerprint]]
+            on_completed("rows", len(rows))
+        else:
+            rows = generate_unit_spec_rows(test_gen_prompt, use_cache=use_cache, shared_prefix=shared_prefix, on_row=lambda: on_completed("rows"))
+        if fingerprint is not None:
+            save_checkpoint(shards={fingerprint: [dict(row) for row in rows]})
+        return rows
+
+    # 構造化に成功したシートの指紋（次回の再利用対象。設計書の内容が同じなら前回のテストケースを再利用する）
+    def section_fingerprint(sheet_name: str, md_sheet: str) -> str | None:
+        return None if md_sheet.endswith(STRUCTURING_FAILED_NOTE) else sheet_fingerprints[sheet_name]
+
+    # テスト仕様書の行は、セクションとそれより前のセクションがすべて完了した時点で設計書の順序にテンプレートへ書き込む
+    # （Noの通し番号は前のセクションの件数が確定しないと決まらないため、セクション単位で順に書き込む）
+    wb = load_template_workbook()
+    spec_rows = []
+
+    def append_shard_rows(shard_rows: list[dict[str, str]]):
+        start_row = 11 + len(spec_rows)
+        for row in shard_rows:
+            # トレース元などはそのままに、Noのみ全体の通し番号に振り直す
+            row["No"] = str(len(spec_rows) + 1)
+            spec_rows.append(row)
+        # 既存テンプレートの複製に、表の行をA11,B11,F11,J11,W11,AP11から順に書き込み
+        write_spec_rows(wb.active, shard_rows, start_row=start_row)
+
+    if section_pipeline_enabled and spec_sharding_enabled and len(sheet_names) > 1:
+        # --- 1〜3. セクション単位のパイプライン ---
+        # シートごとに「構造化 → そのセクションのテスト観点抽出 → テストケース生成」を1つのタスクとして実行し、
+        # 他のシートの完了を待たずに次の処理へ進む（テストケースは設計書の順序でテンプレートへ書き込む）
+        def run_section(index: int) -> tuple[str | None, str | None, list[dict[str, str]]]:
+            sheet_name = sheet_names[index]
+            md_sheet = structure_or_reuse(sheet_name)
+            if sheet_name in boilerplate_signatures:
+                # 定型シートはテスト観点抽出・テストケース生成の対象にしない
+                on_completed("perspectives")
+                return None, None, []
+            fingerprint = section_fingerprint(sheet_name, md_sheet)
+
+            # テスト観点抽出とテストケース生成で同じ先頭部分（このセクションの設計書）を使い、プロンプトキャッシュを再利用する
+            section_context = f"--- 設計書 ---\n# {filename}\n\n{md_sheet}"
+            with metrics.span("perspectives.section", section=index + 1) as span:
+                previous_sheet = previous_sheets.get(sheet_name)
+                if fingerprint and previous_sheet and previous_sheet["fingerprint"] == fingerprint and previous_sheet.get("perspectives"):
+                    logging.info(f"「{sheet_name}」シートは前回から変更がないため、テスト観点を再利用します。")
+                    span.attributes["reused"] = True
+                    perspectives_md = previous_sheet["perspectives"]
+                else:
+                    perspectives_md = extract_validated_perspectives("上記の設計書からテスト観点を抽出してください。", use_cache=use_cache, shared_prefix=section_context)
+            if fingerprint:
+                save_checkpoint(perspectives={sheet_name: perspectives_md})
+            on_completed("perspectives")
+
+            with metrics.span("spec.section", section=index + 1) as span:
+                test_gen_prompt = f'''
+            --- テスト観点 ---
+            {perspectives_md}
+            '''
+                rows = generate_rows(test_gen_prompt, section_context, fingerprint)
+                span.attributes["rows"] = len(rows)
+            return perspectives_md, fingerprint, rows
+
+        metrics.start_stage("sections")
+        metrics.stage.attributes["sections"] = len(sheet_names)
+        logging.info(f"{len(sheet_names)}セクションの構造化・テスト観点抽出・テスト仕様書生成を、最大{llm_max_concurrency}並列でセクションごとに実行します。")
+        with llm_task_executor(llm_executor) as executor:
+            section_futures = [executor.submit(bind_context(run_section), index) for index in range(len(sheet_names))]
+
+            # 全シートの構造化が完了した時点で構造化設計書を書き込む（後続の処理は完了したセクションから進行中）
+            md_sheets = [structured_futures[sheet_name].result() for sheet_name in sheet_names]
+            md_output_first = assemble_design(md_sheets)
+            zip_file.writestr(f"{base_name}_構造化設計書.md", md_output_first.encode('utf-8'))
+            logging.info("Markdown設計書を生成しました。")
+
+            section_results = []
+            for future in section_futures:
+                section_results.append(future.result())
+                append_shard_rows(section_results[-1][2])
+
+        md_output_second = "\n\n".join(perspectives_md for perspectives_md, _, _ in section_results if perspectives_md)
+        zip_file.writestr(f"{base_name}_テスト観点.md", md_output_second.encode('utf-8'))
+        logging.info("テスト観点抽出が完了しました。")
+
+    else:
+        # --- 各シートを並列にAIで構造化 ---
+        # executor.mapは入力順に結果を返すため、シート順は維持される
+        metrics.start_stage("structuring")
+        logging.info(f"{len(sheet_names)}シートを最大{llm_max_concurrency}並列でAIにより構造化します。")
+        with llm_task_executor(llm_executor) as executor:
+            md_sheets = list(executor.map(bind_context(structure_or_reuse), sheet_names))
+
+        # --- 1. 全体を結合して最終的なMarkdown設計書を生成 ---
+        logging.info("全シートの処理が完了。最終的な設計書を組み立てます。")
+        md_output_first = assemble_design(md_sheets)
+        zip_file.writestr(f"{base_name}_構造化設計書.md", md_output_first.encode('utf-8'))
+        logging.info("Markdown設計書を生成しました。")
+
+        # --- 2. AIによるテスト観点抽出 ---
+        notify_progress(progress, "perspectives")
+        metrics.start_stage("perspectives")
+        logging.info("設計書全体をAIに渡し、テスト観点を抽出します。")
+        # 設計書全体はテスト仕様書の生成でも同じ内容を先頭に置き、プロバイダ側のプロンプトキャッシュを再利用する
+        design_context = f"--- 設計書 ---\n{md_output_first}"
+        extract_test_perspectives_prompt = "上記の設計書からテスト観点を抽出してください。"
+        md_output_second = extract_validated_perspectives(extract_test_perspectives_prompt, use_cache=use_cache, shared_prefix=design_context)
+        zip_file.writestr(f"{base_name}_テスト観点.md", md_output_second.encode('utf-8'))
+        logging.info("テスト観点抽出が完了しました。")
+        on_completed("perspectives", len(sheet_names))
+
+        # --- 3. AIによるテスト仕様書生成（セクション単位で並列生成） ---
+        # 設計書のシート（## セクション）ごとに対応するテスト観点と組にして並列に生成し、
+        # 設計書の順序でテンプレートへ書き込み、Noを通し番号に振り直す
+        notify_progress(progress, "spec")
+        metrics.start_stage("spec")
+        fingerprints = [section_fingerprint(sheet_name, md_sheet) for sheet_name, md_sheet in zip(sheet_names, md_sheets)]
+        if spec_sharding_enabled and len(md_sheets) > 1:
+            # 定型シートのセクションはテストケース生成の対象にしない
+            # （先に除外してからテスト観点を割り当て、定型シートに一致した観点が捨てられないようにする）
+            content_sections = [
+                (md_sheet, fingerprint)
+                for sheet_name, md_sheet, fingerprint in zip(sheet_names, md_sheets, fingerprints)
+                if sheet_name not in boilerplate_signatures
+            ]
+            content_perspectives = assign_perspectives_to_sections([md_sheet for md_sheet, _ in content_sections], md_output_second)
+            shards = [
+                (md_sheet, perspectives_md, fingerprint)
+                for (md_sheet, fingerprint), perspectives_md in zip(content_sections, content_perspectives)
+            ]
+        else:
+            combined_fingerprint = compute_fingerprint(*fingerprints) if all(fingerprints) else None
+            # 分割しない場合は設計書全体（design_context）を使用する
+            shards = [(None, md_output_second, combined_fingerprint)]
+        logging.info(f"テスト仕様書を{len(shards)}セクションに分割し、最大{llm_max_concurrency}並列で生成します。")
+
+        def generate_shard(index: int) -> tuple[str | None, list[dict[str, str]]]:
+            design_md, perspectives_md, fingerprint = shards[index]
+            with metrics.span("spec.section", section=index + 1) as span:
+                if design_md is None:
+                    # 設計書全体はテスト観点抽出と同じ先頭部分として送信する（プロンプトキャッシュの対象）
+                    shared_prefix = design_context
+                    test_gen_prompt = f'''
+            --- テスト観点 ---
+            {perspectives_md}
+            '''
+                else:
+                    shared_prefix = None
+                    test_gen_prompt = f'''
+            --- 設計書 ---
+            # {filename}
+
+            {design_md}
+            
+            --- テスト観点 ---
+            {perspectives_md}
+            '''
+                rows = generate_rows(test_gen_prompt, shared_prefix, fingerprint)
+                span.attributes["rows"] = len(rows)
+                return fingerprint, rows
+
+        # executor.mapは設計書の順序で結果を返すため、先頭のセクションから順に書き込まれる
+        with llm_task_executor(llm_executor) as executor:
+            for _, shard_rows in executor.map(bind_context(generate_shard), range(len(shards))):
+                append_shard_rows(shard_rows)
+
+    logging.info(f"テスト仕様書の生成が完了しました（{len(spec_rows)}件）。")
+    metrics.root.attributes["testCases"] = len(spec_rows)
+
+    if not spec_rows:
+        logging.error("テスト仕様書にMarkdown表が見つかりませんでした")
+        raise SpecGenerationError("テスト仕様書の生成に失敗しました（表形式が見つかりません）")
+
+    zip_file.writestr(f"{base_name}_テスト仕様書.md", render_markdown_table(list(UNIT_SPEC_COLUMN_MAP), spec_rows).encode('utf-8'))
+
+    # 今回の実行結果を保存（次回の差分再生成で使用）
+    save_checkpoint("completed")
+
+    # --- 4. テスト仕様書をExcelとして保存 ---
+    notify_progress(progress, "excel")
+    metrics.start_stage("excel")
+
+    # ZIP内のファイルへ直接保存する（Excelのバイト列をメモリ上に複製しない）
+    with zip_file.open(f"{base_name}_テスト仕様書.xlsx", "w") as excel_file:
+        wb.save(excel_file)
+    del wb
+    logging.info("テンプレートExcelへの書き込みが完了しました。")
+
+    # --- 5. ZIPファイルを仕上げる ---
+    # 構造化設計書・テスト観点・テスト仕様書は各ステージで書き込み済み。計測結果は全ステージの終了後に追加する
+    notify_progress(progress, "zip")
+    metrics.start_stage("zip")
+    write_metrics_to_zip(zip_file, metrics)
+    logging.info("ZIPファイルの作成が完了しました。")
+
+# --- 結合テストの対象画面の索引（画面遷移データの絞り込み） ---
+# 画面IDを表す項目名（全角は正規化してから判定する）
+SCREEN_ID_LABEL = re.compile(r"画面(?:ID|番号|コード)")
+SCREEN_NAME_LABEL = re.compile(r"画面名(?:称)?")
+# 「画面ID: XXX」「**画面名**：XXX」形式の記載
+SCREEN_KEY_VALUE = re.compile(r"(画面(?:ID|番号|コード)|画面名(?:称)?)[*_\s]*[:：][*_\s]*([^\s|、,]+)")
+# 「## 2.1 ユーザー登録画面」形式の見出し
+SCREEN_HEADING = re.compile(r"^#{1,6}\s+(?:[\d.]+\s*)?(\S.*画面)\s*$")
+SCREEN_ID_VALUE = re.compile(r"[A-Za-z0-9][A-Za-z0-9_-]+")
+# 画面名として扱わない一般的な語（「関連画面」などの見出し）
+GENERIC_SCREEN_NAME = re.compile(r"(?:関連|対象|遷移先|遷移元|共通|各|全|前|次)?画面(?:一覧|遷移)?")
+# 画面遷移データの見出し行（対象画面を含まなくても残す）
+TRANSITION_HEADER_LABEL = re.compile(r"画面(?:ID|番号|コード)|画面名|遷移元|遷移先")
+
+def build_screen_index(structured_design_md: str) -> tuple[set[str], set[str]]:
+    """
+    構造化詳細設計書から、記載されている画面の画面IDと画面名を抽出する（LLMは使用しない）。
+    - 列名が「画面ID」「画面名」などの表の列
+    - 「| 画面ID | XXX |」形式の項目・値の表、「画面ID: XXX」形式の記載
+    - 「画面」で終わる見出し
+    戻り値: (画面IDの集合, 画面名の集合)
+    """
+    screen_ids = set()
+    screen_names = set()
+
+    def add_name(name: str):
+        if len(name) < 2 or GENERIC_SCREEN_NAME.fullmatch(name):
+            return
+        screen_names.add(name)
+        # 遷移図では「画面」を省略した名前（「ユーザー登録画面」→「ユーザー登録」）で記載される場合もある
+        if name.endswith("画面") and len(name) >= 4:
+            screen_names.add(name[:-2])
+
+    def add(label: str, value: str):
+        value = value.strip().strip("*_`「」").strip()
+        if SCREEN_ID_LABEL.fullmatch(label):
+            if SCREEN_ID_VALUE.fullmatch(value):
+                screen_ids.add(value)
+        else:
+            add_name(value)
+
+    lines = unicodedata.normalize("NFKC", structured_design_md).splitlines()
+    columns = None  # 表の列のうち、画面ID・画面名の列 {列番号: 列名}
+    for index, line in enumerate(lines):
+        stripped = line.strip()
+        if not stripped.startswith("|"):
+            columns = None
+            heading = SCREEN_HEADING.match(stripped)
+            if heading:
+                add_name(heading.group(1).strip())
+            for label, value in SCREEN_KEY_VALUE.findall(stripped):
+                add(label, value)
+            continue
+
+        cells = [normalize_header_cell(cell) for cell in split_markdown_row(stripped)]
+        next_cells = split_markdown_row(lines[index + 1]) if index + 1 < len(lines) and lines[index + 1].strip().startswith("|") else []
+        if next_cells and is_separator_row(next_cells):
+            # 見出し行: 画面ID・画面名の列を記録する
+            columns = {
+                i: cell for i, cell in enumerate(cells)
+                if SCREEN_ID_LABEL.fullmatch(cell) or SCREEN_NAME_LABEL.fullmatch(cell)
+            }
+            continue
+        if is_separator_row(cells):
+            continue
+        if columns:
+            for i, label in columns.items():
+                if i < len(cells):
+                    add(label, cells[i])
+        # 「| 画面ID | XXX |」のような項目・値の組
+        for i, cell in enumerate(cells[:-1]):
+            if SCREEN_ID_LABEL.fullmatch(cell) or SCREEN_NAME_LABEL.fullmatch(cell):
+                add(cell, cells[i + 1])
+
+    return screen_ids, screen_names
+
+def compile_screen_pattern(screen_ids: set[str], screen_names: set[str]) -> re.Pattern | None:
+    # 画面IDは英数字の区切りで一致するもの（SCR001とSCR0010を区別する）、画面名は部分一致で判定する
+    alternatives = []
+    if screen_ids:
+        ids = "|".join(re.escape(screen_id) for screen_id in sorted(screen_ids, key=len, reverse=True))
+        alternatives.append(f"(?<![A-Za-z0-9])(?:{ids})(?![A-Za-z0-9])")
+    if screen_names:
+        alternatives.extend(re.escape(name) for name in sorted(screen_names, key=len, reverse=True))
+    return re.compile("|".join(alternatives)) if alternatives else None
+
+def filter_transition_sheet(df: "pd.DataFrame", screen_pattern: re.Pattern) -> "pd.DataFrame | None":
+    """
+    画面一覧/画面遷移図のシートから、対象画面を含む行と見出し行のみを残す。
+    先頭列が空の行（セル結合された遷移元の続きなど）は、直前の行と同じ扱いにする。
+    対象画面を含む行がない場合はNoneを返す。
+    """
+    text_df = df.fillna("").astype(str)
+    row_texts = text_df.agg("\t".join, axis=1).map(lambda text: unicodedata.normalize("NFKC", text))
+    non_empty = text_df.apply(lambda col: col.str.strip() != "")
+    has_value = non_empty.any(axis=1)
+    if not has_value.any():
+        return None
+    first_columns = non_empty.values.argmax(axis=1)
+    leftmost = first_columns[has_value.values].min()
+
+    keep = []
+    matched_any = False
+    header_seen = False
+    parent_kept = False
+    for text, first_column, row_has_value in zip(row_texts, first_columns, has_value):
+        if not row_has_value:
+            keep.append(False)
+            continue
+        if not header_seen or TRANSITION_HEADER_LABEL.search(text):
+            # 最初の行と、列名を含む行は見出しとして残す
+            header_seen = True
+            keep.append(True)
+            parent_kept = False
+            continue
+        matched = screen_pattern.search(text) is not None
+        if first_column > leftmost:
+            matched = matched or parent_kept
+        else:
+            parent_kept = matched
+        matched_any = matched_any or matched
+        keep.append(matched)
+
+    if not matched_any:
+        return None
+    return df[keep]
+
+def prune_transition_sheets(transition_data: dict[str, "pd.DataFrame"], structured_design_md: str, metrics: PipelineMetrics) -> list[tuple[str, str]]:
+    """
+    画面一覧/画面遷移図の各シートをテキスト化し、対象画面を含まない行・シートを除外する。
+    構造化詳細設計書から画面を抽出できない場合や、対象画面を含むシートがない場合は除外しない。
+    戻り値: [(シート名, テキスト), ...]
+    """
+    def serialize_all() -> list[tuple[str, str]]:
+        return [(sheet_name, serialize_sheet(df)) for sheet_name, df in transition_data.items()]
+
+    screen_ids, screen_names = build_screen_index(structured_design_md)
+    screen_pattern = compile_screen_pattern(screen_ids, screen_names)
+    if not transition_filter_enabled or screen_pattern is None:
+        if transition_filter_enabled:
+            logging.warning("構造化詳細設計書から画面ID・画面名を抽出できなかったため、画面遷移データを絞り込まずに使用します。")
+        sheets = serialize_all()
+    else:
+        logging.info(f"構造化詳細設計書から画面ID{len(screen_ids)}件、画面名{len(screen_names)}件を抽出しました。")
+        sheets = []
+        for sheet_name, df in transition_data.items():
+            filtered = filter_transition_sheet(df, screen_pattern)
+            if filtered is None:
+                logging.info(f"「{sheet_name}」シートは対象画面を含まないため除外します。")
+                continue
+            logging.info(f"「{sheet_name}」シートを{len(df)}行から{len(filtered)}行に絞り込みました。")
+            sheets.append((sheet_name, serialize_sheet(filtered)))
+        if not sheets:
+            logging.warning("対象画面を含むシートが見つからなかったため、画面遷移データを絞り込まずに使用します。")
+            sheets = serialize_all()
+
+    for sheet_name, raw_text in sheets:
+        logging.info(f"「{sheet_name}」シートをテキスト化しました（{len(raw_text)}文字、推定{estimate_tokens(raw_text)}トークン）。")
+    metrics.stage.attributes.update(
+        screenIds=len(screen_ids),
+        screenNames=len(screen_names),
+        sheets=len(transition_data),
+        sheetsKept=len(sheets),
+        rows=sum(len(df) for df in transition_data.values()),
+        estimatedTokens=sum(estimate_tokens(raw_text) for _, raw_text in sheets),
+    )
+    return sheets
+
+def generate_integration_test(req: func.HttpRequest) -> func.HttpResponse:
+    try:
+        structured_design_files = req.files.getlist("structuredDesignFiles")
+        transition_diagram_file = req.files.get("transitionDiagramFile")
+        use_cache = is_cache_requested(req)
+        
+        if not structured_design_files or not transition_diagram_file:
+            return func.HttpResponse("必須ファイルが不足しています", status_code=400)
+
+        # バックグラウンド実行でも参照できるよう、リクエスト中にファイル内容を取得しておく
+        structured_designs = [(design_file.filename, design_file.read()) for design_file in structured_design_files]
+        transition_bytes = transition_diagram_file.read()
+            
+    except Exception as e:
+        logging.error(f"ファイル取得エラー: {e}")
+        return func.HttpResponse("ファイルの取得に失敗しました", status_code=400)
+
+    logging.info("結合テスト生成を開始します。")
+
+    if is_async_requested(req):
+        # 待機中・実行中のジョブがアップロード内容をメモリに保持しないよう、一時ファイルに書き出す
+        design_paths = [(design_filename, spill_upload(design_bytes, ".md")) for design_filename, design_bytes in structured_designs]
+        transition_path = spill_upload(transition_bytes, ".xlsx")
+        job_id = submit_job(
+            lambda progress, output: run_integration_test_pipeline(design_paths, transition_path, output, use_cache, progress),
+            INTEGRATION_TEST_STAGES,
+            input_paths=[path for _, path in design_paths] + [transition_path],
+        )
+        return build_job_accepted_response(job_id)
+
+    try:
+        with open_artifact_output() as output:
+            output_filename = run_integration_test_pipeline(structured_designs, transition_bytes, output, use_cache)
+            return build_zip_response(read_artifact(output), output_filename)
+
+    except ValueError as ve:
+        logging.error(f"設定エラー: {ve}")
+        return func.HttpResponse(str(ve), status_code=500)
+    except Exception as e:
+        logging.error(f"処理全体で予期せぬエラーが発生: {e}")
+        return func.HttpResponse("処理中にサーバーエラーが発生しました", status_code=500)
+
+def run_integration_test_pipeline(structured_designs: list[tuple[str, bytes | Path]], transition_source: bytes | Path, output: IO[bytes], use_cache: bool = True, progress=None) -> str:
+    """
+    結合テスト生成の全工程（画面関連情報の構造化 → 結合テスト仕様書 → ZIP）を実行する。
+    structured_designs: (ファイル名, 内容またはファイルのパス) の一覧
+    transition_source: 画面一覧/画面遷移図の内容、またはファイルのパス（非同期ジョブの場合）
+    output: 成果物のZIPを書き込むファイル
+    progress: ステージ開始時に呼び出されるコールバック（非同期ジョブの進捗更新に使用）
+    戻り値: 返却用ファイル名
+    """
+    metrics = PipelineMetrics("integration_test")
+
+    # 複数の構造化詳細設計書を読み込み、結合
+    structured_design_md = ""
+    for design_filename, design_source in structured_designs:
+        content = (design_source if isinstance(design_source, bytes) else design_source.read_bytes()).decode('utf-8')
+        structured_design_md += f"\n\n# {design_filename}\n\n{content}\n\n---\n\n"
+    logging.info(f"{len(structured_designs)}件の構造化詳細設計書を読み込みました。")
+    
+    # 画面一覧/画面遷移図を読み込み、AIで構造化
+    notify_progress(progress, "structuring_transition")
+    logging.info("画面一覧/画面遷移図（Excel）をAIで構造化します。")
+    metrics.start_stage("read")
+    transition_data = read_excel_sheets(transition_source)
+
+    # 構造化詳細設計書に記載された画面を含まない行・シートは、LLMへ渡す前に除外する
+    metrics.start_stage("screen_filter")
+    transition_sheets = prune_transition_sheets(transition_data, structured_design_md, metrics)
+
+    def structure_transition_sheet(sheet: tuple[str, str]) -> str:
+        sheet_name, raw_text = sheet
+        with metrics.span("structuring_transition.sheet", sheet=sheet_name):
+            prompt = f'--- 画面一覧/画面遷移図「{sheet_name}」 ---\n{raw_text}'
+            return f"## {sheet_name}\n\n{structuring_transition(prompt, use_cache=use_cache)}\n\n"
+
+    # シートごとの構造化は並列に実行する（executor.mapはシート順に結果を返す）
+    metrics.start_stage("structuring_transition")
+    with llm_task_executor() as executor:
+        transition_md = "".join(executor.map(bind_context(structure_transition_sheet), transition_sheets))
+    logging.info("画面一覧/画面遷移図の構造化が完了しました。")
+    
+    # 結合テスト仕様書を直接生成
+    notify_progress(progress, "spec")
+    metrics.start_stage("spec")
+    logging.info("結合テスト仕様書を生成します。")
+    # 構造化詳細設計書は先頭に置き、再生成時などにプロバイダ側のプロンプトキャッシュを再利用する
+    design_context = f"--- 構造化詳細設計書 ---\n{structured_design_md}"
+    test_spec_prompt = f'''
+        --- 画面一覧/画面遷移図 ---
+        {transition_md}
+    '''
+    test_spec_md = create_integration_test_spec(test_spec_prompt, use_cache=use_cache, shared_prefix=design_context)
+
+    # 表を10列に整形し直す（セル内の「|」や区切り行の揺れを吸収する）。表を解析できない場合は応答をそのまま出力する
+    try:
+        spec_rows = list(iter_integration_spec_rows(iter_lines(iter([test_spec_md]))))
+        test_spec_md = render_markdown_table(INTEGRATION_SPEC_COLUMNS, spec_rows)
+        logging.info(f"結合テスト仕様書の生成が完了しました（{len(spec_rows)}件）。")
+    except SpecGenerationError as se:
+        logging.warning(f"結合テスト仕様書の表を解析できなかったため、応答をそのまま出力します: {se}")
+    
+    # ZIPファイルにまとめる
+    notify_progress(progress, "zip")
+    metrics.start_stage("zip")
+    logging.info("全成果物をZIPファイルにまとめています。")
+    with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.writestr("1_画面関連情報.md", transition_md.encode('utf-8'))
+        zip_file.writestr("2_結合テスト仕様書.md", test_spec_md.encode('utf-8'))
+        write_metrics_to_zip(zip_file, metrics)
+    logging.info("ZIPファイルの作成が完了しました。")
+    
+    return "結合テスト仕様書.zip"
+
+# --- 成果物・アップロードの一時ファイルとメモリ使用量 ---
+class MemoryBudget:
+    """
+    同時に実行中の単体テスト生成のメモリ使用量（見積もり）の合計を上限内に抑える。
+    上限を超える場合は、実行中の生成が終了してメモリが空くまで待機する。
+    """
+
+    def __init__(self, limit_bytes: int):
+        self.limit_bytes = limit_bytes  # 0の場合は制限なし
+        self.reserved = 0
+        self.condition = threading.Condition()
+
+    def fits(self, amount: int) -> bool:
+        return self.limit_bytes <= 0 or amount <= self.limit_bytes
+
+    def describe_excess(self, amount: int) -> str:
+        return f"設計書が大きすぎるため処理できません（必要なメモリの見積もり{amount // 1024 // 1024}MB、上限{self.limit_bytes // 1024 // 1024}MB）"
+
+    @contextmanager
+    def reserve(self, amount: int, label: str):
+        if self.limit_bytes <= 0:
+            yield
+            return
+        if not self.fits(amount):
+            raise SpecGenerationError(self.describe_excess(amount))
+        with self.condition:
+            if self.reserved + amount > self.limit_bytes:
+                logging.info(f"メモリの上限に達しているため、「{label}」の処理を待機します（見積もり{amount // 1024 // 1024}MB）。")
+            self.condition.wait_for(lambda: self.reserved + amount <= self.limit_bytes)
+            self.reserved += amount
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.reserved -= amount
+                self.condition.notify_all()
+
+memory_budget = MemoryBudget(memory_budget_mb * 1024 * 1024)
+
+# 単体テスト生成1件のメモリ使用量の見積もり = 基本量 + 係数 × 設計書（xlsx）の展開後サイズ
+# benchmarks/bench_memory.pyの計測値（展開後サイズの約3.4〜3.9倍 + 数MB）に余裕を持たせた値
+PIPELINE_MEMORY_BASE_BYTES = 16 * 1024 * 1024
+PIPELINE_MEMORY_PER_EXPANDED_BYTE = 4.0
+
+def estimate_pipeline_memory(source: bytes | Path) -> int:
+    """
+    単体テスト生成1件のピークメモリを見積もる（xlsxは圧縮されているため、展開後のサイズから求める）。
+    """
+    try:
+        with zipfile.ZipFile(io.BytesIO(source) if isinstance(source, bytes) else source) as book:
+            expanded = sum(info.file_size for info in book.infolist())
+    except zipfile.BadZipFile:
+        expanded = len(source) if isinstance(source, bytes) else Path(source).stat().st_size
+    return PIPELINE_MEMORY_BASE_BYTES + int(expanded * PIPELINE_MEMORY_PER_EXPANDED_BYTE)
+
+def get_upload_dir() -> Path:
+    upload_dir = Path(job_result_dir) / "uploads"
+    upload_dir.mkdir(parents=True, exist_ok=True)
+    return upload_dir
+
+def spill_upload(file_bytes: bytes, suffix: str) -> Path:
+    # 非同期ジョブの入力を一時ファイルに書き出す（ジョブの待機中・実行中にアップロード内容をメモリに保持しない）
+    upload_path = get_upload_dir() / f"{uuid.uuid4().hex}{suffix}"
+    upload_path.write_bytes(file_bytes)
+    return upload_path
+
+def remove_temp_path(path: Path):
+    try:
+        if path.is_dir():
+            shutil.rmtree(path)
+        else:
+            path.unlink()
+    except OSError as e:
+        logging.warning(f"一時ファイルの削除に失敗しました（{path}）: {e}")
+
+def open_artifact_output() -> IO[bytes]:
+    # 同期実行の成果物（ZIP）の書き込み先。ARTIFACT_SPOOL_MBを超える分は一時ファイルに書き出す
+    return tempfile.SpooledTemporaryFile(max_size=artifact_spool_mb * 1024 * 1024)
+
+def read_artifact(output: IO[bytes]) -> bytes:
+    # HttpResponseの本文はバイト列のみ受け付けるため、返却時に1回だけ読み込む
+    output.seek(0)
+    return output.read()
+
+# --- バッチ処理（ZIPにまとめた複数の設計書の一括生成） ---
+def decode_archive_member_name(info: zipfile.ZipInfo) -> str:
+    # UTF-8フラグのないファイル名（Windowsの標準機能で作成したZIPなど）はCP932として解釈し直す
+    if info.flag_bits & 0x800:
+        return info.filename
+    try:
+        return info.filename.encode("cp437").decode("cp932")
+    except (UnicodeEncodeError, UnicodeDecodeError):
+        return info.filename
+
+def extract_batch_archive(archive_bytes: bytes, target_dir: Path) -> tuple[list[tuple[str, Path]], list[str]]:
+    """
+    ZIPファイルから設計書（.xlsx）をtarget_dirへ取り出す（全設計書の内容を同時にメモリへ展開しない）。
+    戻り値: ([(ZIP内のパス, 取り出したファイル), ...], 対象外として読み飛ばしたファイルのパス一覧)
+    """
+    try:
+        archive = zipfile.ZipFile(io.BytesIO(archive_bytes))
+    except zipfile.BadZipFile:
+        raise BatchArchiveError("ZIPファイルを展開できませんでした")
+
+    with archive:
+        members = []
+        skipped = []
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
+            name = decode_archive_member_name(info)
+            basename = name.rsplit("/", 1)[-1]
+            # macOSのメタデータ、Excelの一時ファイル（~$で始まる）などは対象外
+            if name.startswith("__MACOSX/") or basename.startswith(("~$", ".")):
+                continue
+            if not basename.lower().endswith(".xlsx"):
+                skipped.append(name)
+                continue
+            members.append((name, info))
+
+        if not members:
+            raise BatchArchiveError("ZIPファイルにExcelファイル(.xlsx)が含まれていません")
+        if len(members) > batch_max_files:
+            raise BatchArchiveError(f"ZIPファイルに含められる設計書は{batch_max_files}件までです（{len(members)}件）")
+        if sum(info.file_size for _, info in members) > batch_max_total_bytes:
+            raise BatchArchiveError(f"設計書の合計サイズが上限（{batch_max_total_bytes // 1024 // 1024}MB）を超えています")
+
+        design_files = []
+        for index, (name, info) in enumerate(members):
+            path = target_dir / f"{index}.xlsx"
+            with archive.open(info) as member, open(path, "wb") as file:
+                shutil.copyfileobj(member, file)
+            design_files.append((name, path))
+        return design_files, skipped
+
+def get_batch_output_dir(name: str, used: set) -> str:
+    # ZIP内のパスから拡張子を除いたものを出力先のフォルダ名にする（「..」などは除去し、重複する場合は連番を付ける）
+    parts = [part for part in name[:-len(".xlsx")].split("/") if part not in ("", ".", "..")]
+    base = "/".join(parts) or "設計書"
+    output_dir = base
+    index = 2
+    while output_dir in used:
+        output_dir = f"{base}_{index}"
+        index += 1
+    used.add(output_dir)
+    return output_dir
+
+def generate_batch_unit_test(req: func.HttpRequest, archive_bytes: bytes, filename: str, use_cache: bool) -> func.HttpResponse:
+    # 設計書は一時ディレクトリに取り出し、処理する時点で1件ずつ読み込む
+    upload_dir = get_upload_dir() / uuid.uuid4().hex
+    upload_dir.mkdir()
+    try:
+        design_files, skipped_files = extract_batch_archive(archive_bytes, upload_dir)
+    except BatchArchiveError as be:
+        remove_temp_path(upload_dir)
+        return func.HttpResponse(str(be), status_code=400)
+    except Exception as e:
+        remove_temp_path(upload_dir)
+        logging.error(f"ZIPファイルの展開エラー: {e}")
+        return func.HttpResponse("ファイルの取得に失敗しました", status_code=400)
+
+    logging.info(f"{filename} を受信しました。{len(design_files)}件の設計書の単体テスト生成を開始します。")
+
+    if is_async_requested(req):
+        job_id = submit_job(
+            lambda progress, output: run_batch_unit_test_pipeline(design_files, filename, output, use_cache, progress, skipped_files),
+            BATCH_UNIT_TEST_STAGES,
+            input_paths=[upload_dir],
+        )
+        return build_job_accepted_response(job_id)
+
+    try:
+        with open_artifact_output() as output:
+            output_filename = run_batch_unit_test_pipeline(design_files, filename, output, use_cache, None, skipped_files)
+            return build_zip_response(read_artifact(output), output_filename)
+
+    except SpecGenerationError as se:
+        return func.HttpResponse(str(se), status_code=500)
     except ValueError as ve:
         logging.error(f"設定エラー: {ve}")
         return func.HttpResponse(str(ve), status_code=500)
     except Exception as e:
         logging.error(f"処理全体で予期せぬエラーが発生: {e}")
-        return func.HttpResponse("処理中にサーバーエラーが発生しました", status_code=500)
\ No newline at end of file
+        return func.HttpResponse("処理中にサーバーエラーが発生しました", status_code=500)
+    finally:
+        remove_temp_path(upload_dir)
+
+def run_batch_unit_test_pipeline(design_files: list[tuple[str, Path]], archive_filename: str, output: IO[bytes], use_cache: bool = True, progress=None, skipped_files: list[str] | None = None) -> str:
+    """
+    複数の設計書の単体テスト生成を並行して実行し、成果物を1つのZIPにまとめる。
+    全設計書のシート・セクション単位のLLM呼び出しは共通のワーカー（最大LLM_MAX_CONCURRENCY並列）で実行し、
+    ある設計書の待ち時間中も他の設計書の呼び出しでLLMの上限を使い切るようにする。
+    1件の設計書が失敗しても他の設計書の処理は継続し、結果は処理結果一覧に記録する。
+    design_files: (ZIP内のパス, 取り出したファイル) の一覧
+    output: 成果物のZIPを書き込むファイル（設計書ごとの成果物は完成した順に追加する）
+    戻り値: 返却用ファイル名
+    """
+    total = len(design_files)
+    used_dirs = set()
+    output_dirs = [get_batch_output_dir(name, used_dirs) for name, _ in design_files]
+    results = [None] * total
+    completed = {"succeeded": 0, "failed": 0}
+    zip_lock = threading.Lock()
+
+    def notify_completed():
+        detail = f"{completed['succeeded'] + completed['failed']}/{total}件完了"
+        if completed["failed"]:
+            detail += f"（失敗{completed['failed']}件）"
+        notify_progress(progress, "files", detail)
+
+    def run_file(index: int):
+        name, path = design_files[index]
+        run_id = uuid.uuid4().hex
+        result = {"file": name, "outputDir": output_dirs[index], "runId": run_id, "status": "failed", "error": None}
+        started = time.monotonic()
+        try:
+            # ZIP内のパスをファイル名として扱い、次回の同じZIPのアップロード時に差分再生成の元にする
+            # 設計書ごとの成果物は一時ファイルに書き込み、全体のZIPへはファイル単位で逐次コピーする
+            with tempfile.TemporaryFile() as file_output:
+                run_unit_test_pipeline(path, name, file_output, use_cache, None, run_id, llm_executor=llm_executor)
+                with zipfile.ZipFile(file_output) as file_zip:
+                    file_metrics = json.loads(file_zip.read("metrics.json"))["total"]
+                    with zip_lock:
+                        for member in file_zip.infolist():
+                            with file_zip.open(member) as src, zip_file.open(f"{output_dirs[index]}/{member.filename}", "w") as dst:
+                                shutil.copyfileobj(src, dst)
+            result.update(
+                status="succeeded",
+                testCases=file_metrics["attributes"].get("testCases"),
+                llmCalls=file_metrics["llmCalls"],
+                inputTokens=file_metrics["inputTokens"],
+                outputTokens=file_metrics["outputTokens"],
+                costUsd=file_metrics["costUsd"],
+            )
+        except SpecGenerationError as se:
+            result["error"] = str(se)
+        except ValueError as ve:
+            logging.error(f"設定エラー: {ve}")
+            result["error"] = str(ve)
+        except Exception as e:
+            logging.error(f"「{name}」の処理中に予期せぬエラーが発生: {e}")
+            result["error"] = "処理中にサーバーエラーが発生しました"
+        result["durationSeconds"] = round(time.monotonic() - started, 3)
+        results[index] = result
+        with zip_lock:
+            completed[result["status"]] += 1
+            notify_completed()
+
+    notify_progress(progress, "files", f"0/{total}件完了")
+    logging.info(f"{total}件の設計書を最大{batch_file_concurrency}件ずつ、LLM呼び出しは全体で最大{llm_max_concurrency}並列で処理します。")
+    with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        with ThreadPoolExecutor(max_workers=llm_max_concurrency, thread_name_prefix="batch-llm") as llm_executor, \
+                ThreadPoolExecutor(max_workers=batch_file_concurrency, thread_name_prefix="batch-file") as file_executor:
+            # 設計書ごとに独立したコンテキストで実行する（計測のスパンが混ざらないようにする）
+            list(file_executor.map(bind_context(run_file), range(total)))
+
+        if not completed["succeeded"]:
+            raise SpecGenerationError(f"すべての設計書の生成に失敗しました（{results[0]['file']}: {results[0]['error']}）")
+
+        notify_progress(progress, "zip")
+        summary = {
+            "archive": archive_filename,
+            "files": total,
+            "succeeded": completed["succeeded"],
+            "failed": completed["failed"],
+            "skipped": skipped_files or [],
+            "results": results,
+        }
+        zip_file.writestr("batch_summary.json", json.dumps(summary, ensure_ascii=False, indent=2).encode('utf-8'))
+        zip_file.writestr("処理結果一覧.md", render_batch_summary(summary).encode('utf-8'))
+
+    logging.info(f"バッチ処理が完了しました（成功{completed['succeeded']}件、失敗{completed['failed']}件）。")
+    return f"テスト仕様書_{Path(archive_filename).stem}.zip"
+
+def render_batch_summary(summary: dict) -> str:
+    rows = [
+        {
+            "設計書": result["file"],
+            "結果": "成功" if result["status"] == "succeeded" else "失敗",
+            "出力先": f"{result['outputDir']}/" if result["status"] == "succeeded" else "",
+            "テストケース数": str(result.get("testCases") or ""),
+            "所要時間（秒）": str(result["durationSeconds"]),
+            "エラー": result["error"] or "",
+        }
+        for result in summary["results"]
+    ]
+    md = f"# 処理結果一覧（{summary['archive']}）\n\n"
+    md += f"- 設計書: {summary['files']}件（成功{summary['succeeded']}件、失敗{summary['failed']}件）\n"
+    if summary["skipped"]:
+        md += f"- 対象外のファイル（.xlsx以外）: {', '.join(summary['skipped'])}\n"
+    md += "\n" + render_markdown_table(list(rows[0]), rows)
+    return md
+
+# --- 非同期ジョブ管理 ---
+# ステージ定義（ステージ名, 表示名）
+UNIT_TEST_STAGES = [
+    ("structuring", "設計書の構造化"),
+    ("perspectives", "テスト観点抽出"),
+    ("spec", "テスト仕様書生成"),
+    ("excel", "Excel変換"),
+    ("zip", "ZIP作成"),
+]
+INTEGRATION_TEST_STAGES = [
+    ("structuring_transition", "画面関連情報の構造化"),
+    ("spec", "結合テスト仕様書生成"),
+    ("zip", "ZIP作成"),
+]
+BATCH_UNIT_TEST_STAGES = [
+    ("files", "設計書ごとのテスト仕様書生成"),
+    ("zip", "ZIP作成"),
+]
+
+def get_job_executor() -> ThreadPoolExecutor:
+    # ジョブ実行用のワーカーは初回投入時に生成する
+    global job_executor
+    with jobs_lock:
+        if job_executor is None:
+            job_executor = ThreadPoolExecutor(max_workers=job_max_concurrency, thread_name_prefix="job")
+        return job_executor
+
+def submit_job(pipeline, stages: list[tuple[str, str]], input_paths: list[Path] | None = None) -> str:
+    """
+    パイプラインをバックグラウンドで実行するジョブとして登録し、ジョブIDを返す。
+    pipeline: progressコールバックと成果物（ZIP）の書き込み先を受け取り、返却用ファイル名を返す関数
+    input_paths: ジョブの終了後に削除する入力の一時ファイル・ディレクトリ
+    """
+    cleanup_expired_jobs()
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    with jobs_lock:
+        jobs[job_id] = {
+            "jobId": job_id,
+            "status": "queued",
+            "stages": [
+                {"name": name, "label": label, "status": "pending", "detail": None, "startedAt": None, "completedAt": None}
+                for name, label in stages
+            ],
+            "error": None,
+            "filename": None,
+            "resultPath": None,
+            "createdAt": now,
+            "updatedAt": now,
+        }
+    get_job_executor().submit(run_job, job_id, pipeline, input_paths or [])
+    logging.info(f"ジョブ {job_id} を登録しました。")
+    return job_id
+
+def run_job(job_id: str, pipeline, input_paths: list[Path]):
+    update_job(job_id, status="running")
+    # 成果物はメモリに保持せず、一時ディレクトリのファイルへ直接書き込む（完了後に名前を変更して公開する）
+    result_dir = Path(job_result_dir)
+    result_dir.mkdir(parents=True, exist_ok=True)
+    result_path = result_dir / f"{job_id}.zip"
+    partial_path = result_dir / f"{job_id}.zip.partial"
+    try:
+        with open(partial_path, "wb") as output:
+            output_filename = pipeline(lambda stage, detail=None: update_job_stage(job_id, stage, detail), output)
+        os.replace(partial_path, result_path)
+
+        update_job_stage(job_id, None)
+        update_job(job_id, status="succeeded", filename=output_filename, resultPath=str(result_path))
+        logging.info(f"ジョブ {job_id} が完了しました。")
+
+    except SpecGenerationError as se:
+        fail_job(job_id, str(se))
+    except ValueError as ve:
+        logging.error(f"設定エラー: {ve}")
+        fail_job(job_id, str(ve))
+    except Exception as e:
+        logging.error(f"ジョブ {job_id} で予期せぬエラーが発生: {e}")
+        fail_job(job_id, "処理中にサーバーエラーが発生しました")
+    finally:
+        if partial_path.exists():
+            remove_temp_path(partial_path)
+        for path in input_paths:
+            remove_temp_path(path)
+
+def update_job(job_id: str, **fields):
+    with jobs_lock:
+        job = jobs.get(job_id)
+        if job is None:
+            return
+        job.update(fields)
+        job["updatedAt"] = time.time()
+
+def update_job_stage(job_id: str, stage: str | None, detail: str | None = None):
+    """
+    指定ステージを実行中にし、それ以前のステージを完了にする。stageがNoneの場合は全ステージを完了にする。
+    detail: 実行中ステージの補足情報（生成済みのテストケース件数など）
+    ステージごとの開始・完了時刻（startedAt/completedAt）も記録する。
+    """
+    now = time.time()
+    with jobs_lock:
+        job = jobs.get(job_id)
+        if job is None:
+            return
+        reached = False
+        for item in job["stages"]:
+            if item["name"] == stage:
+                if item["status"] != "running":
+                    item["startedAt"] = now
+                item["status"] = "running"
+                item["detail"] = detail
+                reached = True
+            elif not reached:
+                if item["status"] != "completed":
+                    item["completedAt"] = now
+                item["status"] = "completed"
+        job["updatedAt"] = now
+
+def fail_job(job_id: str, message: str):
+    with jobs_lock:
+        job = jobs.get(job_id)
+        if job is None:
+            return
+        for item in job["stages"]:
+            if item["status"] == "running":
+                item["status"] = "failed"
+        job["status"] = "failed"
+        job["error"] = message
+        job["updatedAt"] = time.time()
+
+def cleanup_expired_jobs():
+    # 保持期間を過ぎた完了済みジョブと成果物を削除する
+    expire_before = time.time() - job_retention_seconds
+    with jobs_lock:
+        expired = [
+            job_id for job_id, job in jobs.items()
+            if job["status"] in ("succeeded", "failed") and job["updatedAt"] < expire_before
+        ]
+        for job_id in expired:
+            result_path = jobs.pop(job_id)["resultPath"]
+            if result_path:
+                try:
+                    os.remove(result_path)
+                except OSError:
+                    pass
+
+def build_job_accepted_response(job_id: str, run_id: str | None = None) -> func.HttpResponse:
+    body = {
+        "jobId": job_id,
+        "statusUrl": f"jobs/{job_id}",
+        "resultUrl": f"jobs/{job_id}/result",
+    }
+    if run_id:
+        body["runId"] = run_id
+    return func.HttpResponse(json.dumps(body), status_code=202, mimetype="application/json")
+
+@app.route(route="jobs/{job_id}", methods=["GET"])
+def job_status(req: func.HttpRequest) -> func.HttpResponse:
+    job_id = req.route_params.get("job_id")
+    with jobs_lock:
+        job = jobs.get(job_id)
+        if job is None:
+            return func.HttpResponse("指定されたジョブが見つかりません", status_code=404)
+        body = {
+            "jobId": job["jobId"],
+            "status": job["status"],
+            "stages": [dict(item) for item in job["stages"]],
+            "error": job["error"],
+            "createdAt": job["createdAt"],
+            "updatedAt": job["updatedAt"],
+        }
+    return func.HttpResponse(json.dumps(body, ensure_ascii=False), status_code=200, mimetype="application/json")
+
+@app.route(route="jobs/{job_id}/result", methods=["GET"])
+def job_result(req: func.HttpRequest) -> func.HttpResponse:
+    job_id = req.route_params.get("job_id")
+    with jobs_lock:
+        job = jobs.get(job_id)
+        if job is None:
+            return func.HttpResponse("指定されたジョブが見つかりません", status_code=404)
+        status = job["status"]
+        result_path = job["resultPath"]
+        output_filename = job["filename"]
+        error = job["error"]
+
+    if status == "failed":
+        return func.HttpResponse(error or "ジョブが失敗しました", status_code=500)
+    if status != "succeeded":
+        return func.HttpResponse("ジョブはまだ完了していません", status_code=409)
+
+    # HttpResponseは本文をバイト列で受け取るため、返却時に成果物を読み込む
+    try:
+        zip_bytes = Path(result_path).read_bytes()
+    except OSError as e:
+        logging.error(f"ジョブ成果物の読み込みに失敗しました: {e}")
+        return func.HttpResponse("ジョブの成果物が見つかりません", status_code=410)
+    return build_zip_response(zip_bytes, output_filename)
+
+# --- ワーカー起動時のウォームアップ ---
+def warm_up():
+    """
+    初回のリクエストで必要になる読み込みを、ワーカーの起動時に済ませておく。
+    - Excelの読み込みに使うライブラリ（pandas、読み込みエンジン）
+    - 選択したLLMサービスのSDKとクライアント（クライアントの生成のみで、LLMは呼び出さない）
+    - テスト仕様書テンプレート（初回の解析に数秒〜数十秒かかる）
+    失敗した場合も初回のリクエストで改めて読み込まれるため、警告を記録して続行する。
+    """
+    def step(label: str, load):
+        started = time.monotonic()
+        try:
+            load()
+            logging.info(f"ウォームアップ: {label}を読み込みました（{time.monotonic() - started:.1f}秒）。")
+        except Exception as e:
+            logging.warning(f"ウォームアップ: {label}の読み込みに失敗しました: {e}")
+
+    def import_excel_libraries():
+        import pandas  # noqa: F401
+        if excel_read_engine == "calamine" and importlib.util.find_spec("python_calamine") is not None:
+            import python_calamine  # noqa: F401
+        else:
+            import openpyxl  # noqa: F401
+
+    def create_llm_clients():
+        for endpoint in get_llm_endpoints():
+            endpoint.get_client()
+
+    started = time.monotonic()
+    step("Excelの読み込みライブラリ", import_excel_libraries)
+    step("LLMクライアント", create_llm_clients)
+    step("テンプレートExcel", get_template_workbook_bytes)
+    logging.info(f"ウォームアップが完了しました（{time.monotonic() - started:.1f}秒）。")
+
+# ホストによる関数の読み込み（インデックス作成）を妨げないよう、ウォームアップは別スレッドで実行する
+if warmup_enabled:
+    threading.Thread(target=warm_up, name="warmup", daemon=True).start()